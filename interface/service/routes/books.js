@@ -83,7 +83,9 @@ router.get('/get/:title/simple', async (req, res, next) => {
 router.get('/image/:fileLocation', async (req, res, next) => {
   try {
     const result = await pool.query(
-      'SELECT content, format FROM images WHERE location = $1',
+      `SELECT COALESCE(image_blobs.content, images.content) AS content, images.format
+       FROM images LEFT JOIN image_blobs ON image_blobs.hash_sha256 = images.hash_sha256
+       WHERE images.location = $1 LIMIT 1`,
       [req.params.fileLocation],
     );
     if (result.rows.length == 0) {
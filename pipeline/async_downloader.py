@@ -0,0 +1,219 @@
+import asyncio
+import os
+import os.path
+import random
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import boto3
+
+from epub_downloader import (APPEND, BUCKET_NAME, RESTART, RETRY, SKIP, conditional_request, default_epubs_directory,
+                             get_epub_link, response_action, response_metadata, write_metadata)
+
+DEFAULT_CONCURRENCY = 16
+# Requests started per second on each host, so a large --all run doesn't hammer the mirror
+DEFAULT_RATE = 5.0
+DEFAULT_RETRIES = 5
+# Seconds before the first retry, doubled on each following one
+DEFAULT_BACKOFF = 1.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Read and write in large chunks, the mirror serves whole books rather than small responses
+CHUNK_SIZE = 1024 * 1024
+# Books uploaded to S3 are kept in memory up to this size, and spill over to a temporary file above it
+SPOOL_SIZE = 32 * 1024 * 1024
+
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+
+class RetryableStatus(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """Spaces out the requests to each host, so that at most `rate` of them start every second.
+
+    Arguments:
+        rate {float} -- Requests per second per host, or 0 for no limit."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = {}
+
+    async def wait(self, host):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self.next_slot.get(host, now))
+        # Nothing is awaited between reading and reserving the slot, so concurrent tasks get distinct slots
+        self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def retry_delay(attempt, backoff, response=None):
+    """Exponential backoff with jitter, or the Retry-After of the response when the server sends one in seconds."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    return backoff * 2 ** attempt * random.uniform(0.5, 1)
+
+
+async def download_file(session, limiter, link, f, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """Streams a file from an HTTP(S) URL to a file-like object, retrying timeouts, connection errors and 5xx
+    responses. The file is truncated before each attempt, so a retry never appends to a partial download.
+
+    Arguments:
+        session {aiohttp.ClientSession} -- The session, whose connections are kept alive between downloads.
+        limiter {RateLimiter} -- Spaces out the requests to the host.
+        link {str} -- The URL to download
+        f {file} -- The seekable file-like object to write to
+
+    Keyword Arguments:
+        retries {int} -- Attempts after the first one [default: {DEFAULT_RETRIES}]
+        backoff {float} -- Seconds before the first retry [default: {DEFAULT_BACKOFF}]
+
+    Returns:
+        int -- The number of bytes written"""
+    host = urlsplit(link).hostname
+    for attempt in range(retries + 1):
+        await limiter.wait(host)
+        response = None
+        try:
+            async with session.get(link) as response:
+                if response.status in RETRY_STATUSES:
+                    raise RetryableStatus(f"{response.status}: {link}")
+                if response.status != 200:
+                    raise FileNotFoundError(f"{response.status}: {link}")
+                f.seek(0)
+                f.truncate()
+                size = 0
+                async for data in response.content.iter_chunked(CHUNK_SIZE):
+                    f.write(data)
+                    size += len(data)
+                return size
+        except (RetryableStatus, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay(attempt, backoff, response)
+            print(f"warning: ({link}) {e or type(e).__name__}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def download_to_path(session, limiter, link, path, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """Downloads a file to `path` unless the copy on disk is up to date, like epub_downloader.download_to_path. A
+    download which fails half way is resumed from its `.part` file by the next attempt.
+
+    Returns:
+        bool -- True if the file was downloaded, False if the copy on disk was up to date"""
+    host = urlsplit(link).hostname
+    for attempt in range(retries + 1):
+        await limiter.wait(host)
+        headers, offset, metadata = conditional_request(path, link)
+        response = None
+        try:
+            async with session.get(link, headers=headers) as response:
+                if response.status in RETRY_STATUSES:
+                    raise RetryableStatus(f"{response.status}: {link}")
+                action = response_action(path, link, response.status, response.headers, offset, metadata)
+                if action == SKIP:
+                    return False
+                if action == RETRY:
+                    raise RetryableStatus(f"can't resume {link}")
+                if action == RESTART:
+                    metadata = response_metadata(link, response.headers)
+                    write_metadata(path, metadata)
+                with open(path + ".part", "ab" if action == APPEND else "wb", buffering=CHUNK_SIZE) as f:
+                    async for data in response.content.iter_chunked(CHUNK_SIZE):
+                        f.write(data)
+            os.replace(path + ".part", path)
+            write_metadata(path, dict(metadata, size=os.path.getsize(path)))
+            return True
+        except (RetryableStatus, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise
+            delay = retry_delay(attempt, backoff, response)
+            print(f"warning: ({link}) {e or type(e).__name__}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def download_book(session, limiter, id, output=default_epubs_directory, s3_client=None,
+                        retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, link=get_epub_link):
+    """Downloads an ebook to `output`, or uploads it to the S3 bucket when an `s3_client` is given.
+
+    A book is written to a `.part` file which is renamed once it is complete, so an interrupted run never leaves a
+    truncated EPUB behind for process.py to pick up, and the next run resumes it.
+
+    Returns:
+        tuple -- The path of the ebook on the local filesystem or on the AWS S3 bucket, and whether it was
+                 downloaded rather than up to date already"""
+    ebook_link = link(id)
+    filename = ebook_link.split('/')[-1]
+
+    if s3_client is not None:
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+            await download_file(session, limiter, ebook_link, f, retries, backoff)
+            f.seek(0)
+            # boto3 is blocking, so the upload runs in a thread while the other downloads go on
+            await asyncio.get_running_loop().run_in_executor(
+                None, s3_client.upload_fileobj, f, BUCKET_NAME, filename)
+        return f"s3://{BUCKET_NAME}/{filename}", True
+
+    path = os.path.join(output, filename)
+    return path, await download_to_path(session, limiter, ebook_link, path, retries, backoff)
+
+
+async def download_books(books, output=default_epubs_directory, upload_s3=False, concurrency=DEFAULT_CONCURRENCY,
+                         rate=DEFAULT_RATE, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, link=get_epub_link):
+    """Downloads books with `concurrency` downloads in flight, over one pool of keep-alive connections. A book which
+    can't be downloaded is reported and doesn't stop the others.
+
+    Arguments:
+        books {iterable} -- The id and title of each book, consumed lazily so the catalog is never held twice.
+
+    Keyword Arguments:
+        output {str} -- The directory the books are written to [default: {default_epubs_directory}]
+        upload_s3 {bool} -- Upload the books to the AWS S3 bucket instead [default: {False}]
+        concurrency {int} -- The number of books downloaded at once [default: {DEFAULT_CONCURRENCY}]
+        rate {float} -- Requests per second per host, 0 for no limit [default: {DEFAULT_RATE}]
+        retries {int} -- Attempts after the first one for each book [default: {DEFAULT_RETRIES}]
+        backoff {float} -- Seconds before the first retry [default: {DEFAULT_BACKOFF}]
+        link {function} -- Returns the URL of a book id [default: {get_epub_link}]
+
+    Returns:
+        tuple -- The paths of the downloaded books, the paths of the books which were up to date, and the error of
+                 each book which failed by id."""
+    if not upload_s3:
+        os.makedirs(output, exist_ok=True)
+    s3_client = boto3.client('s3') if upload_s3 else None
+    limiter = RateLimiter(rate)
+    books = iter(books)
+    paths = []
+    up_to_date = []
+    failed = {}
+
+    async def worker(session):
+        # Every worker pulls the next book when it is done, so only `concurrency` books are in flight
+        for id, title in books:
+            print(f"{'Uploading S3' if upload_s3 else 'Downloading'} {id}. {title or ''}".rstrip())
+            try:
+                path, downloaded = await download_book(session, limiter, id, output, s3_client, retries, backoff, link)
+                (paths if downloaded else up_to_date).append(path)
+            except Exception as e:
+                print(f"error: ({id}) {e or type(e).__name__}")
+                failed[id] = e
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    return paths, up_to_date, failed
+
+
+def main(books, args):
+    start = time.monotonic()
+    paths, up_to_date, failed = asyncio.run(download_books(
+        books, args.output, args.upload_s3, args.concurrency, args.rate, args.retries))
+    print(f"Downloaded {len(paths)} books in {time.monotonic() - start:.1f}s, {len(up_to_date)} were up to date, "
+          f"{len(failed)} failed")
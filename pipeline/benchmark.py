@@ -0,0 +1,374 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from epub_parser import MemberCache
+from process import BACKENDS
+
+# The phases of parsing a book, in the order they run
+PHASES = ["package", "html", "split", "rewrite", "serialize", "images"]
+
+# Every member of a synthetic book fits in the member cache, so each phase is only measured once per run
+BENCHMARK_MEMBER_CACHE_BYTES = 4 * 1024 * 1024 * 1024
+
+WORDS = ["the", "of", "and", "to", "a", "in", "that", "was", "he", "it", "his", "with", "had", "for", "as", "her",
+         "you", "not", "but", "she", "on", "at", "by", "which", "have", "from", "this", "him", "all", "were", "be",
+         "so", "one", "they", "said", "there", "would", "been", "upon", "when", "what", "their", "no", "are", "or",
+         "could", "an", "me", "if", "my", "more", "into", "very", "then", "some", "than", "time", "now", "little"]
+
+
+def synthetic_epub(spine_files=20, navpoints_per_file=4, anchor_density=0.2, chapter_paragraphs=40,
+                   paragraph_words=80, images=10, image_bytes=50 * 1024, seed=0):
+    """Generates an EPUB shaped like a Gutenberg book, with every dimension the parser is sensitive to as a knob.
+
+    Each spine file holds `navpoints_per_file` chapters, each of which starts with a header the NCX points to. A
+    paragraph carries an id with probability `anchor_density`, and every such paragraph links to another one,
+    usually in a different file. Images are spread over the files and stored uncompressed, like the PNG and JPEG
+    files of real books.
+
+    Keyword Arguments:
+        spine_files {int} -- The number of HTML files in the spine [default: {20}]
+        navpoints_per_file {int} -- The number of chapters in each file [default: {4}]
+        anchor_density {float} -- The share of paragraphs which are link targets and links [default: {0.2}]
+        chapter_paragraphs {int} -- The number of paragraphs in each chapter [default: {40}]
+        paragraph_words {int} -- The number of words in each paragraph [default: {80}]
+        images {int} -- The number of images [default: {10}]
+        image_bytes {int} -- The size of each image [default: {50 * 1024}]
+        seed {int} -- The seed of the generator, the same knobs and seed always produce the same book
+                      [default: {0}]
+
+    Returns:
+        bytes -- The EPUB file."""
+    rng = random.Random(seed)
+
+    anchors = [[(chapter, paragraph) for chapter in range(navpoints_per_file) for paragraph in range(chapter_paragraphs)
+                if rng.random() < anchor_density] for _ in range(spine_files)]
+    targets = [(index, anchor) for index, file_anchors in enumerate(anchors) for anchor in file_anchors]
+    images_by_file = defaultdict(list)
+    for image in range(images):
+        images_by_file[image % spine_files].append(image)
+
+    files = []
+    navpoints = []
+    for index in range(spine_files):
+        anchored = set(anchors[index])
+        file_images = images_by_file[index]
+        body = []
+        for chapter in range(navpoints_per_file):
+            header_id = f"f{index}-c{chapter}"
+            title = f"Chapter {index * navpoints_per_file + chapter + 1}"
+            navpoints.append((f"f{index}.xhtml#{header_id}", title))
+            body.append(f'<div class="chapter">\n<h2 id="{header_id}">{title}</h2>\n')
+            for paragraph in range(chapter_paragraphs):
+                text = " ".join(rng.choice(WORDS) for _ in range(paragraph_words))
+                if (chapter, paragraph) in anchored:
+                    target_file, (target_chapter, target_paragraph) = rng.choice(targets)
+                    link = f'f{target_file}.xhtml#f{target_file}-p{target_chapter}-{target_paragraph}'
+                    body.append(f'<p id="f{index}-p{chapter}-{paragraph}">{text} <a href="{link}">see also</a></p>\n')
+                else:
+                    body.append(f'<p>{text}</p>\n')
+                if file_images and paragraph == chapter_paragraphs // 2:
+                    image = file_images.pop()
+                    body.append(f'<div class="figure"><img src="../images/image{image}.png" alt="Figure {image}"/>'
+                                f'</div>\n')
+            body.append('</div>\n')
+        for image in file_images:
+            body.append(f'<div class="figure"><img src="../images/image{image}.png" alt="Figure {image}"/></div>\n')
+        files.append('<?xml version="1.0" encoding="utf-8"?>\n'
+                     '<html xmlns="http://www.w3.org/1999/xhtml">\n'
+                     f'<head><title>Synthetic {index}</title></head>\n<body>\n{"".join(body)}</body>\n</html>\n')
+
+    manifest = ['<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>']
+    manifest.extend(f'<item id="f{index}" href="text/f{index}.xhtml" media-type="application/xhtml+xml"/>'
+                    for index in range(spine_files))
+    manifest.extend(f'<item id="image{image}" href="images/image{image}.png" media-type="image/png"/>'
+                    for image in range(images))
+    spine = "".join(f'<itemref idref="f{index}"/>' for index in range(spine_files))
+    package = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<package xmlns="http://www.idpf.org/2007/opf" version="2.0">\n'
+               '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Synthetic Book</dc:title>'
+               '<dc:creator>Benchmark</dc:creator><dc:date>2021-01-01</dc:date></metadata>\n'
+               f'<manifest>\n{chr(10).join(manifest)}\n</manifest>\n<spine toc="ncx">{spine}</spine>\n</package>\n')
+    ncx = ('<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"><navMap>\n' +
+           "".join(f'<navPoint id="n{order}" playOrder="{order}"><navLabel><text>{title}</text></navLabel>'
+                   f'<content src="text/{src}"/></navPoint>\n' for order, (src, title) in enumerate(navpoints, 1)) +
+           '</navMap></ncx>\n')
+
+    book = io.BytesIO()
+    with zipfile.ZipFile(book, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml",
+                   '<?xml version="1.0"?>\n<container version="1.0" '
+                   'xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+                   '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                   '</rootfiles></container>\n')
+        z.writestr("OEBPS/content.opf", package)
+        z.writestr("OEBPS/toc.ncx", ncx)
+        for index, html in enumerate(files):
+            z.writestr(f"OEBPS/text/f{index}.xhtml", html)
+        for image in range(images):
+            z.writestr(f"OEBPS/images/image{image}.png", rng.getrandbits(8 * image_bytes).to_bytes(image_bytes, "little"),
+                       zipfile.ZIP_STORED)
+    return book.getvalue()
+
+
+@contextlib.contextmanager
+def span(timings, phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] += time.perf_counter() - start
+
+
+def instrument(content_parser_class, timings):
+    """Subclasses a content parser so it records how long splitting, rewriting and serializing take.
+
+    Rewriting and serializing happen in a single pass over each chapter, so the time spent in `swap_locations` is
+    measured for every tag and taken out of the serialization time. The timer itself adds a little to the rewrite
+    time.
+
+    Arguments:
+        content_parser_class {type} -- ContentParser or one of its subclasses.
+        timings {defaultdict} -- Receives the seconds spent in each phase.
+
+    Returns:
+        type -- The instrumented class."""
+
+    class InstrumentedContentParser(content_parser_class):
+        def parse_chapters(self):
+            with span(timings, "split"):
+                super().parse_chapters()
+
+        def convert_raws_to_output(self):
+            rewrite = timings["rewrite"]
+            with span(timings, "serialize"):
+                super().convert_raws_to_output()
+            timings["serialize"] -= timings["rewrite"] - rewrite
+
+        def swap_locations(self, names, attrs):
+            start = time.perf_counter()
+            super().swap_locations(names, attrs)
+            timings["rewrite"] += time.perf_counter() - start
+
+    return InstrumentedContentParser
+
+
+def parse_phases(book, backend="bs4", prepare_text=False):
+    """Parses a book the way `EpubParser.parse` does, timing each phase on its own.
+
+    Arguments:
+        book {bytes} -- The EPUB file.
+
+    Keyword Arguments:
+        backend {str} -- The key of the parser in BACKENDS [default: {"bs4"}]
+        prepare_text {bool} -- Also compute the text of the chapters, which is counted as serialization
+                               [default: {False}]
+
+    Returns:
+        tuple -- The seconds spent in each phase, and the number of chapters."""
+    timings = defaultdict(float)
+    epub = BACKENDS[backend]("synthetic.epub", io.BytesIO(book), file_hash="synthetic",
+                             member_cache=MemberCache(BENCHMARK_MEMBER_CACHE_BYTES))
+
+    with span(timings, "package"):
+        if not epub.can_be_unzipped():
+            raise ValueError("The synthetic book can't be unzipped")
+        content_directory_path = os.path.dirname(epub.content_path)
+        epub.set_metadata_from_xml(epub.package)
+        ncx = epub.get_file_content_xml(epub.ncx_path)
+        epub.populate_html_page_list(epub.package, content_directory_path)
+        epub.populate_image_list(epub.package, content_directory_path)
+        epub.process_navpoints(ncx)
+
+    # The parsed files stay in the member cache, so splitting doesn't parse them again
+    with span(timings, "html"):
+        for filename in epub.html_file_order:
+            epub.html_files[filename]()
+
+    content_parser_class = instrument(epub.content_parser_class, timings)
+    content = content_parser_class(epub.html_file_order, epub.html_files, epub.image_files, epub.navpoints,
+                                   prepare_text=prepare_text)
+
+    with span(timings, "images"):
+        for image in content.images:
+            image.read()
+
+    return {phase: timings[phase] for phase in PHASES}, len(content.chapters)
+
+
+def run_benchmark(book, backend="bs4", repeat=5, prepare_text=False):
+    """Parses a book `repeat` times after one warm-up run.
+
+    Arguments:
+        book {bytes} -- The EPUB file.
+
+    Keyword Arguments:
+        backend {str} -- The key of the parser in BACKENDS [default: {"bs4"}]
+        repeat {int} -- The number of measured runs [default: {5}]
+        prepare_text {bool} -- Also compute the text of the chapters [default: {False}]
+
+    Returns:
+        dict -- The median and the minimum seconds of each phase and of the whole parse, and the number of
+                chapters."""
+    parse_phases(book, backend, prepare_text)
+    runs = []
+    for _ in range(repeat):
+        phases, chapters = parse_phases(book, backend, prepare_text)
+        phases["total"] = sum(phases.values())
+        runs.append(phases)
+    return {
+        "median": {phase: statistics.median(run[phase] for run in runs) for phase in runs[0]},
+        "min": {phase: min(run[phase] for run in runs) for phase in runs[0]},
+        "chapters": chapters,
+    }
+
+
+def git_revision():
+    """Returns:
+        tuple -- The commit the working tree is at, and whether it has uncommitted changes, or (None, None) outside
+                 of a git checkout."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=directory, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def record_result(path, result):
+    with open(path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def load_history(path, backend, knobs):
+    """Reads the results recorded for the same backend and book, in the order they were recorded.
+
+    Returns:
+        list -- The matching results."""
+    if not os.path.exists(path):
+        return []
+    history = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result["backend"] == backend and result["knobs"] == knobs:
+                history.append(result)
+    return history
+
+
+def format_row(label, seconds):
+    return f"{label:<24}" + "".join(f"{seconds[phase] * 1000:>11.1f}" for phase in PHASES + ["total"])
+
+
+def prepare_args():
+    parser = argparse.ArgumentParser(description='Time each phase of parsing a synthetic EPUB')
+
+    parser.add_argument('--backend', nargs='+', choices=sorted(BACKENDS), default=sorted(BACKENDS),
+                        help="Backends to measure [default: all]")
+    parser.add_argument('--spine-files', type=int, default=20,
+                        help="HTML files in the spine [default: %(default)s]")
+    parser.add_argument('--navpoints-per-file', type=int, default=4,
+                        help="Chapters in each HTML file [default: %(default)s]")
+    parser.add_argument('--anchor-density', type=float, default=0.2,
+                        help="Share of paragraphs which are link targets and links [default: %(default)s]")
+    parser.add_argument('--chapter-paragraphs', type=int, default=40,
+                        help="Paragraphs in each chapter [default: %(default)s]")
+    parser.add_argument('--paragraph-words', type=int, default=80,
+                        help="Words in each paragraph [default: %(default)s]")
+    parser.add_argument('--images', type=int, default=10,
+                        help="Images in the book [default: %(default)s]")
+    parser.add_argument('--image-kb', type=int, default=50,
+                        help="Size of each image in KB [default: %(default)s]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the book generator [default: %(default)s]")
+    parser.add_argument('--prepare-text', action='store_true',
+                        help="Also compute the text of the chapters, like process.py --precompute-text")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Measured runs of each backend, after one warm-up run [default: %(default)s]")
+    parser.add_argument('--results', default="benchmark-results.jsonl",
+                        help="JSON lines file the results are appended to [default: %(default)s]")
+    parser.add_argument('--no-record', action='store_true',
+                        help="Don't append the results to --results")
+    parser.add_argument('--history', action='store_true',
+                        help="Also print the results recorded at other commits for the same book")
+
+    args = parser.parse_args()
+
+    if args.spine_files < 1 or args.navpoints_per_file < 1 or args.chapter_paragraphs < 1:
+        parser.error("--spine-files, --navpoints-per-file and --chapter-paragraphs must be at least 1")
+
+    if not 0 <= args.anchor_density <= 1:
+        parser.error("--anchor-density must be between 0 and 1")
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    return args
+
+
+def main():
+    args = prepare_args()
+
+    knobs = {
+        "spine_files": args.spine_files,
+        "navpoints_per_file": args.navpoints_per_file,
+        "anchor_density": args.anchor_density,
+        "chapter_paragraphs": args.chapter_paragraphs,
+        "paragraph_words": args.paragraph_words,
+        "images": args.images,
+        "image_bytes": args.image_kb * 1024,
+        "seed": args.seed,
+        "prepare_text": args.prepare_text,
+    }
+    book_knobs = {key: value for key, value in knobs.items() if key != "prepare_text"}
+    book = synthetic_epub(**book_knobs)
+    commit, dirty = git_revision()
+
+    print(f"Book: {len(book) / (1024 * 1024):.1f} MB, commit {commit}{' (dirty)' if dirty else ''}")
+    print(f"{'median ms':<24}" + "".join(f"{phase:>11}" for phase in PHASES + ["total"]))
+
+    for backend in args.backend:
+        # The print of each parsed book would end up inside the table
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run_benchmark(book, backend, args.repeat, args.prepare_text)
+
+        if args.history:
+            for previous in load_history(args.results, backend, knobs):
+                label = f"{backend} {(previous['commit'] or 'unknown')[:8]}{'+' if previous['dirty'] else ''}"
+                print(format_row(label, previous["median"]))
+        print(format_row(f"{backend} {(commit or 'unknown')[:8]}{'+' if dirty else ''} (now)", result["median"]))
+
+        if not args.no_record:
+            record_result(args.results, {
+                "commit": commit,
+                "dirty": dirty,
+                "recorded": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "backend": backend,
+                "knobs": knobs,
+                "repeat": args.repeat,
+                "book_bytes": len(book),
+                "chapters": result["chapters"],
+                "median": result["median"],
+                "min": result["min"],
+            })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import csv
+import hashlib
+import json
+import os
+import random
+import sqlite3
+
+
+def read_csv(path):
+    """Reads the rows of pg_catalog.csv one at a time, without loading the file.
+
+    Arguments:
+        path {str} -- The path of the csv file.
+
+    Returns:
+        generator -- Each row as a dict, keyed by the columns of the csv (Text#, Type, Title, ...)"""
+    with open(path, newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f, delimiter=',', quotechar='"')
+
+
+def checksum(row):
+    return int.from_bytes(hashlib.blake2b(row.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+class CatalogIndex(object):
+    """The Gutenberg catalog in a local SQLite file, keyed by `Text#`, so the id ranges, types and random samples of
+    books are indexed lookups instead of a scan of the whole csv.
+
+    Each row of the csv is kept as a JSON list of its values, and the columns once, so the rows come back exactly as
+    csv.DictReader would read them. Refreshing the index from a new csv only writes the rows which changed, and does
+    nothing at all if the csv file is the one it was last refreshed from.
+
+    Usage:
+        with CatalogIndex("cache/pg_catalog.sqlite") as catalog:
+            catalog.refresh("cache/pg_catalog.csv")
+            catalog.range(100, 200)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            row TEXT NOT NULL,
+            checksum INTEGER NOT NULL
+        )''')
+        self.con.execute('''CREATE INDEX IF NOT EXISTS books_type_id ON books (type, id);''')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS source (key TEXT PRIMARY KEY, value TEXT)''')
+        self.con.commit()
+        self.columns = json.loads(self._source('columns') or '[]')
+
+    def _source(self, key):
+        row = self.con.execute('''SELECT value FROM source WHERE key = ?;''', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_source(self, key, value):
+        self.con.execute('''INSERT OR REPLACE INTO source (key, value) VALUES (?, ?);''', (key, value))
+
+    @staticmethod
+    def _version(csv_path):
+        stat = os.stat(csv_path)
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def refresh(self, csv_path):
+        """Applies the rows of the csv which were added, changed or removed since the last refresh.
+
+        Arguments:
+            csv_path {str} -- The path of pg_catalog.csv.
+
+        Returns:
+            dict -- The number of rows which were written and deleted, or None if the csv hasn't changed."""
+        version = self._version(csv_path)
+        if self._source('version') == version:
+            return None
+
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            columns = next(csv.reader(f), [])
+        if columns != self.columns:
+            # The stored rows are lists of values, which can't be read with different columns
+            with self.con:
+                self.con.execute('''DELETE FROM books;''')
+                self._set_source('columns', json.dumps(columns))
+            self.columns = columns
+
+        # Only the checksums of the rows are held in memory, not the rows
+        existing = dict(self.con.execute('''SELECT id, checksum FROM books;'''))
+        changed = []
+        written = 0
+        with self.con:
+            for book in read_csv(csv_path):
+                try:
+                    id = int(book['Text#'])
+                except (KeyError, ValueError):
+                    continue
+                row = json.dumps([book.get(column) for column in columns], ensure_ascii=False)
+                row_checksum = checksum(row)
+                if existing.pop(id, None) == row_checksum:
+                    continue
+                changed.append((id, book.get('Type', ''), row, row_checksum))
+                if len(changed) >= 1000:
+                    written += self._write(changed)
+            written += self._write(changed)
+            # What is left wasn't in the csv anymore
+            self.con.executemany('''DELETE FROM books WHERE id = ?;''', ((id,) for id in existing))
+            self._set_source('version', version)
+        return {"written": written, "deleted": len(existing)}
+
+    def _write(self, rows):
+        self.con.executemany('''INSERT OR REPLACE INTO books (id, type, row, checksum) VALUES (?, ?, ?, ?);''', rows)
+        count = len(rows)
+        del rows[:]
+        return count
+
+    def _book(self, row):
+        return dict(zip(self.columns, json.loads(row)))
+
+    def _rows(self, cur):
+        return [self._book(row) for row, in cur]
+
+    def count(self, type='Text'):
+        return self.con.execute('''SELECT count(*) FROM books WHERE type = ?;''', (type,)).fetchone()[0]
+
+    def books(self, type='Text'):
+        """Returns:
+            generator -- The rows of the books of `type`, by id."""
+        cur = self.con.execute('''SELECT row FROM books WHERE type = ? ORDER BY id;''', (type,))
+        return (self._book(row) for row, in cur)
+
+    def range(self, start, end, type='Text'):
+        """Returns:
+            list -- The rows of the books of `type` with an id from `start` to `end`, inclusive, by id."""
+        cur = self.con.execute('''SELECT row FROM books WHERE type = ? AND id BETWEEN ? AND ? ORDER BY id;''',
+                               (type, start, end))
+        return self._rows(cur)
+
+    def sample(self, k, type='Text'):
+        """Returns:
+            list -- The rows of `k` different books of `type` picked at random, or all of them if there are fewer."""
+        ids = [id for id, in self.con.execute('''SELECT id FROM books WHERE type = ?;''', (type,))]
+        ids = random.sample(ids, min(k, len(ids)))
+        return [book for id in ids for book in
+                self._rows(self.con.execute('''SELECT row FROM books WHERE id = ?;''', (id,)))]
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
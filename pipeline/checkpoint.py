@@ -0,0 +1,156 @@
+import json
+import sqlite3
+import threading
+import time
+
+# A file which was being processed when this many runs stopped is marked as failed instead of being retried again,
+# so a book which crashes the process can't stop every resumed run as well.
+MAX_ATTEMPTS = 2
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+# Over the memory budget, see process.py --memory-budget-mb. Not retried by --resume either.
+QUARANTINED = "quarantined"
+
+
+class UnfinishedRunError(Exception):
+    """Raised by CheckpointJournal.start when the previous run still has files to process."""
+
+
+class CheckpointJournal(object):
+    """Records the progress of an ingest run in a local SQLite file, so a run which stops half way can be resumed
+    without walking the input directory, hashing the files or asking the database what was already stored.
+
+    Each file of the run is a row which goes from pending to in_flight while it is parsed and stored, and then to
+    done, failed or quarantined. Every change is committed straight away. The journal can be used from several
+    threads.
+
+    Usage:
+        with CheckpointJournal("ingest-journal.sqlite") as journal:
+            journal.start(files)  # or journal.remaining() to resume
+            journal.begin(file)
+            journal.finish(file)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        # Commits survive the process being killed, only a crash of the machine can lose the last few
+        self.con.execute('''PRAGMA journal_mode=WAL;''')
+        self.con.execute('''PRAGMA synchronous=NORMAL;''')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS files (
+            position INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated REAL,
+            memory TEXT
+        )''')
+        # Journals written before the memory of each book was recorded
+        if "memory" not in [row[1] for row in self.con.execute('''PRAGMA table_info(files);''')]:
+            self.con.execute('''ALTER TABLE files ADD COLUMN memory TEXT;''')
+        self.con.commit()
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            cur = self.con.execute(sql, parameters)
+            self.con.commit()
+            return cur
+
+    def start(self, files, restart=False):
+        """Begins a new run, forgetting the previous one.
+
+        Arguments:
+            files {iterable} -- The files of the run, in the order they will be processed.
+
+        Keyword Arguments:
+            restart {bool} -- Forget the previous run even though it didn't finish [default: {False}]
+
+        Raises:
+            UnfinishedRunError: The previous run still has files to process, and `restart` is False.
+
+        Returns:
+            list -- The files."""
+        files = list(files)
+        with self.lock:
+            unfinished = self._unfinished()
+            if unfinished and not restart:
+                raise UnfinishedRunError(f"the previous run has {unfinished} unfinished files")
+            self.con.execute('''DELETE FROM files;''')
+            self.con.executemany('''INSERT INTO files (path, status) VALUES (?, ?);''',
+                                 ((file, PENDING) for file in files))
+            self.con.commit()
+        return files
+
+    def _unfinished(self):
+        cur = self.con.execute('''SELECT count(*) FROM files WHERE status IN (?, ?);''', (PENDING, IN_FLIGHT))
+        return cur.fetchone()[0]
+
+    def unfinished(self):
+        """Returns:
+            int -- The number of files the previous run didn't get to, or was in the middle of."""
+        with self.lock:
+            return self._unfinished()
+
+    def remaining(self):
+        """The files the previous run didn't get to, or was in the middle of, in their original order. Files which
+        were in flight during MAX_ATTEMPTS runs are marked as failed instead.
+
+        Returns:
+            list -- The files to process."""
+        self._execute('''UPDATE files SET status = ?, error = ?, updated = ? WHERE status = ? AND attempts >= ?;''',
+                      (FAILED, f"stopped {MAX_ATTEMPTS} runs while it was being processed", time.time(), IN_FLIGHT,
+                       MAX_ATTEMPTS))
+        cur = self._execute('''SELECT path FROM files WHERE status IN (?, ?) ORDER BY position;''',
+                            (PENDING, IN_FLIGHT))
+        return [row[0] for row in cur.fetchall()]
+
+    def begin(self, file):
+        self._execute('''UPDATE files SET status = ?, attempts = attempts + 1, updated = ? WHERE path = ?;''',
+                      (IN_FLIGHT, time.time(), file))
+
+    def _end(self, file, status, error, memory):
+        self._execute('''UPDATE files SET status = ?, error = ?, updated = ?, memory = ? WHERE path = ?;''',
+                      (status, error, time.time(), json.dumps(memory) if memory else None, file))
+
+    def finish(self, file, memory=None):
+        """Marks a file as done, with its memory record, see process.ParsedBook.memory."""
+        self._end(file, DONE, None, memory)
+
+    def fail(self, file, error, memory=None):
+        self._end(file, FAILED, str(error), memory)
+
+    def quarantine(self, file, reason, memory=None):
+        self._end(file, QUARANTINED, str(reason), memory)
+
+    def memory(self, file):
+        """Returns:
+            dict -- The memory record of a file, or None if it wasn't recorded."""
+        cur = self._execute('''SELECT memory FROM files WHERE path = ?;''', (file,))
+        row = cur.fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def quarantined(self):
+        """Returns:
+            list -- The path of each quarantined file and the reason, in their original order."""
+        cur = self._execute('''SELECT path, error FROM files WHERE status = ? ORDER BY position;''', (QUARANTINED,))
+        return cur.fetchall()
+
+    def counts(self):
+        """Returns:
+            dict -- The number of files with each status."""
+        cur = self._execute('''SELECT status, count(*) FROM files GROUP BY status;''')
+        return dict(cur.fetchall())
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
@@ -1,5 +1,5 @@
 import typing
-import uuid
+import hashlib
 import re
 from bs4 import BeautifulSoup
 from slugify import slugify
@@ -9,6 +9,12 @@ from dataclasses import dataclass
 
 from titlecase import titlecase
 import bs4
+from lxml import etree
+
+from profiling import span
+
+# The number of hex digits of the SHA-256 of an image which name it, see ContentParser.allocate_locations
+IMAGE_NAME_HASH_LENGTH = 16
 
 
 @dataclass
@@ -17,12 +23,20 @@ class Navpoint:
     selector: str
 
 
+@dataclass
+class ChapterText:
+    stripped: str
+    searchable: str
+    paragraphs: List[str]
+
+
 @dataclass
 class Chapter:
     title: str
     slug: str
     content: str
     order: int
+    text: ChapterText = None
 
 
 @dataclass
@@ -35,8 +49,29 @@ class RawChapter:
 @dataclass
 class Image:
     location: str
-    content: ByteString
+    content: typing.Union[ByteString, typing.Callable[[], ByteString]]
     format: str
+    hash_sha256: str = None
+
+    def read(self):
+        """Returns the bytes of the image. `content` is either the bytes themselves or a callable which lazily reads
+        them from the EPUB file.
+
+        Returns:
+            bytes -- The content of the image."""
+        if callable(self.content):
+            return self.content()
+        return self.content
+
+    def sha256(self):
+        """Returns the SHA-256 of the image, which its content is stored under, see db.add_images. It is computed
+        on the first call only, without keeping the content.
+
+        Returns:
+            str -- The hex digest."""
+        if self.hash_sha256 is None:
+            self.hash_sha256 = hashlib.sha256(self.read()).hexdigest()
+        return self.hash_sha256
 
 
 def title_to_slug(title):
@@ -59,8 +94,364 @@ def content_into_stripped_text(content):
     return rex.sub(' ', text)
 
 
+WHITESPACE = re.compile(r'\s+')
+
+
+# The SQL functions parse the stored chapter with `xmlparse(document ...)`, which is libxml2 with these options. The
+# default STRIP WHITESPACE is XML_PARSE_NOBLANKS, which drops most of the whitespace prettify adds between tags.
+# Postgres ignores namespace errors such as an undeclared `epub:` prefix, which lxml only does when recovering. Markup
+# Postgres would reject outright, like a `<` left in a script, is recovered as well rather than losing the book.
+SQL_XML_PARSER = etree.XMLParser(resolve_entities=True, attribute_defaults=True, remove_blank_text=True,
+                                 strip_cdata=False, recover=True)
+
+
+def sql_document(markup):
+    """Parses the markup of a chapter the way the SQL functions do.
+
+    Args:
+        markup (str): The prettified chapter, as it is stored in `chapters.content`.
+
+    Returns:
+        lxml.etree._Element: The root of the document."""
+    document = etree.fromstring(markup, SQL_XML_PARSER)
+    if document is None:
+        raise ValueError("the chapter isn't XML")
+    return document
+
+
+def html_strip(document):
+    """Python version of the `html_strip` SQL function: every text node joined by a space, with runs of whitespace
+    collapsed into one.
+
+    Args:
+        document (lxml.etree._Element): The chapter, see sql_document.
+
+    Returns:
+        str: The text of the chapter."""
+    return WHITESPACE.sub(' ', ' '.join(document.xpath('//text()')))
+
+
+def html_to_paragraphs(document):
+    """Python version of the `html_to_paragraph` SQL function: the markup of every <p> which has a text node of its
+    own and some text, with runs of whitespace collapsed into one.
+
+    Args:
+        document (lxml.etree._Element): The chapter, see sql_document.
+
+    Returns:
+        list: The paragraphs of the chapter, in order."""
+    return [WHITESPACE.sub(' ', etree.tostring(paragraph, encoding=str, with_tail=False))
+            for paragraph in document.xpath('//p[text()][normalize-space()]')]
+
+
+def searchable_text(stripped):
+    """The text which `prepare_chapter_search` feeds into `to_tsvector`, which leaves out words of 20 characters or
+    more.
+
+    Args:
+        stripped (str): The stripped text of the chapter.
+
+    Returns:
+        str: The text to index."""
+    return ' '.join(word for word in stripped.split(' ') if len(word) < 20)
+
+
+def chapter_text(markup):
+    """Computes everything the chapter triggers would otherwise compute inside the database, from the markup they
+    would see.
+
+    Args:
+        markup (str): The prettified chapter.
+
+    Returns:
+        ChapterText: The stripped text, the text to index and the paragraphs of the chapter."""
+    document = sql_document(markup)
+    stripped = html_strip(document)
+    return ChapterText(stripped=stripped, searchable=searchable_text(stripped),
+                       paragraphs=html_to_paragraphs(document))
+
+
+def prettify(content: bs4.Tag, visit=None, release=False):
+    """Produces exactly what `content.prettify()` produces, in a single traversal which can also rewrite the tags
+    and free the tree as it goes.
+
+    Args:
+        content (bs4.Tag): The tag to serialize.
+        visit (callable): Called with every tag, including `content`, right before it is serialized.
+        release (bool): Break up the tree while serializing it, so its memory is freed straight away instead of
+            waiting for the garbage collector. `content` can't be used afterwards.
+
+    Returns:
+        str: The prettified markup."""
+    formatter = content.formatter_for_name("minimal")
+    output = []
+    _prettify_tag(content, True, bool(content.next_sibling),
+                  formatter, visit, release, output)
+    return ''.join(output)
+
+
+def _prettify_tag(tag: bs4.Tag, indent_level, has_next_sibling, formatter, visit, release, output):
+    # Mirrors `Tag.decode` and `Tag.decode_contents`, appending to `output` instead of building strings per tag
+    if visit is not None:
+        visit(tag)
+
+    attrs = []
+    for key, val in formatter.attributes(tag):
+        if val is None:
+            attrs.append(key)
+            continue
+        if isinstance(val, (list, tuple)):
+            val = ' '.join(val)
+        elif not isinstance(val, str):
+            val = str(val)
+        elif isinstance(val, bs4.element.AttributeValueWithCharsetSubstitution):
+            val = val.encode(bs4.element.DEFAULT_OUTPUT_ENCODING)
+        attrs.append(str(key) + '=' + formatter.quoted_attribute_value(formatter.attribute_value(val)))
+
+    prefix = tag.prefix + ":" if tag.prefix else ''
+    children = tag.contents
+    close = ''
+    close_tag = ''
+    if not children and tag.can_be_empty_element:
+        close = formatter.void_element_close_prefix or ''
+    else:
+        close_tag = f'</{prefix}{tag.name}>'
+
+    preserve_whitespace = bool(tag.preserve_whitespace_tags) and tag.name in tag.preserve_whitespace_tags
+    pretty_print = indent_level is not None and not preserve_whitespace
+    indent_space = ' ' * (indent_level - 1) if indent_level is not None else ''
+    indent_contents = indent_level + 1 if pretty_print else None
+
+    if not tag.hidden:
+        if indent_level is not None:
+            output.append(indent_space)
+        output.append(
+            f"<{prefix}{tag.name}{' ' + ' '.join(attrs) if attrs else ''}{close}>")
+        if pretty_print:
+            output.append("\n")
+    contents_start = len(output)
+
+    last = len(children) - 1
+    for index, child in enumerate(children):
+        if isinstance(child, bs4.NavigableString):
+            text = child.output_ready(formatter)
+            if text and indent_contents and not preserve_whitespace:
+                text = text.strip()
+            if text:
+                if indent_contents is not None and not preserve_whitespace:
+                    output.append(" " * (indent_contents - 1))
+                output.append(text)
+                if indent_contents is not None and not preserve_whitespace:
+                    output.append("\n")
+            if release:
+                child.__dict__.clear()
+        elif isinstance(child, bs4.Tag):
+            _prettify_tag(child, indent_contents, index < last and bool(children[index + 1]),
+                          formatter, visit, release, output)
+
+    if not tag.hidden:
+        if pretty_print:
+            for index in range(len(output) - 1, contents_start - 1, -1):
+                if output[index]:
+                    if output[index][-1] != "\n":
+                        output.append("\n")
+                    break
+        if pretty_print and close_tag:
+            output.append(indent_space)
+        output.append(close_tag)
+        if indent_level is not None and close_tag and has_next_sibling:
+            output.append("\n")
+
+    if release:
+        tag.__dict__.clear()
+        tag.contents = []
+
+
+def shallow_copy(tag: bs4.Tag):
+    """Copies a tag the same way `copy.copy` does, but leaves out its children.
+
+    Args:
+        tag (bs4.Tag): The tag to copy.
+
+    Returns:
+        bs4.Tag: An empty tag with the same name and attributes, unconnected to the parse tree."""
+    # Parsed tags don't keep their builder, so `copy.copy` ends up passing None as well. Looking up `tag.builder`
+    # would search the whole subtree for a <builder> tag first.
+    clone = type(tag)(
+        None, None, tag.name, tag.namespace,
+        tag.prefix, tag.attrs, is_xml=tag._is_xml,
+        sourceline=tag.sourceline, sourcepos=tag.sourcepos,
+        can_be_empty_element=tag.can_be_empty_element,
+        cdata_list_attributes=tag.cdata_list_attributes,
+        preserve_whitespace_tags=tag.preserve_whitespace_tags
+    )
+    clone.can_be_empty_element = tag.can_be_empty_element
+    clone.hidden = tag.hidden
+    return clone
+
+
+class BodySplitter(object):
+    """Cuts chapters out of the body of a file without modifying it.
+
+    Splitting used to copy the whole body for every navpoint and then delete everything around the chapter, which is
+    quadratic in the size of files with many navpoints. The body is now indexed once, and each chapter only copies
+    the tags it keeps, plus empty copies of the ancestors of its boundaries.
+
+    The result is the same as the old copy-and-delete approach: tags before the header and after the next header are
+    dropped, but text directly inside an ancestor of either header is kept. Whitespace-only text outside of the chapter
+    is thinned out, keeping enough of it that neither the prettified markup nor the collapsed text changes."""
+
+    def __init__(self, body: bs4.Tag):
+        self.body = body
+        # id(tag): [preorder position, position after its last descendant]
+        self.positions = {id(body): [0, None]}
+        # id(tag): index of the tag in the contents of its parent
+        self.indexes = {}
+        # element id: first tag with that id, like `body.select_one(f"#{id}")`
+        self.ids = {}
+        # id(tag): indexes of the text children which are kept even when they are outside of the chapter
+        self.kept_strings = {}
+
+        position = 0
+        stack = [(body, enumerate(body.contents))]
+        while stack:
+            tag, children = stack[-1]
+            for index, child in children:
+                if isinstance(child, bs4.Tag):
+                    position += 1
+                    self.positions[id(child)] = [position, None]
+                    self.indexes[id(child)] = index
+                    element_id = child.attrs.get("id")
+                    if element_id is not None and element_id not in self.ids:
+                        self.ids[element_id] = child
+                    stack.append((child, enumerate(child.contents)))
+                    break
+            else:
+                self.positions[id(tag)][1] = position + 1
+                stack.pop()
+
+    def find(self, selector):
+        """Finds the tag a navpoint points to.
+
+        Args:
+            selector (str): The id of the tag, or None.
+
+        Returns:
+            bs4.Tag: The first tag with that id, or None."""
+        if not selector:
+            return None
+        return self.ids.get(selector)
+
+    def contains(self, ancestor: bs4.Tag, tag: bs4.Tag):
+        start, end = self.positions[id(ancestor)]
+        return start <= self.positions[id(tag)][0] < end
+
+    def path(self, tag: bs4.Tag):
+        """Maps each ancestor of a tag to the index of the child which leads to the tag."""
+        path = {}
+        while tag is not None and tag is not self.body:
+            path[id(tag.parent)] = self.indexes[id(tag)]
+            tag = tag.parent
+        return path
+
+    def extract(self, start: bs4.Tag = None, end: bs4.Tag = None):
+        """Copies the part of the body from `start` up to, but excluding, `end`. If `start` is too simple to be the
+        page we are trying to display (it contains at most one tag), it is left out as well.
+
+        Args:
+            start (bs4.Tag): The header the part begins with, or None to begin at the top of the body.
+            end (bs4.Tag): The header the part ends before, or None to end at the bottom of the body.
+
+        Returns:
+            bs4.Tag: A copy of the body with only that part in it."""
+        dropped = None
+        if start is not None:
+            start_position, start_end = self.positions[id(start)]
+            if start_end - start_position - 1 <= 1:
+                dropped = start
+
+        if start is not None and end is not None:
+            if dropped is not None and self.contains(start, end):
+                # The end was removed together with the start
+                end = None
+            elif self.positions[id(end)][0] < self.positions[id(start)][0] and not self.contains(end, start):
+                # The end was removed together with everything before the start
+                end = None
+
+        return self.copy_between(self.body, self.path(start), self.path(end), dropped, end)
+
+    def copy_between(self, tag: bs4.Tag, starts, ends, dropped, end):
+        clone = shallow_copy(tag)
+        contents = tag.contents
+        first = starts.get(id(tag), 0)
+        last = ends.get(id(tag), len(contents) - 1)
+        kept_strings = self.strings_to_keep(tag)
+
+        for index in kept_strings:
+            if index >= first:
+                break
+            clone.append(copy.copy(contents[index]))
+
+        for index in range(first, last + 1):
+            child = contents[index]
+            if not isinstance(child, bs4.Tag):
+                clone.append(copy.copy(child))
+            elif child is end or child is dropped:
+                continue
+            elif id(child) in starts or id(child) in ends:
+                clone.append(self.copy_between(
+                    child, starts, ends, dropped, end))
+            else:
+                clone.append(copy.copy(child))
+
+        for index in kept_strings:
+            if index > last:
+                clone.append(copy.copy(contents[index]))
+
+        return clone
+
+    def strings_to_keep(self, tag: bs4.Tag):
+        """The text children of a tag which survive outside of the chapter: all text which isn't whitespace, and the
+        first and last string of each run of whitespace. Everything in whitespace preserving tags is kept."""
+        if id(tag) in self.kept_strings:
+            return self.kept_strings[id(tag)]
+
+        preserve_whitespace = False
+        ancestor = tag
+        while ancestor is not None:
+            if ancestor.name in (tag.preserve_whitespace_tags or ()):
+                preserve_whitespace = True
+                break
+            if ancestor is self.body:
+                break
+            ancestor = ancestor.parent
+
+        kept = []
+        last_whitespace = None
+        for index, child in enumerate(tag.contents):
+            if isinstance(child, bs4.Tag):
+                continue
+            if preserve_whitespace or type(child) is not bs4.NavigableString or child.strip():
+                if last_whitespace is not None and last_whitespace != kept[-1]:
+                    kept.append(last_whitespace)
+                last_whitespace = None
+                kept.append(index)
+                continue
+            if last_whitespace is None:
+                kept.append(index)
+            last_whitespace = index
+        if last_whitespace is not None and last_whitespace != kept[-1]:
+            kept.append(last_whitespace)
+
+        self.kept_strings[id(tag)] = kept
+        return kept
+
+
 class ContentParser(object):
-    def __init__(self, file_order: List[str], html_files: Dict[str, typing.Any], image_files: Dict[str, typing.Any], navpoints: Dict[str, List[Navpoint]]):
+    # Cuts the chapters out of the body of each file, see BodySplitter
+    splitter_class = BodySplitter
+
+    def __init__(self, file_order: List[str], html_files: Dict[str, typing.Any], image_files: Dict[str, typing.Any], navpoints: Dict[str, List[Navpoint]], prepare_text=False, stream=False):
         # file_order: [file_id, ...]
         # File order is derived from the spine of container.xml
 
@@ -71,11 +462,19 @@ class ContentParser(object):
         # Navpoints are sorted into their files in this dictionary. Each navpoint is represented as a named tuple
         # navpoint.selector can be None to mean it begins at the top of the page
 
+        # prepare_text: also fill in Chapter.text, so the database doesn't have to parse the chapters again
+
+        # stream: instead of building every chapter up front, `chapters` is a generator which finishes each chapter
+        # as soon as its boundaries are known. Links can point forwards, so the files are split twice: the first
+        # pass only builds the location map and throws the chapters away, the second rewrites and emits them. Only
+        # the chapter being built and the location map are kept in memory.
+
         # Input
         self.file_order = file_order
         self.html_files = html_files
         self.image_files = image_files
         self.navpoints = navpoints
+        self.prepare_text = prepare_text
 
         # Output
         self.chapters = []
@@ -86,76 +485,102 @@ class ContentParser(object):
         self.current_order = 0
         self.location_mapping = {}
         self.raw_chapters = []
+        self.pending_chapters = []
+        self.record_locations = True
 
         self.allocate_locations()
+
+        if stream:
+            with span("split"):
+                for _ in self.iter_raw_chapters():
+                    pass
+            self.chapters = self.iter_chapters()
+            return
+
         self.parse_chapters()
-        self.swap_locations_in_parsed_chapters()
+        self.convert_raws_to_output()
+        self.release_inputs()
 
+    def release_inputs(self):
         self.chapter_carry_over = None
         self.location_mapping = None
         self.file_order = None
         self.html_files = None
         self.image_files = None
         self.navpoints = None
-        self.convert_raws_to_output()
+
+    def iter_chapters(self):
+        """Splits the files a second time, now with the complete location map, and yields each chapter in its final
+        form as soon as it is complete. Used in streaming mode.
+
+        Yields:
+            Chapter: The next chapter of the book."""
+        self.chapter_carry_over = None
+        self.current_order = 0
+        # The map is already complete, registering the ids again would only overwrite it with partial values.
+        self.record_locations = False
+
+        for chapter in self.iter_raw_chapters():
+            yield self.convert_raw_to_output(chapter)
+
+        self.release_inputs()
 
     def allocate_locations(self):
         # for index, html_file in enumerate(self.file_order):
         #     self.location_mapping[html_file] = f"part-{index}.html"
 
+        # Images are named after their content, so parsing a book again gives the same locations and the same
+        # chapter markup, and an image the book contains twice is stored once
+        allocated = set()
         for index, image_file in enumerate(self.image_files.keys()):
             directoryless_image_file = image_file.split("/")[-1]
             image_format = directoryless_image_file.split(".")[-1]
 
-            new_image_name = f"image-{str(uuid.uuid4())}"
-            new_image_location = f"{new_image_name}.{image_format}"
+            image = Image(location=None, content=self.image_files[image_file], format=image_format)
+            new_image_location = f"image-{image.sha256()[:IMAGE_NAME_HASH_LENGTH]}.{image_format}"
             self.location_mapping[directoryless_image_file] = new_image_location
-            image_content = self.image_files[image_file]
-            self.images.append(
-                Image(location=new_image_location, content=image_content, format=image_format))
+            if new_image_location in allocated:
+                continue
+            allocated.add(new_image_location)
+            image.location = new_image_location
+            self.images.append(image)
 
-    def swap_locations_in_parsed_chapters(self):
-        self.swap_images_in_parsed_chapters()
-        self.swap_links_in_parsed_chapters()
+    def swap_locations_in_tag(self, tag: bs4.Tag):
+        """Update <img> and <a> tags to point to the new location of their src or href when they are parsed from the epub file into our own format.
 
-    def swap_links_in_parsed_chapters(self):
-        """Update all <a> tags in the book to point to the new location of their href when they are parsed from the epub file into our own format.
+        Args:
+            tag (bs4.element.Tag): The tag to update.
 
         Returns:
             None"""
-        for chapter in self.raw_chapters:
-            chapter: RawChapter
-            items = chapter.content.find_all("a")
-            for item in items:
-                if "href" not in item.attrs:
-                    item.attrs["href"] = "#"
-                    continue
+        names = (tag.name, f"{tag.prefix}:{tag.name}") if tag.prefix else (tag.name,)
+        self.swap_locations(names, tag.attrs)
 
-                src = item.attrs["href"].split("/")[-1]
-
-                if src not in self.location_mapping:
-                    item.attrs["href"] = "#"
-                    continue
+    def swap_locations(self, names, attrs):
+        """Points the src of an image or the href of a link to its new location.
 
-                new_src = self.location_mapping[src]
-                item.attrs["href"] = new_src
-
-    def swap_images_in_parsed_chapters(self):
-        """Update all <img> tags in the book to point to the new location of their src when they are parsed from the epub file into our own format.
+        Args:
+            names (tuple): The names the tag matches, with and without its namespace prefix.
+            attrs (dict): The attributes of the tag, which are updated in place.
 
         Returns:
             None"""
-        for chapter in self.raw_chapters:
-            chapter: RawChapter
-            items = chapter.content.find_all(["img", "image"])
-            for item in items:
+        if "img" in names or "image" in names:
+            src = attrs["src"].split("/")[-1]
+            if src in self.location_mapping:
+                attrs["src"] = f"/api/books/image/{self.location_mapping[src]}"
+        elif "a" in names:
+            if "href" not in attrs:
+                attrs["href"] = "#"
+                return
 
-                src = item.attrs["src"].split("/")[-1]
-                if src not in self.location_mapping:
-                    continue
+            src = attrs["href"].split("/")[-1]
 
-                new_src = self.location_mapping[src]
-                item.attrs["src"] = f"/api/books/image/{new_src}"
+            if src not in self.location_mapping:
+                attrs["href"] = "#"
+                return
+
+            attrs["href"] = self.location_mapping[src]
 
     def convert_raws_to_output(self):
         """Convert the raw chapters into the chapters we want to output. The raw chapters are temporary and will be discarded.
@@ -163,67 +588,113 @@ class ContentParser(object):
 
         Returns:
             None"""
-        for chapter in self.raw_chapters:
-            chapter: RawChapter
-            title = titlecase_chapter(chapter.title)
-            new_chapter = Chapter(
-                title=title,
-                slug=title_to_slug(title),
-                content=str(chapter.content.prettify()),
-                order=chapter.order
-            )
-            self.chapters.append(new_chapter)
+        raw_chapters, self.raw_chapters = self.raw_chapters, []
+        for index, chapter in enumerate(raw_chapters):
+            raw_chapters[index] = None
+            self.chapters.append(self.convert_raw_to_output(chapter))
+
+    def convert_raw_to_output(self, chapter: RawChapter):
+        """Rewrites the images and links of a raw chapter and serializes it, in a single pass over its tree. The
+        tree is released straight afterwards.
+
+        Args:
+            chapter (RawChapter): The chapter to convert.
+
+        Returns:
+            Chapter: The chapter in its final form."""
+        title = titlecase_chapter(chapter.title)
+        with span("render"):
+            content, text = self.render(chapter.content)
+        chapter.content = None
+
+        return Chapter(
+            title=title,
+            slug=title_to_slug(title),
+            content=content,
+            order=chapter.order,
+            text=text
+        )
+
+    def render(self, content: bs4.Tag):
+        """Serializes the content of a chapter, and computes its text when `prepare_text` is set.
+
+        Args:
+            content (bs4.element.Tag): The content of the chapter, which can't be used afterwards.
+
+        Returns:
+            tuple: The prettified markup and the ChapterText, or None."""
+        markup = prettify(content, self.swap_locations_in_tag, release=True)
+        if not self.prepare_text:
+            return markup, None
+        return markup, chapter_text(markup)
 
     def parse_chapters(self):
         """Parses through each file, and each navpoint in each file, to seperate them out into their own chapters. A chapter is defined as the content in between two navpoints, including the first navpoint.
 
         Returns:
             None"""
+        with span("split"):
+            self.raw_chapters = list(self.iter_raw_chapters())
+
+    def iter_raw_chapters(self):
+        """Generator version of parse_chapters, which yields each raw chapter as soon as it is complete.
+
+        Yields:
+            RawChapter: The next raw chapter of the book."""
         for file_id in self.file_order:
             file = self.html_files[file_id]()
 
             if file_id in self.navpoints:
                 navpoints = self.navpoints[file_id]
             else:
-                self.carry_over("Other Content", copy.copy(
-                    file.find("body")), file_id)
+                self.carry_over("Other Content",
+                                self.copy_body(self.find_body(file)), file_id)
                 continue
 
+            splitter = self.splitter_class(self.find_body(file))
+            headers = [splitter.find(navpoint.selector)
+                       for navpoint in navpoints]
+
             for navpoint_id, navpoint in enumerate(navpoints):
 
-                body, header, next_header = self.find_headers(
-                    file, navpoint_id, navpoints)
+                header = headers[navpoint_id]
+                next_header = None
+                if navpoint_id + 1 < len(navpoints):
+                    next_header = headers[navpoint_id + 1]
 
                 navpoint_references_entire_page = navpoint.selector == None
 
-                if header:
-                    if self.chapter_carry_over:
-                        remainder_of_body = copy.copy(body)
-                        # `header` references the header in `body`, `header_in_remainder` references the same header but in the `remainder_of_body` object instead
-                        header_in_remainder = remainder_of_body.select_one(
-                            f"#{header.attrs['id']}")
-                        ContentParser.force_remove_including_after(
-                            header_in_remainder)
-                        self.carry_over(
-                            navpoint.title, remainder_of_body, file_id)
-                        self.push_carry_over()
-
-                    ContentParser.remove_including_before(header)
-
-                if next_header:
-                    ContentParser.force_remove_including_after(next_header)
-                else:
-                    if not navpoint_references_entire_page:
-                        # No next_header in this page. Merge into the carry over and look at the next page
-                        self.carry_over(
-                            navpoint.title, body, file_id)
-                        continue
+                if header is not None and self.chapter_carry_over:
+                    remainder_of_body = splitter.extract(end=header)
+                    self.carry_over(
+                        navpoint.title, remainder_of_body, file_id)
+                    self.push_carry_over()
+                    yield from self.pop_finished_chapters()
+
+                body = splitter.extract(start=header, end=next_header)
+
+                if next_header is None and not navpoint_references_entire_page:
+                    # No next_header in this page. Merge into the carry over and look at the next page
+                    self.carry_over(
+                        navpoint.title, body, file_id)
+                    continue
 
                 self.carry_over(navpoint.title, body, file_id)
                 self.push_carry_over()
+                yield from self.pop_finished_chapters()
 
         if self.chapter_carry_over:
             self.push_carry_over()
+            yield from self.pop_finished_chapters()
+
+    def pop_finished_chapters(self):
+        """Hands over the chapters finished since the last call.
+
+        Returns:
+            list: The finished raw chapters."""
+        finished = self.pending_chapters
+        self.pending_chapters = []
+        return finished
 
     def title_to_slug(self, title):
         """Converts a title to a slug. This is used to create a url for the chapter.
@@ -235,24 +706,28 @@ class ContentParser(object):
                 str: The slug of the chapter."""
         return slugify(title)
 
-    def add_ids_to_location_map(self, chapter: RawChapter, filename):
-        """For each element in a chapter which has an id, add it to the location map. This is to preserve any links that link to that id.
+    def add_ids_to_location_map(self, chapter: RawChapter, fragment: bs4.Tag, filename):
+        """For each element in a fragment of a chapter which has an id, add it to the location map. This is to preserve any links that link to that id.
+
+        Only the fragment which is being merged into the chapter is scanned, so building a chapter out of many pages
+        or navpoints doesn't rescan what was merged before.
 
         Args:
-            chapter (RawChapter): The chapter to add the ids from.
+            chapter (RawChapter): The chapter the fragment belongs to.
+            fragment (bs4.element.Tag): The content which was added to the chapter.
             filename (str): The original filename of the page to map from.
 
         Returns:
             None"""
-        content = chapter.content
-        tags_with_an_id = content.find_all(id=True)
+        if not self.record_locations:
+            return
         filename = filename.split("/")[-1]
-        for tag in tags_with_an_id:
-            tag_id = tag.attrs["id"]
+        slug = title_to_slug(chapter.title)
+        for tag_id in self.find_ids(fragment):
             ref = f"{filename}#{tag_id}"
-            new_ref = f"{title_to_slug(chapter.title)}#{tag_id}"
+            new_ref = f"{slug}#{tag_id}"
             self.location_mapping[ref] = new_ref
-        self.location_mapping[filename] = title_to_slug(chapter.title)
+        self.location_mapping[filename] = slug
 
     def add_chapter(self, chapter: RawChapter):
         """Adds a raw chapter to the book.
@@ -267,9 +742,27 @@ class ContentParser(object):
             content=chapter.content,
             order=self.current_order
         )
-        self.raw_chapters.append(new_chapter)
+        self.pending_chapters.append(new_chapter)
         self.current_order += 1
 
+    @staticmethod
+    def find_body(file: BeautifulSoup):
+        return file.find("body")
+
+    @staticmethod
+    def copy_body(body: bs4.Tag):
+        return copy.copy(body)
+
+    @staticmethod
+    def find_ids(fragment: bs4.Tag):
+        return [tag.attrs["id"] for tag in fragment.find_all(id=True)]
+
+    @staticmethod
+    def merge(content: bs4.Tag, to_merge: bs4.Tag):
+        # Only the tags are moved over, text directly inside the body of `to_merge` is dropped
+        for child in to_merge.find_all(recursive=False):
+            content.append(child)
+
     def carry_over(self, title, to_merge, filename):
         """Merges the content of a chapter into the carry over.
 
@@ -283,12 +776,13 @@ class ContentParser(object):
         if self.chapter_carry_over is None:
             self.chapter_carry_over = RawChapter(
                 title=title, content=to_merge)
-            self.add_ids_to_location_map(self.chapter_carry_over, filename)
+            self.add_ids_to_location_map(
+                self.chapter_carry_over, to_merge, filename)
             return
 
-        for child in to_merge.find_all(recursive=False):
-            self.chapter_carry_over.content.append(child)
-        self.add_ids_to_location_map(self.chapter_carry_over, filename)
+        self.add_ids_to_location_map(
+            self.chapter_carry_over, to_merge, filename)
+        self.merge(self.chapter_carry_over.content, to_merge)
 
     def push_carry_over(self):
         """Pushes the carry over into the book as its own chapter.
@@ -300,61 +794,3 @@ class ContentParser(object):
 
         self.add_chapter(self.chapter_carry_over)
         self.chapter_carry_over = None
-
-    def find_headers(self, file: BeautifulSoup, navpoint_id, navpoints):
-        """Finds the header and next header of a file. In between the two headers, we have the content of the chapter.
-
-        Args:
-            file (bs4.element.Tag): The file to find the headers in.
-            navpoint_id (int): The id of the navpoint we are currently on.
-            navpoints (list): The list of navpoints in the file.
-
-        Returns:
-            tuple: A tuple containing the body, header, and next_header of the file."""
-        navpoint = navpoints[navpoint_id]
-
-        next_navpoint = None
-        if navpoint_id + 1 < len(navpoints):
-            next_navpoint = navpoints[navpoint_id+1]
-
-        body = copy.copy(file.find("body"))
-
-        if navpoint.selector:
-            header = body.select_one(f"#{navpoint.selector}")
-        else:
-            header = None
-
-        if next_navpoint and next_navpoint.selector:
-            next_header = body.select_one(f"#{next_navpoint.selector}")
-        else:
-            next_header = None
-
-        return (body, header, next_header)
-
-    @staticmethod
-    def remove_including_before(target):
-        # If the target is too complex (meaning it's likely to be the page we are trying to display), it won't be removed.
-        curr_target = target
-        while curr_target is not None:
-            curr_target: bs4.Tag
-            for prev_sibling in curr_target.find_previous_siblings():
-                prev_sibling.decompose()
-            curr_target = curr_target.parent
-        ContentParser.remove_if_not_complex(target)
-
-    @staticmethod
-    def force_remove_including_after(target):
-        # Will always remove the target.
-        curr_target = target
-        while curr_target is not None:
-            target: bs4.Tag
-            for prev_sibling in curr_target.find_next_siblings():
-                prev_sibling.decompose()
-            curr_target = curr_target.parent
-        target.decompose()
-
-    @staticmethod
-    def remove_if_not_complex(target: bs4.Tag):
-        children = target.find_all(recursive=True)
-        if len(children) <= 1:
-            target.decompose()
@@ -1,5 +1,287 @@
+import io
 import psycopg2
 
+from profiling import timed
+
+
+def _copy_value(value):
+    """Formats a single value for `COPY ... FROM STDIN` in PostgreSQL's text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea input in hex format (\x...); the backslash itself has to be escaped for COPY.
+        return '\\\\x' + bytes(value).hex()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _stamp_parser_version(cur, ebook_source_id, version):
+    """Marks a source as produced by `version` of the parser, and deletes the chapters, paragraphs and images which
+    older versions stored for its books. Run it in the transaction which stores the rows of `version`, so readers
+    see either the old rows or the new ones, never both."""
+    cur.execute(
+        '''DELETE FROM paragraphs USING chapters, books
+            WHERE paragraphs.chapters_id = chapters.id AND chapters.book_id = books.id
+            AND books.ebook_source_id = %s AND chapters.version < %s;''', (ebook_source_id, version))
+    cur.execute(
+        '''DELETE FROM chapters USING books
+            WHERE chapters.book_id = books.id AND books.ebook_source_id = %s AND chapters.version < %s;''',
+        (ebook_source_id, version))
+    # The image_blobs are kept, other books may use them
+    cur.execute(
+        '''DELETE FROM images USING books
+            WHERE images.book_id = books.id AND books.ebook_source_id = %s AND images.version < %s;''',
+        (ebook_source_id, version))
+    cur.execute(
+        '''UPDATE ebook_source SET parser_version = %s WHERE id = %s;''', (version, ebook_source_id))
+
+
+class BulkLoader(object):
+    """Loads whole books in as few round-trips as possible. Chapters and images are staged with `COPY` into
+    temporary tables and merged into the real tables with the same `ON CONFLICT ... DO NOTHING` semantics as
+    `db.add_chapters` and `db.add_images`. Nothing is committed until `commit()`, so a batch of books costs a
+    single transaction.
+
+    With `precomputed_text`, every chapter must carry a `ChapterText` (see `ContentParser(prepare_text=True)`). The
+    stripped text, search vector and paragraphs are then loaded as they are and the chapter triggers are skipped
+    for the transaction, so the database no longer parses the chapter HTML itself.
+
+    Usage:
+        with con.bulk_loader() as loader:
+            for book in books:
+                loader.add_full_book(...)
+    """
+
+    # Staged rows are sent to the server whenever this much COPY data has been buffered, which keeps memory
+    # bounded for very large books or batches.
+    flush_bytes = 8 * 1024 * 1024
+
+    def __init__(self, con, precomputed_text=False):
+        self.db = con
+        self.precomputed_text = precomputed_text
+        self.books = 0
+        self._chapters = io.StringIO()
+        self._paragraphs = io.StringIO()
+        self._images = io.StringIO()
+        self._image_blobs = io.StringIO()
+        # The images whose content is staged in this transaction, so a batch of books sends each one once
+        self._staged_image_hashes = set()
+        self._staging_ready = False
+
+    def _cursor(self):
+        return self.db.con.cursor()
+
+    def _prepare_staging(self):
+        if self._staging_ready:
+            return
+        cur = self._cursor()
+        cur.execute('''CREATE TEMP TABLE IF NOT EXISTS staged_chapters (
+            book_id integer,
+            title text,
+            slug text,
+            content text,
+            chapter_order integer,
+            content_stripped text,
+            searchable text
+        ) ON COMMIT DELETE ROWS''')
+        cur.execute('''CREATE TEMP TABLE IF NOT EXISTS staged_paragraphs (
+            book_id integer,
+            slug text,
+            chapter_order integer,
+            paragraph_order integer,
+            content text
+        ) ON COMMIT DELETE ROWS''')
+        cur.execute('''CREATE TEMP TABLE IF NOT EXISTS staged_images (
+            book_id integer,
+            location text,
+            format text,
+            hash_sha256 text
+        ) ON COMMIT DELETE ROWS''')
+        cur.execute('''CREATE TEMP TABLE IF NOT EXISTS staged_image_blobs (
+            hash_sha256 text,
+            content bytea
+        ) ON COMMIT DELETE ROWS''')
+        self._staging_ready = True
+
+    @staticmethod
+    def _stage(buffer, row):
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+
+    def _flush(self, buffer, table, columns):
+        if buffer.tell() == 0:
+            return
+        self._prepare_staging()
+        buffer.seek(0)
+        self._cursor().copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    def _flush_chapters(self):
+        self._flush(self._chapters, 'staged_chapters',
+                    ('book_id', 'title', 'slug', 'content', 'chapter_order', 'content_stripped', 'searchable'))
+        self._flush(self._paragraphs, 'staged_paragraphs',
+                    ('book_id', 'slug', 'chapter_order', 'paragraph_order', 'content'))
+
+    def _flush_images(self):
+        self._flush(self._images, 'staged_images',
+                    ('book_id', 'location', 'format', 'hash_sha256'))
+        self._flush(self._image_blobs, 'staged_image_blobs', ('hash_sha256', 'content'))
+
+    @timed("db.add_book_source")
+    def add_book_source(self, source, source_id, s3_path, hash_sha256):
+        """Adds an ebook source, or finds the existing one with the same hash.
+
+        Returns:
+            tuple -- The id of the ebook source and the id of its book, if it already has one."""
+        cur = self._cursor()
+        cur.execute(
+            '''WITH new_source AS (
+                INSERT INTO ebook_source (source, source_id, s3_path, hash_sha256) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (hash_sha256) DO NOTHING RETURNING id
+            ), found_source AS (
+                SELECT id FROM new_source
+                UNION ALL
+                SELECT id FROM ebook_source WHERE hash_sha256 = %s
+            )
+            SELECT found_source.id, (SELECT min(books.id) FROM books WHERE books.ebook_source_id = found_source.id)
+            FROM found_source LIMIT 1;''',
+            (source, source_id, s3_path, hash_sha256, hash_sha256))
+        row = cur.fetchone()
+        if row is None:
+            # Another writer committed the same source after this statement took its snapshot, so the INSERT
+            # skipped it but the SELECT couldn't see it. A new statement gets a new snapshot, which can.
+            cur.execute(
+                '''SELECT ebook_source.id, (SELECT min(books.id) FROM books WHERE books.ebook_source_id = ebook_source.id)
+                FROM ebook_source WHERE hash_sha256 = %s;''', (hash_sha256,))
+            row = cur.fetchone()
+        return row
+
+    @timed("db.add_book")
+    def add_book(self, ebook_source_id, title, author, slug, description, publication):
+        cur = self._cursor()
+        cur.execute(
+            '''INSERT INTO books (ebook_source_id, title, author, slug, description, version, publication) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id''',
+            (ebook_source_id, title, author, slug, description, self.db.version, publication))
+        return cur.fetchone()[0]
+
+    @timed("db.add_chapters")
+    def add_chapters(self, book_id, chapters):
+        for chapter in chapters:
+            if not self.precomputed_text:
+                self._stage(self._chapters, (book_id, chapter.title,
+                            chapter.slug, chapter.content, chapter.order, None, None))
+            elif chapter.text is None:
+                raise ValueError(
+                    f"chapter `{chapter.title}` has no precomputed text")
+            else:
+                self._stage(self._chapters, (book_id, chapter.title, chapter.slug, chapter.content, chapter.order,
+                            chapter.text.stripped, chapter.text.searchable))
+                for paragraph_order, paragraph in enumerate(chapter.text.paragraphs, start=1):
+                    self._stage(self._paragraphs, (book_id, chapter.slug,
+                                chapter.order, paragraph_order, paragraph))
+            if self._chapters.tell() + self._paragraphs.tell() >= self.flush_bytes:
+                self._flush_chapters()
+
+    @timed("db.add_images")
+    def add_images(self, book_id, images):
+        images = list(images)
+        hashes = {image.sha256() for image in images} - self._staged_image_hashes
+        # Like db.add_images, only the content of the images which aren't stored yet is sent
+        self._staged_image_hashes |= self.db.get_stored_image_hashes(hashes)
+        for image in images:
+            if image.hash_sha256 not in self._staged_image_hashes:
+                self._stage(self._image_blobs, (image.hash_sha256, image.read()))
+                self._staged_image_hashes.add(image.hash_sha256)
+            self._stage(self._images, (book_id, image.location, image.format, image.hash_sha256))
+            if self._images.tell() + self._image_blobs.tell() >= self.flush_bytes:
+                self._flush_images()
+
+    def add_full_book(self, source, source_id, s3_path, hash_sha256, title, author, slug, description, publication,
+                      chapters, images):
+        """Stages a complete book: its source, the book row (reusing the existing one for a known source), its
+        chapters and its images. The source is marked as produced by this version of the parser, and the rows of older
+        versions are deleted.
+
+        Returns:
+            int -- The id of the book."""
+        ebook_source_id, book_id = self.add_book_source(
+            source, source_id, s3_path, hash_sha256)
+        if not book_id:
+            book_id = self.add_book(
+                ebook_source_id, title, author, slug, description, publication)
+        self.add_chapters(book_id, chapters)
+        self.add_images(book_id, images)
+        _stamp_parser_version(self._cursor(), ebook_source_id, self.db.version)
+        self.books += 1
+        return book_id
+
+    def _merge_chapters_with_text(self, cur):
+        # Only chapters which were actually inserted get paragraphs, just like the AFTER INSERT trigger.
+        cur.execute("SET LOCAL openbook.precomputed_text = 'on';")
+        cur.execute(
+            '''WITH inserted AS (
+                INSERT INTO chapters (book_id, title, slug, content, content_stripped, chapter_order, version,
+                                      searchable_tsvector)
+                SELECT book_id, title, slug, content, content_stripped, chapter_order, %s,
+                       to_tsvector('english', searchable)
+                FROM staged_chapters
+                ON CONFLICT ON CONSTRAINT unique_chapter_version DO NOTHING
+                RETURNING id, book_id, slug, chapter_order
+            )
+            INSERT INTO paragraphs (chapters_id, paragraph_order, content, version)
+                SELECT inserted.id, staged_paragraphs.paragraph_order, staged_paragraphs.content, %s
+                FROM inserted JOIN staged_paragraphs
+                    ON staged_paragraphs.book_id = inserted.book_id
+                    AND staged_paragraphs.slug = inserted.slug
+                    AND staged_paragraphs.chapter_order = inserted.chapter_order
+                ON CONFLICT DO NOTHING;''', (self.db.version, self.db.version))
+
+    def commit(self):
+        """Merges everything staged so far into the real tables and commits the transaction."""
+        self._flush_chapters()
+        self._flush_images()
+        if self._staging_ready:
+            cur = self._cursor()
+            if self.precomputed_text:
+                self._merge_chapters_with_text(cur)
+            else:
+                cur.execute(
+                    '''INSERT INTO chapters (book_id, title, slug, content, chapter_order, version)
+                        SELECT book_id, title, slug, content, chapter_order, %s FROM staged_chapters
+                        ON CONFLICT ON CONSTRAINT unique_chapter_version DO NOTHING;''', (self.db.version,))
+            cur.execute(
+                '''INSERT INTO image_blobs (hash_sha256, content)
+                    SELECT hash_sha256, content FROM staged_image_blobs
+                    ON CONFLICT DO NOTHING;''')
+            cur.execute(
+                '''INSERT INTO images (book_id, location, format, hash_sha256, version)
+                    SELECT book_id, location, format, hash_sha256, %s FROM staged_images
+                    ON CONFLICT ON CONSTRAINT unique_image_version DO NOTHING;''', (self.db.version,))
+        self.db.con.commit()
+        self._staged_image_hashes = set()
+        self.books = 0
+
+    def rollback(self):
+        self._chapters = io.StringIO()
+        self._paragraphs = io.StringIO()
+        self._images = io.StringIO()
+        self._image_blobs = io.StringIO()
+        self._staged_image_hashes = set()
+        self.db.con.rollback()
+        # The staging tables may have been created in the transaction which was just rolled back.
+        self._staging_ready = False
+        self.books = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
 
 class db(object):
 
@@ -28,6 +310,8 @@ class db(object):
             hash_sha256 text,
             UNIQUE(hash_sha256)
         )''')
+        # The version_marker of the parser which produced the rows of the source, see get_current_source_hashes
+        cur.execute('''ALTER TABLE ebook_source ADD COLUMN IF NOT EXISTS parser_version integer;''')
         cur.execute('''CREATE TABLE IF NOT EXISTS books (
                 id SERIAL PRIMARY KEY,
                 ebook_source_id integer NOT NULL,
@@ -75,6 +359,13 @@ class db(object):
             FOREIGN KEY (book_id) REFERENCES books (id),
             CONSTRAINT unique_image_version UNIQUE(book_id, location, version)
         )''')
+        # The bytes of each image are stored once, keyed by their SHA-256, and images only maps the locations of a
+        # book to them. The content column of images is only set on the rows stored before image_blobs existed.
+        cur.execute('''CREATE TABLE IF NOT EXISTS image_blobs (
+            hash_sha256 text PRIMARY KEY,
+            content bytea NOT NULL
+        )''')
+        cur.execute('''ALTER TABLE images ADD COLUMN IF NOT EXISTS hash_sha256 text REFERENCES image_blobs (hash_sha256);''')
         cur.execute('''CREATE TABLE IF NOT EXISTS category (
             id SERIAL PRIMARY KEY,
             name text,
@@ -138,7 +429,7 @@ class db(object):
         RETURNS trigger AS $$
         BEGIN
             NEW.content_stripped = html_strip(NEW.content);
-            NEW.searchable_tsvector = to_tsvector('english', (select string_agg(txt, ' ') from unnest(string_to_array(coalesce(NEW.content_stripped,''), ' ')) with ordinality as tmp(txt) where length(txt) < 20))
+            NEW.searchable_tsvector = to_tsvector('english', (select string_agg(txt, ' ') from unnest(string_to_array(coalesce(NEW.content_stripped,''), ' ')) with ordinality as tmp(txt) where length(txt) < 20));
         RETURN NEW;
         END$$ LANGUAGE 'plpgsql';''')
 
@@ -146,12 +437,14 @@ class db(object):
         RETURNS trigger AS '
         BEGIN
             INSERT INTO paragraphs (chapters_id, paragraph_order, content, version)
-                SELECT NEW.id, paragraph_order, a.content, 1 FROM unnest(html_to_paragraph(NEW.content)) WITH ORDINALITY AS a(content, paragraph_order) ON CONFLICT DO NOTHING;
+                SELECT NEW.id, paragraph_order, a.content, NEW.version FROM unnest(html_to_paragraph(NEW.content)) WITH ORDINALITY AS a(content, paragraph_order) ON CONFLICT DO NOTHING;
             RETURN NEW;
         END' LANGUAGE 'plpgsql';''')
         cur.execute(
             '''DROP TRIGGER IF EXISTS trigger_create_paragraphs on chapters;''')
+        # Both triggers are skipped when the pipeline has already computed their results, see BulkLoader.
         cur.execute('''CREATE TRIGGER trigger_create_paragraphs AFTER INSERT or UPDATE ON chapters FOR EACH ROW
+        WHEN (current_setting('openbook.precomputed_text', true) IS DISTINCT FROM 'on')
         EXECUTE PROCEDURE create_paragraphs();''')
 
         cur.execute(
@@ -159,8 +452,9 @@ class db(object):
         cur.execute(
             '''DROP TRIGGER IF EXISTS prepare_chapter_search on chapters;''')
         cur.execute('''CREATE TRIGGER prepare_chapter_search BEFORE INSERT or UPDATE ON chapters FOR EACH ROW
+        WHEN (current_setting('openbook.precomputed_text', true) IS DISTINCT FROM 'on')
         EXECUTE PROCEDURE prepare_chapter_search();''')
-        cur.execute('''CREATE INDEX IF NOT EXIST idx 
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx 
             ON books USING gist ( 
             (
                 to_tsvector('english', coalesce(title, '')) || 
@@ -172,7 +466,7 @@ class db(object):
 
     def drop_tables(self):
         cur = self.con.cursor()
-        for table_name in ['images', 'chapters', 'books', 'ebook_source']:
+        for table_name in ['paragraphs', 'images', 'image_blobs', 'chapters', 'books', 'ebook_source']:
             cur.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE;")
         self.con.commit()
 
@@ -188,6 +482,7 @@ class db(object):
             '''SELECT count(*) FROM books;''')
         return cur.fetchone()[0]
 
+    @timed("db.add_book")
     def add_book(self, ebook_source_id, title, author, slug, description, publication):
         cur = self.con.cursor()
         cur.execute(
@@ -208,12 +503,32 @@ class db(object):
             '''SELECT * FROM ebook_source WHERE hash_sha256 = %s;''', (hash_sha256,))
         return cur.fetchone()
 
+    def get_current_source_hashes(self):
+        """The hashes of the sources whose rows were produced by this version of the parser, or a later one.
+
+        Returns:
+            set -- The SHA-256 of each of those sources."""
+        cur = self.con.cursor()
+        cur.execute(
+            '''SELECT hash_sha256 FROM ebook_source WHERE parser_version >= %s;''', (self.version,))
+        return {row[0] for row in cur.fetchall()}
+
+    @timed("db.set_source_parser_version")
+    def set_source_parser_version(self, ebook_source_id, commit=True):
+        """Records that the rows of a source were produced by this version of the parser, and replaces the rows of
+        older versions with them. Call it once the chapters and images of the source are stored, all three with
+        `commit=False` and committed together."""
+        _stamp_parser_version(self.con.cursor(), ebook_source_id, self.version)
+        if commit:
+            self.con.commit()
+
     def get_book_source_by_id(self, ebook_source_id):
         cur = self.con.cursor()
         cur.execute(
             '''SELECT * FROM ebook_source WHERE id = %s;''', (ebook_source_id,))
         return cur.fetchone()
 
+    @timed("db.add_book_source")
     def add_book_source(self, source, source_id, s3_path, hash_sha256):
         cur = self.con.cursor()
         cur.execute(
@@ -221,24 +536,59 @@ class db(object):
         self.con.commit()
         return cur.fetchone()[0]
 
-    def add_chapters(self, book_id, chapters):
+    @timed("db.add_chapters")
+    def add_chapters(self, book_id, chapters, commit=True):
         cur = self.con.cursor()
         for chapter in chapters:
             cur.execute(
                 '''INSERT INTO chapters (book_id, title, slug, content, chapter_order, version) VALUES (%s, %s, %s, %s, %s, %s)
                     ON CONFLICT ON CONSTRAINT unique_chapter_version DO NOTHING;''',
                 (book_id, chapter.title, chapter.slug, chapter.content, chapter.order, self.version))
-        self.con.commit()
+        if commit:
+            self.con.commit()
 
-    def add_images(self, book_id, images):
+    def get_stored_image_hashes(self, hashes):
+        """Returns:
+            set -- The hashes, out of `hashes`, of the images whose content is stored already."""
+        hashes = list(hashes)
+        if not hashes:
+            return set()
+        cur = self.con.cursor()
+        cur.execute(
+            '''SELECT hash_sha256 FROM image_blobs WHERE hash_sha256 = ANY(%s);''', (hashes,))
+        return {row[0] for row in cur.fetchall()}
+
+    @timed("db.add_images")
+    def add_images(self, book_id, images, commit=True):
+        """Stores the images of a book. The content of an image is only sent if no book stored it before, so
+        storing a book again, e.g. for a new version of the parser, writes no image content at all."""
+        images = list(images)
+        stored = self.get_stored_image_hashes(image.sha256() for image in images)
         cur = self.con.cursor()
         for image in images:
+            if image.hash_sha256 not in stored:
+                cur.execute(
+                    '''INSERT INTO image_blobs (hash_sha256, content) VALUES (%s, %s) ON CONFLICT DO NOTHING;''',
+                    (image.hash_sha256, image.read()))
+                stored.add(image.hash_sha256)
             cur.execute(
-                '''INSERT INTO images (book_id, location, content, format, version) VALUES (%s, %s, %s, %s, %s)
+                '''INSERT INTO images (book_id, location, format, hash_sha256, version) VALUES (%s, %s, %s, %s, %s)
                     ON CONFLICT ON CONSTRAINT unique_image_version DO NOTHING;''',
-                (book_id, image.location, image.content(), image.format, self.version))
-        self.con.commit()
+                (book_id, image.location, image.format, image.hash_sha256, self.version))
+        if commit:
+            self.con.commit()
+
+    def bulk_loader(self, precomputed_text=False):
+        """Returns a BulkLoader which writes whole books, or batches of books, in a single transaction. The
+        add_* methods above stay as the simple row-by-row path.
+
+        Keyword Arguments:
+            precomputed_text {bool} -- Load the text computed by the pipeline instead of running the chapter
+                                       triggers [default: {False}]
 
+        Returns:
+            BulkLoader -- A loader bound to this connection."""
+        return BulkLoader(self, precomputed_text)
 
     def add_category(self, name):
         cur = self.con.cursor()
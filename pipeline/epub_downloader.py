@@ -3,20 +3,28 @@ import sys
 import os
 import os.path
 import csv
+import json
 import argparse
 import requests
-import random
 import boto3
+from catalog import CatalogIndex, read_csv
 
 default_epubs_directory = './epubs/'
 default_cache_directory = './cache/'
 default_csv_path = './cache/pg_catalog.csv'
+default_catalog_path = './cache/pg_catalog.sqlite'
 
 GUTENBERG_MIRROR = "https://gutenberg.readingroo.ms/cache/epub"
 ebook_link_unformatted = GUTENBERG_MIRROR + "/{}/pg{}-images.epub"
 
 BUCKET_NAME = "gutenberg-vivlia"
 
+# What to do with the response to a conditional request, see response_action
+SKIP = "skip"
+APPEND = "append"
+RESTART = "restart"
+RETRY = "retry"
+
 
 def prepare_args():
     def unsigned_int(value):
@@ -43,7 +51,16 @@ def prepare_args():
                         help="Maximum books to download, applies to --all/--random [default: 5, unlimited: 0]")
 
     parser.add_argument('--clear-cache', action='store_true',
-                        help="Cache is used to store csv to speed subsequent reads, clear cache if you expect the csv to be out of date")
+                        help="Cache is used to store csv to speed subsequent reads, clear cache if you expect the csv to be out of date. "
+                        "The csv is only downloaded again if it changed")
+
+    parser.add_argument('--concurrency', '-c', type=int, default=None,
+                        help="Download this many books at once with asyncio, over kept-alive connections, retrying "
+                        "5xx responses and timeouts. Needs aiohttp [default: one book at a time]")
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help="Requests per second to the mirror with --concurrency [default: %(default)s, unlimited: 0]")
+    parser.add_argument('--retries', type=unsigned_int, default=5,
+                        help="Retries of each book with --concurrency, with exponential backoff [default: %(default)s]")
 
     args = parser.parse_args()
 
@@ -58,6 +75,12 @@ def prepare_args():
         parser.error(
             "--random does not accept --max 0, use --all --max 0 instead")
 
+    if(args.concurrency is not None and args.concurrency < 1):
+        parser.error("--concurrency must be at least 1")
+
+    if(args.rate < 0):
+        parser.error("--rate can't be negative")
+
     return args
 
 
@@ -65,31 +88,48 @@ def get_epub_link(id):
     return ebook_link_unformatted.format(id, id)
 
 
-def download_file(link, f):
+def download_file(link, f, hasher=None, chunk_size=4096):
     """Streams a file from an HTTP(S) URL to a file-like object.
 
     Arguments:
         link {str} -- The URL to download
         f {file} -- The file-like object to write to
 
+    Keyword Arguments:
+        hasher {hashlib object} -- Updated with every chunk as it is written, so the digest is ready once the download
+                                   is done without reading the file again [default: {None}]
+        chunk_size {int} -- The size of the chunks written to `f` [default: {4096}]
+
     Returns:
         None
     """
-    filename = link.split('/')[-1]
     r = requests.get(link, stream=True)
     if(r.status_code != 200):
         raise FileNotFoundError(f"404: {link}")
+    write_response(r, f, link.split('/')[-1], hasher, chunk_size=chunk_size)
+
+
+def write_response(r, f, filename, hasher=None, offset=0, chunk_size=4096):
+    """Writes the body of a streamed response to a file-like object, showing the progress.
+
+    Keyword Arguments:
+        offset {int} -- The bytes of the file which were already downloaded, for a resumed download [default: {0}]
+        chunk_size {int} -- The size of the chunks written to `f` [default: {4096}]"""
     total_length = r.headers.get('content-length')
 
     # https://stackoverflow.com/a/15645088
     if total_length is None:  # no content length header
         f.write(r.content)
+        if hasher:
+            hasher.update(r.content)
     else:
-        processed = 0
-        total_length = int(total_length)
-        for data in r.iter_content(chunk_size=4096):
+        processed = offset
+        total_length = int(total_length) + offset
+        for data in r.iter_content(chunk_size=chunk_size):
             processed += len(data)
             f.write(data)
+            if hasher:
+                hasher.update(data)
             done = int(50 * processed / total_length)
             sys.stdout.write(
                 "\rDownloading: {} - [{}{}] {}%".format(filename, '=' * done, ' ' * (50-done), done * 2))
@@ -97,29 +137,170 @@ def download_file(link, f):
         print("")
 
 
+def metadata_path(path):
+    return path + ".http.json"
+
+
+def response_metadata(link, headers):
+    return {"url": link, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"), "size": None}
+
+
+def read_metadata(path):
+    """Returns:
+        dict -- The URL, validators and size of a downloaded file, see write_metadata, or {} if there are none."""
+    try:
+        with open(metadata_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_metadata(path, metadata):
+    """Keeps the URL, ETag and Last-Modified of a download next to the file, so the next download of the same URL
+    can be a conditional request, or resume the partial file with a range request. The size is only set once the
+    file is complete.
+
+    Arguments:
+        path {str} -- The path of the downloaded file
+        metadata {dict} -- The metadata, see response_metadata"""
+    with open(metadata_path(path), "w") as f:
+        json.dump(metadata, f)
+
+
+def conditional_request(path, link):
+    """The headers to request a file which may already be on disk.
+
+    A complete file, whose size matches its metadata, is requested with If-None-Match/If-Modified-Since, so an
+    unchanged file only costs a 304. A partial `.part` file is resumed with a Range request, whose If-Range makes the
+    server send the whole file instead if it changed in the meantime.
+
+    Arguments:
+        path {str} -- The path the file is downloaded to
+        link {str} -- The URL of the file
+
+    Returns:
+        tuple -- The headers, the offset to resume at (None when the complete file is on disk, 0 for a new download)
+                 and the metadata of the file"""
+    metadata = read_metadata(path)
+    if(metadata.get("url") != link or not (metadata.get("etag") or metadata.get("last_modified"))):
+        return {}, 0, {}
+
+    if(metadata.get("size") is not None and os.path.isfile(path) and os.path.getsize(path) == metadata["size"]):
+        headers = {}
+        if(metadata.get("etag")):
+            headers["If-None-Match"] = metadata["etag"]
+        if(metadata.get("last_modified")):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+        return headers, None, metadata
+
+    offset = os.path.getsize(path + ".part") if os.path.isfile(path + ".part") else 0
+    etag = metadata.get("etag")
+    # A weak ETag can't be used in If-Range
+    validator = etag if etag and not etag.startswith("W/") else metadata.get("last_modified")
+    if(not offset or not validator):
+        return {}, 0, {}
+    return {"Range": f"bytes={offset}-", "If-Range": validator}, offset, metadata
+
+
+def response_action(path, link, status, headers, offset, metadata):
+    """Decides what to do with the response to a request from conditional_request.
+
+    Returns:
+        str -- SKIP when the file on disk is up to date, APPEND when the response continues the partial file,
+               RESTART when the response is the whole file, or RETRY when the partial file can't be resumed and was
+               removed"""
+    if(status == 304):
+        return SKIP
+    if(status == 200):
+        # Some servers ignore conditional requests, but still send the same validators for an unchanged file
+        unchanged = (offset is None and str(metadata.get("size")) == headers.get("Content-Length") and
+                     (headers.get("ETag") or headers.get("Last-Modified")) and
+                     headers.get("ETag") == metadata.get("etag") and
+                     headers.get("Last-Modified") == metadata.get("last_modified"))
+        return SKIP if unchanged else RESTART
+    if(status == 206 and offset and headers.get("Content-Range", "").startswith(f"bytes {offset}-")):
+        return APPEND
+    if(status in (206, 416) and offset):
+        os.remove(path + ".part")
+        return RETRY
+    raise FileNotFoundError(f"{status}: {link}")
+
+
+def download_to_path(link, path):
+    """Downloads a file to `path`, unless the copy on disk is up to date. An interrupted download is left in a
+    `.part` file, which the next download resumes.
+
+    Arguments:
+        link {str} -- The URL to download
+        path {str} -- The path of the file
+
+    Returns:
+        bool -- True if the file was downloaded, False if the copy on disk was up to date"""
+    filename = link.split('/')[-1]
+    # A partial file which can't be resumed is removed, and requested again from the start
+    for _ in range(2):
+        headers, offset, metadata = conditional_request(path, link)
+        with requests.get(link, headers=headers, stream=True) as r:
+            action = response_action(path, link, r.status_code, r.headers, offset, metadata)
+            if(action == RETRY):
+                continue
+            if(action == SKIP):
+                print(f"Up to date: {filename}")
+                return False
+            if(action == RESTART):
+                metadata = response_metadata(link, r.headers)
+                write_metadata(path, metadata)
+            with open(path + ".part", "ab" if action == APPEND else "wb") as f:
+                write_response(r, f, filename, offset=offset if action == APPEND else 0)
+        os.replace(path + ".part", path)
+        write_metadata(path, dict(metadata, size=os.path.getsize(path)))
+        return True
+    raise FileNotFoundError(f"{link} could not be resumed")
+
+
 def get_csv_reader(save_to_file=True, clear_cache=False):
-    """Downloads the csv file from gutenberg.org and returns a csv.reader object
+    """Downloads the csv file from gutenberg.org and reads it one row at a time. Use open_catalog to look books up.
 
     Keyword Arguments:
         save_to_file {bool} -- If true, saves the csv file to the cache directory [default: {True}]
-        clear_cache {bool} -- If true, clears the cache directory [default: {False}]
+        clear_cache {bool} -- If true, checks whether the cached csv is out of date, and downloads it again if it is
+                             [default: {False}]
 
     Returns:
-        csv.reader -- A csv.reader object"""
+        iterable -- Each row as a dict"""
     if(save_to_file):
-        if(clear_cache or not os.path.isfile(default_csv_path)):
-            os.makedirs(os.path.dirname(default_csv_path), exist_ok=True)
-            with open(default_csv_path, "wb") as f:
-                download_file(f'{GUTENBERG_MIRROR}/feeds/pg_catalog.csv', f)
-
-        with open(default_csv_path, "r", encoding='utf-8') as f:
-            return csv.DictReader(f.read().splitlines(), delimiter=',', quotechar='"')
+        update_csv(default_csv_path, clear_cache)
+        return read_csv(default_csv_path)
     else:
         f = io.BytesIO()
         download_file(f'{GUTENBERG_MIRROR}/feeds/pg_catalog.csv', f)
         f.seek(0)
-        strbuf = io.TextIOWrapper(f, 'utf-8', newline='')
-        return csv.DictReader(strbuf.read().splitlines(), delimiter=',', quotechar='"')
+        return csv.DictReader(io.TextIOWrapper(f, 'utf-8', newline=''), delimiter=',', quotechar='"')
+
+
+def update_csv(csv_path=default_csv_path, refresh=False):
+    if(refresh or not os.path.isfile(csv_path)):
+        os.makedirs(os.path.dirname(csv_path) or '.', exist_ok=True)
+        download_to_path(f'{GUTENBERG_MIRROR}/feeds/pg_catalog.csv', csv_path)
+
+
+def open_catalog(csv_path=default_csv_path, catalog_path=default_catalog_path, refresh=False):
+    """Opens the local index of the catalog, downloading the csv and bringing the index up to date with it first.
+
+    Keyword Arguments:
+        csv_path {str} -- Where the csv is cached [default: {default_csv_path}]
+        catalog_path {str} -- Where the index is kept [default: {default_catalog_path}]
+        refresh {bool} -- Check whether the cached csv is out of date, which costs a conditional request
+                          [default: {False}]
+
+    Returns:
+        CatalogIndex -- The index, to be closed by the caller"""
+    update_csv(csv_path, refresh)
+    catalog = CatalogIndex(catalog_path)
+    changes = catalog.refresh(csv_path)
+    if(changes):
+        print(f"Catalog: {changes['written']} books updated, {changes['deleted']} removed")
+    return catalog
 
 
 def upload_ebook_s3(id):
@@ -144,7 +325,7 @@ def upload_ebook_s3(id):
 
 
 def download_ebook(id):
-    """Downloads an ebook from gutenberg.org
+    """Downloads an ebook from gutenberg.org, unless the copy on disk is up to date
 
     Arguments:
         id {int} -- The id of the ebook to download
@@ -154,55 +335,54 @@ def download_ebook(id):
     ebook_link = get_epub_link(id)
     filename = ebook_link.split('/')[-1]
     path = os.path.join(default_epubs_directory, filename)
-    with open(path, "wb") as f:
-        download_file(ebook_link, f)
-        return path
+    download_to_path(ebook_link, path)
+    return path
 
 
-def download_ebook_to_temp(id):
-    """Downloads an ebook from gutenberg.org to a temporary file
+def catalog_books(args):
+    """Yields the books of the catalog selected by --all or --random, up to --max books. Entries which aren't books
+    (Type != 'Text') are never selected.
 
     Arguments:
-        id {int} -- The id of the ebook to download
+        args {argparse.Namespace} -- The command line arguments.
 
     Returns:
-        list -- A list containing the file and the file path"""
-    ebook_link = get_epub_link(id)
-    filename = ebook_link.split('/')[-1]
-    f = open(f'/tmp/{filename}', 'w+b')
-    download_file(ebook_link, f)
-    f.seek(0)
-    return [f, filename]
+        generator -- The id and title of each book."""
+    with open_catalog(refresh=args.clear_cache) as catalog:
+        if(args.all):
+            books = catalog.books()
+
+        if(args.random):
+            books = catalog.sample(args.max)
+
+        count = 0
+        for book in books:
+            yield book['Text#'], book['Title']
+            count += 1
+            if(count == args.max):
+                break
 
 
 if __name__ == '__main__':
     args = prepare_args()
-    if(args.clear_cache and os.path.isfile(default_csv_path)):
-        os.remove(default_csv_path)
 
-    if(args.all):
-        books = get_csv_reader(clear_cache=args.clear_cache)
-
-    if(args.random):
-        books = random.choices(
-            list(get_csv_reader(clear_cache=args.clear_cache)), k=args.max)
+    if(args.concurrency):
+        # Imported here, so the sequential downloader and the Lambda functions don't need aiohttp
+        import async_downloader
+        if(args.all or args.random):
+            async_downloader.main(catalog_books(args), args)
+        else:
+            async_downloader.main([(args.id, None)], args)
+        sys.exit()
 
     if(args.all or args.random):
-        for book in books:
-            book_id = book['Text#']
-            title = book['Title']
-            if(book['Type'] != 'Text'):
-                print(f"Not a book, skipping: {book_id}. {title}.")
-                continue
+        for book_id, title in catalog_books(args):
             if(args.upload_s3):
                 print(f"Uploading S3 {book_id}. {title}.")
                 upload_ebook_s3(book_id)
             else:
                 print(f"Downloading {book_id}. {title}.")
                 download_ebook(book_id)
-            args.max -= 1
-            if(args.max == 0):
-                break
 
     if(args.id):
         if(args.upload_s3):
@@ -1,37 +1,210 @@
 from bs4.element import Comment, NavigableString
 from content_parser import Navpoint, ContentParser
+from dataclasses import dataclass
+from typing import List
+import io
 import os
+import mmap
 import hashlib
 
 from zipfile import ZipFile
 from zipfile import is_zipfile
+from zipfile import ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 from titlecase import titlecase
 
 from slugify import slugify
 from bs4 import BeautifulSoup
 
 import random
+from collections import OrderedDict
 from helpers import join_path
+from profiling import span
+
+# Files are hashed in blocks of this size when they can't be memory mapped
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# The member cache of each book is bounded to this many bytes
+DEFAULT_MEMBER_CACHE_BYTES = 64 * 1024 * 1024
+# Parsed members are weighed as this many times their uncompressed size, which is roughly what their tree takes in
+# memory (BeautifulSoup trees measure around 6 times their markup)
+PARSED_MEMBER_WEIGHT = 8
+
+# What parsing any book costs on top of its files, see EpubParser.memory_estimate
+MEMORY_OVERHEAD = 16 * 1024 * 1024
+
+CONTAINER_PATH = "META-INF/container.xml"
+SUPPORTED_COMPRESSION = {ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA}
+
+
+def calc_sha256(f):
+    """Calculates the SHA-256 of a whole file. Local files are memory mapped and in-memory files are hashed in place,
+    anything else is read in large blocks.
+
+    Arguments:
+        f {file} -- The binary file-like object to hash.
+
+    Returns:
+        str -- The hex digest of the file."""
+    sha256 = hashlib.sha256()
+
+    if isinstance(f, io.BytesIO):
+        with f.getbuffer() as view:
+            sha256.update(view)
+        return sha256.hexdigest()
+
+    try:
+        fileno = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+
+    if fileno is not None and os.fstat(fileno).st_size > 0:
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+            sha256.update(mapped)
+        return sha256.hexdigest()
+
+    while True:
+        data = f.read(HASH_BUFFER_SIZE)
+        if not data:
+            break
+        sha256.update(data)
+    return sha256.hexdigest()
+
+
+class MemberCache(object):
+    """A least recently used cache of the members read out of EPUB files, bounded by their size. Keys begin with the
+    hash of the EPUB file, so one cache can also be shared between books. The hit, miss and eviction counters are there
+    to tune the size with."""
+
+    def __init__(self, max_bytes=DEFAULT_MEMBER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        # key: (value, weight), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, load, weight):
+        """Returns the cached value of `key`, or loads and caches it.
+
+        Arguments:
+            key {tuple} -- The hash of the EPUB file, the path of the member and anything else the value depends on.
+            load {callable} -- Produces the value when it isn't cached.
+            weight {int} -- The size the value counts for. Values heavier than the whole cache are never cached.
+
+        Returns:
+            object -- The value."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        value = load()
+        if weight <= self.max_bytes:
+            while self.size + weight > self.max_bytes:
+                _, (_, evicted_weight) = self.entries.popitem(last=False)
+                self.size -= evicted_weight
+                self.evictions += 1
+            self.entries[key] = (value, weight)
+            self.size += weight
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions, " \
+            f"{self.size}/{self.max_bytes} bytes"
+
+
+@dataclass
+class ManifestItem:
+    id: str
+    href: str
+    media_type: str
+
+
+class Manifest(object):
+    """The items of the OPF manifest, indexed once by id and by href so resolving the spine, the images and the NCX
+    doesn't search the whole OPF for each item."""
+
+    def __init__(self, items: List[ManifestItem]):
+        self.items = items
+        # The first item wins, like the selector lookups this replaces
+        self.by_id = {}
+        self.by_href = {}
+        for item in items:
+            self.by_id.setdefault(item.id, item)
+            self.by_href.setdefault(item.href, item)
 
 
 class EpubParser(object):
-    def __init__(self, filename, file=None):
+    # Builds the chapters out of the parsed HTML files, see LxmlEpubParser for the other backend
+    content_parser_class = ContentParser
+    # Part of the member cache key of parsed members, which differ between backends
+    backend = "bs4"
+    # The memory a book takes while it is parsed, for each byte of its HTML files: the parsed files, the copies of
+    # the chapters and their markup. Streaming only keeps the parsed files and one chapter, see memory_estimate.
+    memory_weight = 14
+    tree_weight = PARSED_MEMBER_WEIGHT
+
+    def __init__(self, filename, file=None, file_hash=None, member_cache=None):
+        """Opens an EPUB file, either from `filename` or from the already open `file`.
+
+        Arguments:
+            filename {str} -- The name (or path) of the EPUB file.
+
+        Keyword Arguments:
+            file {file} -- The binary file-like object to read instead of opening `filename` [default: {None}]
+            file_hash {str} -- The SHA-256 of the file, if the caller already computed it while the bytes were
+                               streamed in. The file is only hashed when this isn't given [default: {None}]
+            member_cache {MemberCache} -- The cache of the members read from the file, so reading a member again
+                                          doesn't decompress or parse it again [default: a cache for this book only]
+        """
         self.file = file
         self.filename = filename
         self.html_file_order = []
         self.html_files = {}
         self.image_files = {}
         self.navpoints = {}
+        self.content_path = None
+        self.package = None
+        self.manifest = None
+        self.ncx_path = None
         self.ezip = None
-        self.file_hash = None
-        if(self.file):
-            self.file_hash = self._calc_sha256(self.file)
+        self.file_hash = file_hash
+        self.member_cache = member_cache if member_cache is not None else MemberCache()
+        # Only a file opened here is closed by close(), one which was passed in belongs to the caller
+        self.owns_file = not self.file
+        if(self.owns_file):
+            # The same handle is used for hashing and by ZipFile, so the file is only read from disk once.
+            self.file = open(self.filename, "rb")
+        try:
+            if(not self.file_hash):
+                with span("hash"):
+                    self.file_hash = self._calc_sha256(self.file)
             self.file.seek(0)
             self.ezip = ZipFile(self.file, 'r')
-        else:
-            with open(self.filename, "rb") as f:
-                self.file_hash = self._calc_sha256(f)
-            self.ezip = ZipFile(self.filename, 'r')
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Closes the zip file, and the EPUB file if it was opened from `filename`. A streamed book can't build any
+        more chapters or read its images after this."""
+        if self.ezip is not None:
+            self.ezip.close()
+        if self.owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
 
     @staticmethod
     def _try_get_text(content, selector):
@@ -46,47 +219,54 @@ class EpubParser(object):
         return (filename, None)
 
     def _calc_sha256(self, f):
-        sha256 = hashlib.sha256()
-        while True:
-            data = f.read(sha256.block_size)
-            if not data:
-                break
-            sha256.update(data)
-        return sha256.hexdigest()
+        return calc_sha256(f)
 
-    def parse(self):
+    def parse(self, prepare_text=False, stream=False, full_check=False):
         """Main function which parses the EPUB file and populates the class attributes with the resulting data.
 
+        Keyword Arguments:
+            prepare_text {bool} -- Also compute the stripped text, search text and paragraphs of each chapter
+                                   [default: {False}]
+            stream {bool} -- Make `content.chapters` a generator which builds one chapter at a time, to bound memory
+                             on very large books [default: {False}]
+            full_check {bool} -- Decompress and CRC-check every member before parsing, see `can_be_unzipped`
+                                 [default: {False}]
+
         Returns:
             EpubParser -- The current instance of the class"""
 
         print(f"Processing: {self.filename}")
 
-        if not self.can_be_unzipped():
-            return
+        with span("unzip_check"):
+            if not self.can_be_unzipped(full_check):
+                return
 
-        container = self.get_file_content_xml("META-INF/container.xml")
-        content_path = container.find("rootfile").attrs["full-path"]
-        content_directory_path = os.path.dirname(content_path)
-        content = self.get_file_content_xml(content_path)
+        self.read_package()
+        content = self.package
+        content_directory_path = os.path.dirname(self.content_path)
 
         self.set_metadata_from_xml(content)
 
         print(f"Reading: {self}")
 
-        ncx = self.get_file_content_xml(
-            join_path(content_directory_path, content.select_one("#ncx").attrs["href"]))
+        with span("navpoints"):
+            ncx = self.get_file_content_xml(self.ncx_path)
 
-        self.populate_html_page_list(content, content_directory_path)
-        self.populate_image_list(content, content_directory_path)
+            self.populate_html_page_list(content, content_directory_path)
+            self.populate_image_list(content, content_directory_path)
 
-        self.process_navpoints(ncx)
+            self.process_navpoints(ncx)
 
-        self.content = ContentParser(self.html_file_order, self.html_files, self.image_files,
-                                     self.navpoints)
+        with span("content"):
+            self.content = self.content_parser_class(self.html_file_order, self.html_files, self.image_files,
+                                                     self.navpoints, prepare_text=prepare_text, stream=stream)
 
         return self
 
+    @staticmethod
+    def find_content_path(container: BeautifulSoup):
+        return container.find("rootfile").attrs["full-path"]
+
     def set_metadata_from_xml(self, content: BeautifulSoup):
         """Sets the metadata from the EPUB's container.xml file.
 
@@ -112,18 +292,11 @@ class EpubParser(object):
         Returns:
             None
         """
-        navpoints = ncx.find_all("navpoint")
-
         # sort them by playorder
-        navpoints = sorted(
-            navpoints, key=lambda elem: int(elem.attrs["playorder"]))
-
-        for navpoint in navpoints:
-            navpoint: BeautifulSoup
+        navpoints = sorted(self.find_navpoints(ncx), key=lambda navpoint: navpoint[0])
 
-            title = navpoint.find("text").text
-            filename, selector = self._normalize_navlink_src(
-                navpoint.find("content").attrs["src"])
+        for _, title, src in navpoints:
+            filename, selector = self._normalize_navlink_src(src)
 
             navpoint_to_add = Navpoint(title=title, selector=selector)
 
@@ -135,6 +308,19 @@ class EpubParser(object):
 
         self.add_navpoint_to_start_of_book()
 
+    @staticmethod
+    def find_navpoints(ncx: BeautifulSoup):
+        """Reads the navpoints of the NCX file, in document order.
+
+        Arguments:
+            ncx {BeautifulSoup} -- The BeautifulSoup representation of the NCX file.
+
+        Returns:
+            list -- The playorder, title and src of each navpoint.
+        """
+        return [(int(navpoint.attrs["playorder"]), navpoint.find("text").text, navpoint.find("content").attrs["src"])
+                for navpoint in ncx.find_all("navpoint")]
+
     def add_navpoint_to_start_of_book(self):
         """Adds a navpoint to the start of the book. This is used in case the book doesn't have a navpoint in the
         beginning of the book.
@@ -153,13 +339,102 @@ class EpubParser(object):
         else:
             self.navpoints[first_html_page] = [new_navpoint]
 
-    def can_be_unzipped(self):
+    def read_package(self):
+        """Reads container.xml, the OPF file it points to and the manifest of the OPF file. They are only read once,
+        however many times this is called.
+
+        Returns:
+            None
+        """
+        if self.content_path is not None:
+            return
+        with span("package"):
+            container = self.get_file_content_xml(CONTAINER_PATH)
+            content_path = self.find_content_path(container)
+            self.package = self.get_file_content_xml(content_path)
+            self.manifest = Manifest(self.find_manifest_items(self.package))
+            self.ncx_path = join_path(os.path.dirname(content_path), self.manifest.by_id["ncx"].href)
+            self.content_path = content_path
+
+    def file_size(self):
+        """Returns:
+            int -- The size of the EPUB file in bytes, without reading it."""
+        position = self.file.tell()
+        size = self.file.seek(0, os.SEEK_END)
+        self.file.seek(position)
+        return size
+
+    def member_sizes(self):
+        """The uncompressed sizes of the HTML files of the spine and of the images, from the central directory.
+
+        Returns:
+            tuple -- The size of each HTML file, and the size of each image."""
+        self.read_package()
+        content_directory_path = os.path.dirname(self.content_path)
+
+        def size(href):
+            try:
+                return self.ezip.getinfo(join_path(content_directory_path, href).lstrip("/")).file_size
+            except KeyError:
+                return 0
+
+        hrefs = dict.fromkeys(self.manifest.by_id[idref].href for idref in self.find_spine_idrefs(self.package))
+        html = [size(href) for href in hrefs]
+        images = [size(href) for href, item in self.manifest.by_href.items() if item.media_type.startswith("image/")]
+        return html, images
+
+    def memory_estimate(self, stream=False):
+        """Estimates how much memory parsing the book takes, without decompressing anything. The estimate is meant
+        to be an upper bound, so it can be checked against a memory budget before the book is parsed.
+
+        Keyword Arguments:
+            stream {bool} -- Estimate for `parse(stream=True)`, which keeps at most the member cache worth of parsed
+                             files, one chapter and one image in memory [default: {False}]
+
+        Returns:
+            int -- The estimate in bytes."""
+        html, images = self.member_sizes()
+        if not stream:
+            return MEMORY_OVERHEAD + sum(html) * self.memory_weight + sum(images)
+        trees = min(sum(html) * self.tree_weight, self.member_cache.max_bytes)
+        return MEMORY_OVERHEAD + trees + max(html, default=0) * 2 + max(images, default=0)
+
+    def can_be_unzipped(self, full=False):
         """Checks if the EPUB file can be unzipped. Correctly formatted EPUB files should be able to be unzipped.
 
+        By default only the structure is checked: every member of the central directory must be readable, and
+        container.xml, the OPF file and the NCX file must exist. The CRC of a member is checked when it is read to
+        the end by parsing, so each member is only decompressed once.
+
+        Keyword Arguments:
+            full {bool} -- Decompress and CRC-check every member instead, like `zip -T` [default: {False}]
+
         Returns:
             bool -- True if the EPUB file can be unzipped, False otherwise.
         """
-        return not self.ezip.testzip()
+        if full:
+            return not self.ezip.testzip()
+
+        for info in self.ezip.infolist():
+            if info.flag_bits & 0x1 or info.compress_type not in SUPPORTED_COMPRESSION:
+                print(f"Can't read {info.filename} in {self.filename}: encrypted or unsupported compression")
+                return False
+            if info.header_offset + info.compress_size > self.ezip.start_dir:
+                print(f"Can't read {info.filename} in {self.filename}: it overlaps the central directory")
+                return False
+
+        try:
+            self.read_package()
+        except Exception as e:
+            print(f"Can't read the package of {self.filename}: {e!r}")
+            return False
+
+        names = set(self.ezip.namelist())
+        for required in (self.content_path, self.ncx_path):
+            if required.lstrip("/") not in names:
+                print(f"{required} is missing from {self.filename}")
+                return False
+        return True
 
     def get_file_content(self, filename):
         """Gets the content of a file in the EPUB file.
@@ -170,15 +445,17 @@ class EpubParser(object):
         Returns:
             bytes -- The content of the file.
         """
-        data = None
         if filename.startswith("/"):
             filename = filename[1:]
-        with self.ezip.open(filename) as f:
-            data = f.read()
-        return data
+
+        def read():
+            with span("unzip"), self.ezip.open(filename) as f:
+                return f.read()
+        return self.member_cache.get((self.file_hash, filename), read, self.ezip.getinfo(filename).file_size)
 
     def get_file_content_xml(self, filename):
-        """Gets the content of a file in the EPUB file and parses it as XML.
+        """Gets the content of a file in the EPUB file and parses it as XML. The parsed file is shared by every
+        caller, so it must not be modified.
 
         Arguments:
             filename {str} -- The name of the file to get the content of.
@@ -188,8 +465,16 @@ class EpubParser(object):
         """
         if filename.startswith("/"):
             filename = filename[1:]
-        with self.ezip.open(filename) as f:
-            return BeautifulSoup(f, features="lxml")
+
+        def read():
+            with span("parse_member"), self.ezip.open(filename) as f:
+                return self.parse_member(f)
+        return self.member_cache.get((self.file_hash, filename, self.backend), read,
+                                     self.ezip.getinfo(filename).file_size * PARSED_MEMBER_WEIGHT)
+
+    @staticmethod
+    def parse_member(f):
+        return BeautifulSoup(f, features="lxml")
 
     def populate_html_page_list(self, content: BeautifulSoup, content_directory_path):
         """Populates the html_file_order and html_files attributes with the content of the EPUB's HTML files. The
@@ -204,19 +489,10 @@ class EpubParser(object):
         Returns:
             None
         """
-        spine_tag = content.find('spine')
-        for spine_item_tag in spine_tag.children:
-            spine_item_tag: BeautifulSoup
-            if type(spine_item_tag) == NavigableString:
-                continue
+        for idref in self.find_spine_idrefs(content):
+            filename = self.manifest.by_id[idref].href
 
-            idref = spine_item_tag.attrs['idref']
-            # Dots are valid in IDs, but they must be escaped for us to use them in a selector
-            idref = idref.replace(".", "\.")
-            corresponding_item = content.select_one(f"#{idref}")
-            filename = corresponding_item.attrs['href']
-
-            if filename in self.html_file_order:
+            if filename in self.html_files:
                 continue
 
             full_path = join_path(content_directory_path, filename)
@@ -236,24 +512,46 @@ class EpubParser(object):
 
         Returns:
             None"""
-        manifest_tag = content.find('manifest')
-        for manifest_item_tag in manifest_tag.children:
-            manifest_item_tag: BeautifulSoup
-            if type(manifest_item_tag) == NavigableString or type(manifest_item_tag) == Comment:
-                continue
-
-            mimetype: str = manifest_item_tag.attrs['media-type']
-
-            if not mimetype.startswith("image/"):
+        for filename, item in self.manifest.by_href.items():
+            if not item.media_type.startswith("image/"):
                 continue
 
-            filename = manifest_item_tag.attrs['href']
             full_path = join_path(content_directory_path, filename)
             def file_content(
                 full_path=full_path): return self.get_file_content(full_path)
 
             self.image_files[filename] = file_content
 
+    @staticmethod
+    def find_manifest_items(content: BeautifulSoup):
+        """Reads the items of the OPF manifest, in document order.
+
+        Arguments:
+            content {BeautifulSoup} -- The BeautifulSoup representation of the OPF file.
+
+        Returns:
+            list -- A ManifestItem for each item.
+        """
+        items = []
+        for manifest_item_tag in content.find('manifest').children:
+            manifest_item_tag: BeautifulSoup
+            if type(manifest_item_tag) == NavigableString or type(manifest_item_tag) == Comment:
+                continue
+
+            items.append(ManifestItem(id=manifest_item_tag.attrs.get('id'), href=manifest_item_tag.attrs.get('href'),
+                                      media_type=manifest_item_tag.attrs['media-type']))
+        return items
+
+    @staticmethod
+    def find_spine_idrefs(content: BeautifulSoup):
+        """Yields the idref of each spine item, in reading order."""
+        for spine_item_tag in content.find('spine').children:
+            spine_item_tag: BeautifulSoup
+            if type(spine_item_tag) == NavigableString:
+                continue
+
+            yield spine_item_tag.attrs['idref']
+
     def __str__(self):
         return f"`{self.title}` -> `{self.slug}`"
 
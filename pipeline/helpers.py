@@ -16,16 +16,17 @@ def parse_s3_url(s3url):
     filename = url.path.lstrip('/')
     return {'bucketname': bucketname, 'filename': filename}
 
-def EpubParserFromS3(bucketname, filename):
+def EpubParserFromS3(bucketname, filename, s3_resource=None, file_hash=None):
     # we are importing from within a function,
     # to avoid introducing unneeded dependencies when other simpler functions are called,
     # e.g join_path
     import boto3
-    import io
     from epub_parser import EpubParser
+    from s3_io import S3RangeReader
 
-    s3_client = boto3.resource('s3')
-    book_object = s3_client.Object(bucketname, filename)
-    book_io =  io.BytesIO()
-    book_object.download_fileobj(book_io)
-    return EpubParser(filename, book_io)
\ No newline at end of file
+    # callers handling several books pass their resource, so the client is only set up once
+    s3_client = s3_resource or boto3.resource('s3')
+    # Only the members which are read are fetched, with ranged GETs, instead of downloading the whole book.
+    # With the stored `file_hash` the book isn't read through just to hash it either.
+    book_io = S3RangeReader(s3_client.meta.client, bucketname, filename)
+    return EpubParser(filename, book_io, file_hash)
\ No newline at end of file
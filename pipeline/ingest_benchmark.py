@@ -0,0 +1,393 @@
+import argparse
+import contextlib
+import functools
+import io
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extensions
+
+import process
+from benchmark import git_revision, record_result, span, synthetic_epub
+from checkpoint import CheckpointJournal
+from db import db
+
+# The functions run by the triggers on chapters, see db._create_tables
+TRIGGER_FUNCTIONS = ("prepare_chapter_search", "create_paragraphs")
+
+
+class TemporaryCluster(object):
+    """A throwaway PostgreSQL cluster in a temporary directory, created with initdb and started with pg_ctl. It only
+    listens on a Unix socket inside its own directory, so it never clashes with another server. PostgreSQL refuses
+    to run as root.
+
+    Usage:
+        with TemporaryCluster() as dsn:
+            con = db(dsn)
+    """
+
+    def __init__(self, bin_dir=None, settings=()):
+        self.bin_dir = bin_dir or find_bin_dir()
+        self.settings = ["track_functions=all", *settings]
+        self.directory = None
+
+    def _run(self, program, *args):
+        subprocess.run([os.path.join(self.bin_dir, program), *args], check=True, capture_output=True, text=True)
+
+    @property
+    def data(self):
+        return os.path.join(self.directory, "data")
+
+    @property
+    def dsn(self):
+        return f"host={self.directory} port=5432 user=postgres dbname=postgres"
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="openbook-pg-")
+        self._run("initdb", "-D", self.data, "-U", "postgres", "-A", "trust", "-E", "UTF8", "--no-sync")
+        options = ["-k", self.directory, "-p", "5432", "-c", "listen_addresses="]
+        for setting in self.settings:
+            options.extend(["-c", setting])
+        self._run("pg_ctl", "-D", self.data, "-l", os.path.join(self.directory, "postgres.log"), "-w",
+                  "-o", " ".join(shlex.quote(option) for option in options), "start")
+        return self.dsn
+
+    def stop(self):
+        if self.directory is None:
+            return
+        try:
+            self._run("pg_ctl", "-D", self.data, "-m", "fast", "-w", "stop")
+        except subprocess.CalledProcessError:
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+    def __enter__(self):
+        try:
+            return self.start()
+        except BaseException:
+            self.stop()
+            raise
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+def find_bin_dir():
+    """The directory of initdb and pg_ctl: the one on the PATH, or the one pg_config reports.
+
+    Returns:
+        str -- The directory."""
+    initdb = shutil.which("initdb")
+    if initdb:
+        return os.path.dirname(initdb)
+    try:
+        return subprocess.run(["pg_config", "--bindir"], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        raise RuntimeError("initdb can't be found, add the PostgreSQL binaries to the PATH or use --pg-bin")
+
+
+class DatabaseTimer(object):
+    """Accumulates the time the connections it creates spend waiting for statements and commits, from any thread.
+    The time is measured on the client, so it includes the round trip to the server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(float)
+        self.cursor_classes = {}
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] += seconds
+
+    def cursor_class(self, base):
+        # Subclasses whichever cursor class the connection would have used, so other cursor factories keep working
+        if base not in self.cursor_classes:
+            timer = self
+
+            def timed(method):
+                @functools.wraps(method)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return method(*args, **kwargs)
+                    finally:
+                        timer.add("statements", time.perf_counter() - start)
+                return wrapper
+
+            self.cursor_classes[base] = type("TimedCursor", (base,), {
+                name: timed(getattr(base, name)) for name in ("execute", "executemany", "copy_expert", "copy_from")})
+        return self.cursor_classes[base]
+
+    def connect(self, dsn):
+        timer = self
+
+        class TimedConnection(psycopg2.extensions.connection):
+            def cursor(self, *args, **kwargs):
+                base = kwargs.pop("cursor_factory", None) or self.cursor_factory or psycopg2.extensions.cursor
+                return super().cursor(*args, cursor_factory=timer.cursor_class(base), **kwargs)
+
+            def commit(self):
+                start = time.perf_counter()
+                try:
+                    super().commit()
+                finally:
+                    timer.add("commit", time.perf_counter() - start)
+
+        return psycopg2.connect(dsn, connection_factory=TimedConnection)
+
+
+def timed_db_class(timer):
+    """A db class whose connections are timed by `timer`."""
+
+    class TimedDb(db):
+        @property
+        def con(self):
+            if self._con is None:
+                self._con = timer.connect(self.dsn)
+            return self._con
+
+    return TimedDb
+
+
+@contextlib.contextmanager
+def instrumented_process(dsn, timer, timings, time_parsing=True):
+    """Points process.py at the temporary cluster and times its parse and store steps, for the duration of the
+    block. Books parsed by --workers are parsed in other processes, so `time_parsing` should be off for them.
+
+    Arguments:
+        dsn {str} -- The connection string of the cluster.
+        timer {DatabaseTimer} -- Times the database connections of process.py.
+        timings {defaultdict} -- Receives the seconds spent parsing and storing books.
+
+    Keyword Arguments:
+        time_parsing {bool} -- Also time parse_book [default: {True}]"""
+
+    def timed(phase, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(timings, phase):
+                return function(*args, **kwargs)
+        return wrapper
+
+    replaced = {"db_connection": dsn, "db": timed_db_class(timer),
+                "store_book": timed("store", process.store_book), "store_books": timed("store", process.store_books)}
+    if time_parsing:
+        replaced["parse_book"] = timed("parse", process.parse_book)
+    original = {name: getattr(process, name) for name in replaced}
+    for name, value in replaced.items():
+        setattr(process, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(process, name, value)
+
+
+def write_corpus(directory, books, **knobs):
+    """Writes `books` different synthetic EPUB files into a directory.
+
+    Arguments:
+        directory {str} -- The directory to write to.
+        books {int} -- The number of books.
+
+    Keyword Arguments:
+        knobs -- Passed to synthetic_epub, except for the seed, which is the number of the book.
+
+    Returns:
+        int -- The size of the corpus in bytes."""
+    size = 0
+    for index in range(books):
+        book = synthetic_epub(**knobs, seed=index)
+        with open(os.path.join(directory, f"pg-synthetic-{index}.epub"), "wb") as f:
+            f.write(book)
+        size += len(book)
+    return size
+
+
+def query_one(dsn, sql):
+    con = psycopg2.connect(dsn)
+    try:
+        cur = con.cursor()
+        cur.execute(sql)
+        return cur.fetchone()[0]
+    finally:
+        con.close()
+
+
+def trigger_seconds(dsn):
+    """The time the server spent in the chapter triggers since the statistics were reset, including the functions
+    they call and the paragraphs they insert. Needs track_functions=all."""
+    names = ", ".join(f"'{name}'" for name in TRIGGER_FUNCTIONS)
+    return float(query_one(dsn, f'''SELECT coalesce(sum(total_time), 0) FROM pg_stat_user_functions
+        WHERE funcname IN ({names});''')) / 1000
+
+
+def run_ingest(dsn, corpus, process_arguments):
+    """Ingests a corpus into an empty database with process.py, timing where the time goes.
+
+    Arguments:
+        dsn {str} -- The connection string of the database.
+        corpus {str} -- The directory of the EPUB files.
+        process_arguments {list} -- Extra command line arguments of process.py, such as --bulk or --workers.
+
+    Returns:
+        dict -- The wall time, the time of each phase in seconds, and the journal counts."""
+    with tempfile.TemporaryDirectory() as directory:
+        args = process.prepare_args(["--input-dir", corpus, "--journal", os.path.join(directory, "journal.sqlite"),
+                                     *process_arguments])
+
+        # The schema is created before the clock starts, which also checks that plv8 is available
+        db(dsn).close()
+        query_one(dsn, "SELECT pg_stat_reset();")
+
+        timer = DatabaseTimer()
+        timings = defaultdict(float)
+        output = io.StringIO()
+        with CheckpointJournal(args.journal) as journal, contextlib.redirect_stdout(output), \
+                instrumented_process(dsn, timer, timings, time_parsing=not args.workers):
+            start = time.perf_counter()
+            files = journal.start(process.limit_files(process.list_files(args), args.max))
+            process.ingest_files(files, args, journal)
+            wall = time.perf_counter() - start
+            counts = journal.counts()
+
+    for line in output.getvalue().splitlines():
+        if line.startswith(("error:", "warning:")):
+            print(line)
+
+    # Closed connections have flushed their function statistics
+    triggers = trigger_seconds(dsn)
+    statements = timer.timings["statements"]
+    commit = timer.timings["commit"]
+    parallel = bool(args.workers)
+    phases = {
+        "python_parse": None if parallel else timings["parse"],
+        "python_store": None if parallel else timings["store"] - statements - commit,
+        "python_other": None if parallel else wall - timings["parse"] - timings["store"],
+        # The triggers run inside the INSERT statements, also the ones BulkLoader runs before committing
+        "db_statements": max(statements - triggers, 0),
+        "db_triggers": triggers,
+        "db_commit": commit,
+    }
+    return {"wall": wall, "phases": phases, "journal": counts, "workers": args.workers}
+
+
+def prepare_args():
+    parser = argparse.ArgumentParser(
+        description='Ingest a synthetic corpus into a throwaway local PostgreSQL cluster with process.py and report '
+        'the throughput. Arguments which are not listed here, such as --bulk, --batch-size, --workers, --backend or '
+        '--precompute-text, are passed on to process.py.')
+
+    parser.add_argument('--books', type=int, default=20,
+                        help="Books in the corpus [default: %(default)s]")
+    parser.add_argument('--spine-files', type=int, default=20,
+                        help="HTML files in each book [default: %(default)s]")
+    parser.add_argument('--navpoints-per-file', type=int, default=4,
+                        help="Chapters in each HTML file [default: %(default)s]")
+    parser.add_argument('--chapter-paragraphs', type=int, default=40,
+                        help="Paragraphs in each chapter [default: %(default)s]")
+    parser.add_argument('--images', type=int, default=10,
+                        help="Images in each book [default: %(default)s]")
+    parser.add_argument('--image-kb', type=int, default=50,
+                        help="Size of each image in KB [default: %(default)s]")
+    parser.add_argument('--pg-bin', default=None,
+                        help="Directory of initdb and pg_ctl [default: the one on the PATH]. The server needs the "
+                        "plv8 extension")
+    parser.add_argument('--pg-setting', action='append', default=[],
+                        help="A server setting such as shared_buffers=1GB, can be repeated")
+    parser.add_argument('--results', default="ingest-benchmark-results.jsonl",
+                        help="JSON lines file the results are appended to [default: %(default)s]")
+    parser.add_argument('--no-record', action='store_true',
+                        help="Don't append the results to --results")
+
+    args, process_arguments = parser.parse_known_args()
+
+    if args.books < 1:
+        parser.error("--books must be at least 1")
+
+    for option in ("--input-dir", "--input-path", "--journal", "--resume", "--drop"):
+        if option in process_arguments:
+            parser.error(f"{option} is set by the benchmark")
+
+    return args, process_arguments
+
+
+def format_seconds(seconds, wall):
+    if seconds is None:
+        return f"{'n/a':>10}"
+    return f"{seconds:>9.2f}s {seconds / wall:>6.1%}"
+
+
+def main():
+    args, process_arguments = prepare_args()
+
+    knobs = {
+        "books": args.books,
+        "spine_files": args.spine_files,
+        "navpoints_per_file": args.navpoints_per_file,
+        "chapter_paragraphs": args.chapter_paragraphs,
+        "images": args.images,
+        "image_bytes": args.image_kb * 1024,
+    }
+
+    with tempfile.TemporaryDirectory(prefix="openbook-corpus-") as corpus:
+        size = write_corpus(corpus, args.books, spine_files=args.spine_files,
+                            navpoints_per_file=args.navpoints_per_file,
+                            chapter_paragraphs=args.chapter_paragraphs, images=args.images,
+                            image_bytes=args.image_kb * 1024)
+        print(f"Corpus: {args.books} books, {size / (1024 * 1024):.1f} MB")
+
+        try:
+            with TemporaryCluster(args.pg_bin, args.pg_setting) as dsn:
+                result = run_ingest(dsn, corpus, process_arguments)
+                books = query_one(dsn, "SELECT count(*) FROM books;")
+                chapters = query_one(dsn, "SELECT count(*) FROM chapters;")
+                paragraphs = query_one(dsn, "SELECT count(*) FROM paragraphs;")
+        except subprocess.CalledProcessError as e:
+            print(f"error: {' '.join(e.cmd)} failed\n{e.stderr}")
+            sys.exit(1)
+
+    wall = result["wall"]
+    print(f"Journal: {result['journal']}")
+    print(f"Stored {books} books, {chapters} chapters and {paragraphs} paragraphs in {wall:.2f}s")
+    print(f"{books / wall:.2f} books/s, {chapters / wall:.1f} chapters/s, {size / (1024 * 1024) / wall:.2f} MB/s")
+    for phase, seconds in result["phases"].items():
+        print(f"  {phase:<16}{format_seconds(seconds, wall)}")
+    if result["workers"]:
+        print("  Books are parsed by the workers while the database is written, and the database time is summed over "
+              "the writer connections, so the phases overlap")
+
+    if not args.no_record:
+        commit, dirty = git_revision()
+        record_result(args.results, {
+            "commit": commit,
+            "dirty": dirty,
+            "recorded": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "knobs": knobs,
+            "process_arguments": process_arguments,
+            "corpus_bytes": size,
+            "books": books,
+            "chapters": chapters,
+            "paragraphs": paragraphs,
+            "wall": wall,
+            "books_per_second": books / wall,
+            "chapters_per_second": chapters / wall,
+            "mb_per_second": size / (1024 * 1024) / wall,
+            "phases": result["phases"],
+        })
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,123 @@
-from io import BufferedReader
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import json
+import hashlib
 import boto3
 from config import config
+from memory import MB, account_memory, over_budget
+from profiling import profiled, span
+from s3_io import MultipartUpload, Spool, Tee
 
 bucket_name = config["BUCKET_NAME"]
 db_connection = config["DB_CONNECTION"]
+# Only /tmp is writable on Lambda
+CATALOG_CSV_PATH = "/tmp/pg_catalog.csv"
+CATALOG_PATH = "/tmp/pg_catalog.sqlite"
+
+# Books handed to each invocation of the batch handlers, unless the event of the dispatcher sets its own batch_size.
+# A batch size of 1 invokes the single book handlers instead.
+DEFAULT_BATCH_SIZE = 10
+# Invocations each dispatcher has in flight at once
+DISPATCH_CONCURRENCY = 16
+# Books are streamed to S3 and the parser in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# The memory of a function which the runtime, boto3 and the DB driver take before a book is opened, the rest is the
+# memory budget of the book, see memory_budget
+RUNTIME_MEMORY = 128 * MB
+
+
+def batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def invoke_all(client, function_name, payloads, concurrency=DISPATCH_CONCURRENCY):
+    """Invokes a Lambda function asynchronously once for each payload, with `concurrency` invocations in flight. A
+    failed invocation is reported in the responses and doesn't stop the others.
+
+    Arguments:
+        client {Lambda.Client} -- The Lambda client, which can be shared between threads.
+        function_name {str} -- The name of the function to invoke.
+        payloads {list} -- The event of each invocation.
+
+    Keyword Arguments:
+        concurrency {int} -- The number of invocations in flight [default: {DISPATCH_CONCURRENCY}]
+
+    Returns:
+        list -- The response of each invocation, in the order of the payloads, or its error."""
+    def invoke(payload):
+        try:
+            response = client.invoke(
+                FunctionName=function_name,
+                InvocationType='Event',  # 'RequestResponse',
+                Payload=json.dumps(payload),
+            )
+        except Exception as e:
+            print(f"error: ({function_name}) {e}")
+            return {'error': str(e), 'payload': payload}
+        del response['Payload']
+        return response
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(invoke, payloads))
+
+
+def dispatch(function_name, batch_function_name, books, batch_size):
+    """Hands `books` to the single book handler one at a time, or to the batch handler `batch_size` at a time.
+
+    Returns:
+        list -- The response of each invocation."""
+    client = boto3.client('lambda')
+    if(batch_size > 1):
+        return invoke_all(client, batch_function_name, [{'data': batch} for batch in batches(books, batch_size)])
+    return invoke_all(client, function_name, books)
+
+
+def memory_budget(context):
+    """The memory a book may take in an invocation: MEMORY_BUDGET_MB if it is configured, otherwise the memory of the
+    function less RUNTIME_MEMORY.
+
+    Arguments:
+        context {object} -- The Lambda context object, or None outside of Lambda.
+
+    Returns:
+        int -- The budget in bytes, or None for no budget."""
+    if config.get("MEMORY_BUDGET_MB"):
+        return int(config["MEMORY_BUDGET_MB"]) * MB
+    if context is None:
+        return None
+    return max(int(context.memory_limit_in_mb) * MB - RUNTIME_MEMORY, 0)
+
+
+def parse_within_budget(epub, memory_budget):
+    """Parses a book like process.py --memory-budget-mb does, before the invocation can be killed for running out of
+    memory: a book over the budget is streamed, so its chapters are built while they are stored, and a book which is
+    over it even then isn't parsed.
+
+    Arguments:
+        epub {EpubParser} -- The book.
+        memory_budget {int} -- The memory the book may take in bytes, or None.
+
+    Raises:
+        MemoryError: The book is over the budget even when it is streamed."""
+    memory = {}
+    path = account_memory(epub, memory, memory_budget)
+    if path == "quarantined":
+        raise MemoryError(f"{epub.filename} {over_budget(memory, memory_budget)}")
+    if path == "stream":
+        print(f"Streaming {epub.filename}, it needs about {memory['estimate_bytes'] // MB} MB")
+    with span("parse"):
+        epub.parse(stream=path == "stream")
+
+
+def batch_response(results):
+    """The response of a batch handler, with the result of each book, which has an `error` if it failed."""
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'results': results,
+            'failed': sum(1 for result in results if 'error' in result),
+        })
+    }
 
 
 def UpdateBooks(event, context):
@@ -18,20 +131,10 @@ def UpdateBooks(event, context):
     Returns:
         dict -- A dictionary containing the status of the update.
     """
-    # body = {"data": [{"book_id": 1, "ebook_source_id": 1}, ...]}
+    # body = {"data": [{"book_id": 1, "ebook_source_id": 1}, ...], "batch_size": 10}
 
-    data = event['data']
-    responses = []
-    client = boto3.client('lambda')
-    for book in data:
-        response = client.invoke(
-            FunctionName='updateBook',
-            InvocationType='Event',  # 'RequestResponse',
-            Payload=json.dumps(book),
-        )
-        print(response['Payload'].read())
-        del response['Payload']
-        responses.append(response)
+    responses = dispatch('updateBook', 'updateBookBatch', event['data'],
+                         event.get('batch_size', DEFAULT_BATCH_SIZE))
 
     print(event, context)
     return {
@@ -40,6 +143,7 @@ def UpdateBooks(event, context):
     }
 
 
+@profiled
 def UpdateBook(event, context):
     """Updates a book given a dictionary of the book id and the source id.
 
@@ -49,43 +153,89 @@ def UpdateBook(event, context):
 
     Returns:
         dict -- A dictionary containing the status of the update."""
-    book_id = event['book_id']
-    ebook_source_id = event['ebook_source_id']
-
     from db import db
     with db(db_connection) as con:
-
-        ebook_source = con.get_book_source_by_id(ebook_source_id)
-        if(not ebook_source):
+        try:
+            update_book(con, boto3.resource('s3'), event['book_id'], event['ebook_source_id'],
+                        memory_budget(context))
+        except (LookupError, MemoryError) as e:
             return {
                 'statusCode': 200,
-                'body': json.dump({'error': "ebook_source not found"})
+                'body': json.dumps({'error': str(e)})
             }
 
-        import helpers
-        url = helpers.parse_s3_url(ebook_source[3])
-        epub = helpers.EpubParserFromS3(**url)
+        return {
+            'statusCode': 200,
+            'body': event
+        }
+
+
+@profiled
+def UpdateBookBatch(event, context):
+    """Updates several books with one DB connection and one S3 client. A book which fails doesn't stop the others.
 
+    Arguments:
+        event {dict} -- A dictionary containing the list of dictionaries of the book id and the source id.
+        context {object} -- The Lambda context object.
+
+    Returns:
+        dict -- A dictionary containing the result of each book."""
+    # body = {"data": [{"book_id": 1, "ebook_source_id": 1}, ...]}
+
+    results = []
+    s3_resource = boto3.resource('s3')
+    from db import db
+    with db(db_connection) as con:
+        for book in event['data']:
+            try:
+                update_book(con, s3_resource, book['book_id'], book['ebook_source_id'], memory_budget(context))
+                results.append(dict(book))
+            except Exception as e:
+                con.con.rollback()
+                print(f"error: ({book.get('book_id')}) {e}")
+                results.append(dict(book, error=str(e)))
+    return batch_response(results)
+
+
+def update_book(con, s3_resource, book_id, ebook_source_id, memory_budget=None):
+    """Parses a book again from its source on S3, and stores its chapters and images.
+
+    Arguments:
+        con {db} -- The DB connection.
+        s3_resource {S3.ServiceResource} -- The S3 resource.
+        book_id {int} -- The id of the book.
+        ebook_source_id {int} -- The id of its source.
+
+    Keyword Arguments:
+        memory_budget {int} -- The memory the book may take in bytes, see parse_within_budget [default: {None}]
+
+    Raises:
+        LookupError: The book or its source doesn't exist, or they don't belong together.
+        MemoryError: The book is over the memory budget."""
+    ebook_source = con.get_book_source_by_id(ebook_source_id)
+    if(not ebook_source):
+        raise LookupError("ebook_source not found")
+
+    import helpers
+    url = helpers.parse_s3_url(ebook_source[3])
+    with span("s3_download"):
+        # The hash of the source was stored with it, so the book doesn't have to be read through to hash it
+        epub = helpers.EpubParserFromS3(**url, s3_resource=s3_resource, file_hash=ebook_source[4])
+
+    with epub:
         book = con.get_book_by_ebook_source_id(ebook_source_id)
         if(not book):
-            return {
-                'statusCode': 200,
-                'body': json.dump({'error': "book not found"})
-            }
+            raise LookupError("book not found")
 
         if(ebook_source[0] != ebook_source_id or book[0] != book_id):
-            return {
-                'statusCode': 200,
-                'body': json.dump({'error': "ids mismatch"})
-            }
+            raise LookupError("ids mismatch")
 
-        con.add_chapters(book_id, epub.content.chapters)
-        con.add_images(book_id, epub.content.images)
-
-        return {
-            'statusCode': 200,
-            'body': event
-        }
+        parse_within_budget(epub, memory_budget)
+        # In one transaction, see process.store_book
+        con.add_chapters(book_id, epub.content.chapters, commit=False)
+        con.add_images(book_id, epub.content.images, commit=False)
+        con.set_source_parser_version(ebook_source_id, commit=False)
+        con.con.commit()
 
 
 def DownloadBooks(event, context):
@@ -98,20 +248,10 @@ def DownloadBooks(event, context):
 
     Returns:
         dict -- A dictionary containing the status of the invocation."""
-    # body = {"data": [{"gutenberg_id": 1}, ...]}
+    # body = {"data": [{"gutenberg_id": 1}, ...], "batch_size": 10}
 
-    data = event['data']
-    responses = []
-    client = boto3.client('lambda')
-    for book in data:
-        response = client.invoke(
-            FunctionName='downloadBook',
-            InvocationType='Event',  # 'RequestResponse',
-            Payload=json.dumps(book),
-        )
-        print(response['Payload'].read())
-        del response['Payload']
-        responses.append(response)
+    responses = dispatch('downloadBook', 'downloadBookBatch', event['data'],
+                         event.get('batch_size', DEFAULT_BATCH_SIZE))
 
     print(event, context)
     return {
@@ -119,15 +259,8 @@ def DownloadBooks(event, context):
         'body': json.dumps(responses),
     }
 
-# work around to s3 transfer closing buffer
-# https://github.com/boto/s3transfer/issues/80#issuecomment-482534256
-
-
-class NonCloseableBufferedReader(BufferedReader):
-    def close(self):
-        self.flush()
-
 
+@profiled
 def DownloadBook(event, context):
     """Downloads a book given a dictionary of the gutenberg id and the source id.
 
@@ -137,38 +270,105 @@ def DownloadBook(event, context):
 
     Returns:
         dict -- A dictionary containing the status of the invocation."""
-    gutenberg_id = event['gutenberg_id']
+    from db import db
+    with db(db_connection, False) as con:
+        try:
+            book_id, ebook_source_id = download_book(con, boto3.resource('s3'), event['gutenberg_id'],
+                                                     memory_budget(context))
+        except MemoryError as e:
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'error': str(e)})
+            }
+
+        event['book_id'] = book_id
+        event['ebook_source_id'] = ebook_source_id
+        return {
+            'statusCode': 200,
+            'body': json.dumps(event)
+        }
+
 
+@profiled
+def DownloadBookBatch(event, context):
+    """Downloads several books with one DB connection and one S3 client. A book which fails doesn't stop the others.
+
+    Arguments:
+        event {dict} -- A dictionary containing the list of dictionaries of the gutenberg id.
+        context {object} -- The Lambda context object.
+
+    Returns:
+        dict -- A dictionary containing the result of each book."""
+    # body = {"data": [{"gutenberg_id": 1}, ...]}
+
+    results = []
+    s3_resource = boto3.resource('s3')
     from db import db
     with db(db_connection, False) as con:
+        for book in event['data']:
+            try:
+                book_id, ebook_source_id = download_book(con, s3_resource, book['gutenberg_id'],
+                                                         memory_budget(context))
+                results.append(dict(book, book_id=book_id, ebook_source_id=ebook_source_id))
+            except Exception as e:
+                con.con.rollback()
+                print(f"error: ({book.get('gutenberg_id')}) {e}")
+                results.append(dict(book, error=str(e)))
+    return batch_response(results)
+
 
-        import epub_downloader
-        f, filename = epub_downloader.download_ebook_to_temp(gutenberg_id)
-
-        import epub_parser
-        epub = epub_parser.EpubParser(filename, f)
-        if(not epub.can_be_unzipped()):
-            raise ValueError(
-                f"can't be unzipped, invalid epub file, {filename}")
-
-        ebook_source = con.get_book_source_by_hash(epub.file_hash)
-        if(not ebook_source):
-            print("Uploading to S3")
-            s3_client = boto3.resource('s3')
-            f.seek(0)
-            config = boto3.s3.transfer.TransferConfig(multipart_threshold=262144, max_concurrency=5, multipart_chunksize=262144,
-                                                      num_download_attempts=5, max_io_queue=5, io_chunksize=262144, use_threads=True)
-            s3buffer = NonCloseableBufferedReader(f)
-            response = s3_client.meta.client.upload_fileobj(
-                s3buffer, bucket_name, filename, Config=config)
-            s3buffer.detach()
-            print("Uploaded")
-
-            ebook_source_id = con.add_book_source(
-                "gutenberg", filename, f"s3://{bucket_name}/{filename}", epub.file_hash)
-        else:
-            print("Skip Uploading")
-            ebook_source_id = ebook_source[0]
+def download_book(con, s3_resource, gutenberg_id, memory_budget=None):
+    """Downloads a book from gutenberg, uploads it to S3 unless its source is stored already, and stores the book.
+
+    The download is read once: each chunk goes into the hash, into a multipart upload to S3 and into a spooled copy
+    for the parser at the same time. The upload is only completed once the book is known to be valid and new, and
+    is aborted otherwise.
+
+    Arguments:
+        con {db} -- The DB connection.
+        s3_resource {S3.ServiceResource} -- The S3 resource.
+        gutenberg_id {int} -- The gutenberg id of the book.
+
+    Keyword Arguments:
+        memory_budget {int} -- The memory the book may take in bytes, see parse_within_budget [default: {None}]
+
+    Returns:
+        tuple -- The id of the book and of its source.
+
+    Raises:
+        MemoryError: The book is over the memory budget."""
+    import epub_downloader
+    import epub_parser
+    ebook_link = epub_downloader.get_epub_link(gutenberg_id)
+    filename = ebook_link.split('/')[-1]
+    sha256 = hashlib.sha256()
+
+    # The EPUB is closed before the spool it reads from
+    with Spool() as spool, contextlib.ExitStack() as open_epub:
+        with MultipartUpload(s3_resource.meta.client, bucket_name, filename) as upload:
+            with span("download"):
+                epub_downloader.download_file(ebook_link, Tee(spool, upload), sha256, DOWNLOAD_CHUNK_SIZE)
+
+            epub = open_epub.enter_context(epub_parser.EpubParser(filename, spool.file(), sha256.hexdigest()))
+            with span("unzip_check"):
+                can_be_unzipped = epub.can_be_unzipped()
+            if(not can_be_unzipped):
+                raise ValueError(
+                    f"can't be unzipped, invalid epub file, {filename}")
+
+            ebook_source = con.get_book_source_by_hash(epub.file_hash)
+            if(not ebook_source):
+                print("Uploading to S3")
+                # Most of the parts went up during the download, this waits for the rest
+                with span("s3_upload"):
+                    upload.complete()
+                print("Uploaded")
+
+                ebook_source_id = con.add_book_source(
+                    "gutenberg", filename, f"s3://{bucket_name}/{filename}", epub.file_hash)
+            else:
+                print("Skip Uploading")
+                ebook_source_id = ebook_source[0]
 
         book_id = None
         if(ebook_source):
@@ -176,23 +376,22 @@ def DownloadBook(event, context):
             if(book):
                 book_id = book[0]
 
-        epub.parse()
+        parse_within_budget(epub, memory_budget)
         if(not book_id):
             book_id = con.add_book(ebook_source_id, epub.title, epub.author,
                                    epub.slug, epub.description, epub.publication)
 
+        # In one transaction, see process.store_book
         print("Proccessing Chapters")
-        con.add_chapters(book_id, epub.content.chapters)
+        con.add_chapters(book_id, epub.content.chapters, commit=False)
         print("Proccessing Images")
-        con.add_images(book_id, epub.content.images)
+        con.add_images(book_id, epub.content.images, commit=False)
+        # Otherwise process.py --incremental would parse the book again
+        con.set_source_parser_version(ebook_source_id, commit=False)
+        con.con.commit()
         print("Done")
 
-        event['book_id'] = book_id
-        event['ebook_source_id'] = ebook_source_id
-        return {
-            'statusCode': 200,
-            'body': json.dumps(event)
-        }
+    return book_id, ebook_source_id
 
 
 def DownloadRangeBooks(event, context):
@@ -204,32 +403,18 @@ def DownloadRangeBooks(event, context):
 
     Returns:
         dict -- A dictionary containing the status of the invocation."""
-    # body = {"start": n, "end": m}
+    # body = {"start": n, "end": m, "batch_size": 10}
 
     start_id = event['start']
     end_id = event['end']
 
-    responses = []
-    client = boto3.client('lambda')
-
     import epub_downloader
-    books = epub_downloader.get_csv_reader(False)
-
-    for book in books:
-        if(book['Type'] != 'Text'):
-            continue
-
-        book_id = int(book['Text#'])
-        if(book_id >= start_id and book_id <= end_id):
-            response = client.invoke(
-                FunctionName='downloadBook',
-                InvocationType='Event',  # 'RequestResponse',
-                Payload=json.dumps({"gutenberg_id": book_id}),
-            )
-            print(f"Requesting book ({book_id}) download")
+    # /tmp outlives the invocation while the container stays warm, so the index is usually only revalidated
+    with epub_downloader.open_catalog(CATALOG_CSV_PATH, CATALOG_PATH, refresh=True) as catalog:
+        books = [{"gutenberg_id": int(book['Text#'])} for book in catalog.range(start_id, end_id)]
+    print(f"Requesting the download of {len(books)} books")
 
-            del response['Payload']
-            responses.append(response)
+    responses = dispatch('downloadBook', 'downloadBookBatch', books, event.get('batch_size', DEFAULT_BATCH_SIZE))
 
     return {
         'statusCode': 200,
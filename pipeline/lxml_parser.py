@@ -0,0 +1,463 @@
+import re
+
+from lxml import etree
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EncodingDetector
+from bs4.element import CharsetMetaAttributeValue, ContentMetaAttributeValue, DEFAULT_OUTPUT_ENCODING
+from bs4.formatter import HTMLFormatter
+
+from content_parser import ContentParser, chapter_text
+from epub_parser import EpubParser, ManifestItem
+
+# The lxml backend works on the lxml tree directly instead of building a BeautifulSoup tree on top of it, but it
+# produces exactly the chapters the BeautifulSoup backend produces. The constants below are the ones BeautifulSoup
+# uses to parse and serialize HTML.
+EMPTY_ELEMENT_TAGS = HTMLTreeBuilder.empty_element_tags
+PRESERVE_WHITESPACE_TAGS = HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+STRING_CONTAINERS = set(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+CDATA_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+FORMATTER = HTMLFormatter.REGISTRY["minimal"]
+CDATA_CONTAINING_TAGS = FORMATTER.cdata_containing_tags
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+NON_WHITESPACE = re.compile(r"\S+")
+
+
+def parse_html(f):
+    """Parses a file the same way `BeautifulSoup(f, features="lxml")` does, but keeps the lxml tree.
+
+    Args:
+        f (file): The binary file-like object to parse.
+
+    Returns:
+        lxml.etree._Element: The root of the document."""
+    detector = EncodingDetector(f.read(), [None, None], True, None)
+    error = None
+    for encoding in detector.encodings:
+        parser = etree.HTMLParser(strip_cdata=False, recover=True, encoding=encoding)
+        try:
+            parser.feed(detector.markup)
+            return parser.close()
+        except (UnicodeDecodeError, LookupError, etree.ParserError) as e:
+            error = e
+    raise ValueError(f"The markup can't be parsed with any encoding: {error}")
+
+
+def is_element(node):
+    # Comments and processing instructions are nodes as well, but they are strings to BeautifulSoup
+    return isinstance(node.tag, str)
+
+
+def find(root, name):
+    """The first element called `name`, including `root` itself, like `BeautifulSoup.find` on a whole document.
+
+    Returns:
+        lxml.etree._Element: The element, or None."""
+    return next(root.iter(name), None)
+
+
+class Partial(object):
+    """A view of an element which only has some of its children. The children are strings, whole nodes of the source
+    tree (without their tail) or other partials, so cutting a chapter out of a file never copies or modifies it."""
+
+    __slots__ = ("element", "children")
+
+    def __init__(self, element, children):
+        self.element = element
+        self.children = children
+
+
+def contents(node):
+    """The children of an element or a partial, the way BeautifulSoup sees them: text and tails become strings."""
+    if type(node) is Partial:
+        return node.children
+    children = []
+    if node.text:
+        children.append(node.text)
+    for child in node:
+        children.append(child)
+        if child.tail:
+            children.append(child.tail)
+    return children
+
+
+def string_context(name, container, preserve):
+    """The string container and whitespace preservation which apply to the children of a tag called `name`."""
+    if name in STRING_CONTAINERS:
+        container = name
+    return container, preserve or name in PRESERVE_WHITESPACE_TAGS
+
+
+def collapse(value, preserve):
+    # BeautifulSoup replaces every string made only of ASCII spaces with a single newline or space while parsing
+    if not preserve and not value.strip(ASCII_SPACES):
+        return '\n' if '\n' in value else ' '
+    return value
+
+
+def output_string(child, parent, container, preserve):
+    """Renders a text, comment or processing instruction the way `NavigableString.output_ready` does."""
+    if isinstance(child, str):
+        value, prefix, suffix = child, None, None
+    elif child.tag is etree.Comment:
+        value, prefix, suffix = child.text or '', '<!--', '-->'
+    else:
+        value, prefix, suffix = f"{child.target} {child.text or ''}", '<?', '>'
+    value = collapse(value, preserve)
+
+    if prefix is None or container is not None:
+        # Inside of <script>, <style> and <template> everything is a string of the container's class
+        if parent in CDATA_CONTAINING_TAGS:
+            return value
+        return FORMATTER.substitute(value)
+    return prefix + value + suffix
+
+
+def attributes(element, rewrite):
+    """The serialized attributes of an element, in the order BeautifulSoup outputs them."""
+    name = element.tag
+    attrs = dict(element.attrib)
+    list_attributes = CDATA_LIST_ATTRIBUTES.get('*', []) + CDATA_LIST_ATTRIBUTES.get(name, [])
+    for key in attrs:
+        if key in list_attributes:
+            attrs[key] = ' '.join(NON_WHITESPACE.findall(attrs[key]))
+    if name == "meta":
+        if attrs.get("charset") is not None:
+            attrs["charset"] = CharsetMetaAttributeValue(attrs["charset"]).encode(DEFAULT_OUTPUT_ENCODING)
+        elif attrs.get("content") is not None and (attrs.get("http-equiv") or '').lower() == "content-type":
+            attrs["content"] = ContentMetaAttributeValue(attrs["content"]).encode(DEFAULT_OUTPUT_ENCODING)
+    if rewrite is not None:
+        rewrite((name,), attrs)
+    return [key + '=' + FORMATTER.quoted_attribute_value(FORMATTER.attribute_value(val))
+            for key, val in sorted(attrs.items())]
+
+
+def prettify(content, rewrite=None):
+    """Produces exactly what `prettify()` on the equivalent BeautifulSoup tag produces.
+
+    Args:
+        content (Partial): The tag to serialize.
+        rewrite (callable): Called with the name and a copy of the attributes of every tag, which it can update.
+
+    Returns:
+        str: The prettified markup."""
+    output = []
+    _serialize(content, True, False, None, False, rewrite, output)
+    return ''.join(output)
+
+
+def _serialize(node, indent_level, has_next_sibling, container, preserve, rewrite, output):
+    # Mirrors content_parser._prettify_tag, with the string classes worked out from the ancestors
+    element = node.element if type(node) is Partial else node
+    name = element.tag
+    attrs = attributes(element, rewrite)
+    children = contents(node)
+    container, preserve = string_context(name, container, preserve)
+
+    close = ''
+    close_tag = ''
+    if not children and name in EMPTY_ELEMENT_TAGS:
+        close = FORMATTER.void_element_close_prefix or ''
+    else:
+        close_tag = f'</{name}>'
+
+    preserve_whitespace = name in PRESERVE_WHITESPACE_TAGS
+    pretty_print = indent_level is not None and not preserve_whitespace
+    indent_space = ' ' * (indent_level - 1) if indent_level is not None else ''
+    indent_contents = indent_level + 1 if pretty_print else None
+
+    if indent_level is not None:
+        output.append(indent_space)
+    output.append(f"<{name}{' ' + ' '.join(attrs) if attrs else ''}{close}>")
+    if pretty_print:
+        output.append("\n")
+    contents_start = len(output)
+
+    last = len(children) - 1
+    for index, child in enumerate(children):
+        if isinstance(child, str) or not is_element(child.element if type(child) is Partial else child):
+            text = output_string(child, name, container, preserve)
+            if text and indent_contents and not preserve_whitespace:
+                text = text.strip()
+            if text:
+                if indent_contents is not None and not preserve_whitespace:
+                    output.append(" " * (indent_contents - 1))
+                output.append(text)
+                if indent_contents is not None and not preserve_whitespace:
+                    output.append("\n")
+        else:
+            _serialize(child, indent_contents, index < last,
+                       container, preserve, rewrite, output)
+
+    if pretty_print:
+        for index in range(len(output) - 1, contents_start - 1, -1):
+            if output[index]:
+                if output[index][-1] != "\n":
+                    output.append("\n")
+                break
+    if pretty_print and close_tag:
+        output.append(indent_space)
+    output.append(close_tag)
+    if indent_level is not None and close_tag and has_next_sibling:
+        output.append("\n")
+
+
+def _strings(node, container, preserve, strings):
+    # Collects what `find_all(string=...)` with the plain string types finds
+    if type(node) is not Partial and not is_element(node):
+        return
+    element = node.element if type(node) is Partial else node
+    container, preserve = string_context(element.tag, container, preserve)
+    for child in contents(node):
+        if isinstance(child, str):
+            if container is None:
+                strings.append(collapse(child, preserve))
+        else:
+            _strings(child, container, preserve, strings)
+
+
+def get_text(node, container=None, preserve=False):
+    """Produces what `get_text()` on the equivalent BeautifulSoup tag produces."""
+    strings = []
+    _strings(node, container, preserve, strings)
+    return ''.join(strings)
+
+
+class LxmlBodySplitter(object):
+    """The lxml version of content_parser.BodySplitter, which returns partials instead of copies.
+
+    BeautifulSoup's children are numbered differently here: the text of an element is -1, its i-th child is 2i and
+    the tail of that child is 2i + 1."""
+
+    def __init__(self, body):
+        self.body = body
+        # Elements are keyed by themselves, which also keeps lxml from creating new proxies for them
+        # element: [preorder position, position after its last descendant]
+        self.positions = {body: [0, None]}
+        # element: index of the element in its parent
+        self.indexes = {}
+        # element id: first element with that id
+        self.ids = {}
+        # element: slots of the strings which are kept even when they are outside of the chapter
+        self.kept_strings = {}
+
+        position = 0
+        stack = [(body, enumerate(body))]
+        while stack:
+            element, children = stack[-1]
+            for index, child in children:
+                if is_element(child):
+                    position += 1
+                    self.positions[child] = [position, None]
+                    self.indexes[child] = index
+                    element_id = child.get("id")
+                    if element_id is not None and element_id not in self.ids:
+                        self.ids[element_id] = child
+                    stack.append((child, enumerate(child)))
+                    break
+            else:
+                self.positions[element][1] = position + 1
+                stack.pop()
+
+    def find(self, selector):
+        if not selector:
+            return None
+        return self.ids.get(selector)
+
+    def contains(self, ancestor, element):
+        start, end = self.positions[ancestor]
+        return start <= self.positions[element][0] < end
+
+    def path(self, element):
+        path = {}
+        while element is not None and element is not self.body:
+            parent = element.getparent()
+            path[parent] = self.indexes[element]
+            element = parent
+        return path
+
+    def extract(self, start=None, end=None):
+        """See BodySplitter.extract.
+
+        Returns:
+            Partial: The body with only that part in it."""
+        dropped = None
+        if start is not None:
+            start_position, start_end = self.positions[start]
+            if start_end - start_position - 1 <= 1:
+                dropped = start
+
+        if start is not None and end is not None:
+            if dropped is not None and self.contains(start, end):
+                end = None
+            elif self.positions[end][0] < self.positions[start][0] and not self.contains(end, start):
+                end = None
+
+        return self.copy_between(self.body, self.path(start), self.path(end), dropped, end)
+
+    def copy_between(self, element, starts, ends, dropped, end):
+        children = []
+        first = starts.get(element)
+        last = ends.get(element)
+        count = len(element)
+        # The slots from `lowest` to `highest` are inside of the part
+        lowest = -1 if first is None else 2 * first
+        highest = 2 * count - 1 if last is None else 2 * last
+        kept_strings = self.strings_to_keep(element)
+
+        for slot in kept_strings:
+            if slot >= lowest:
+                break
+            children.append(self.string_at(element, slot))
+
+        if lowest == -1 and element.text:
+            children.append(element.text)
+
+        for index in range(0 if first is None else first, count if last is None else last + 1):
+            child = element[index]
+            if not is_element(child):
+                children.append(child)
+            elif child is end or child is dropped:
+                pass
+            elif child in starts or child in ends:
+                children.append(self.copy_between(
+                    child, starts, ends, dropped, end))
+            else:
+                children.append(child)
+            if child.tail and 2 * index + 1 <= highest:
+                children.append(child.tail)
+
+        for slot in kept_strings:
+            if slot > highest:
+                children.append(self.string_at(element, slot))
+
+        return Partial(element, children)
+
+    @staticmethod
+    def string_at(element, slot):
+        if slot == -1:
+            return element.text
+        if slot % 2:
+            return element[slot // 2].tail
+        return element[slot // 2]
+
+    def strings_to_keep(self, element):
+        """See BodySplitter.strings_to_keep."""
+        if element in self.kept_strings:
+            return self.kept_strings[element]
+
+        # Strings inside of <script>, <style> and <template> aren't plain strings, so they are all kept
+        keep_all = False
+        ancestor = element
+        while ancestor is not None:
+            if ancestor.tag in PRESERVE_WHITESPACE_TAGS or ancestor.tag in STRING_CONTAINERS:
+                keep_all = True
+                break
+            if ancestor is self.body:
+                break
+            ancestor = ancestor.getparent()
+
+        slots = []
+        if element.text:
+            slots.append((-1, element.text))
+        for index, child in enumerate(element):
+            if not is_element(child):
+                slots.append((2 * index, None))
+            if child.tail:
+                slots.append((2 * index + 1, child.tail))
+
+        kept = []
+        last_whitespace = None
+        for slot, value in slots:
+            if keep_all or value is None or value.strip():
+                if last_whitespace is not None and last_whitespace != kept[-1]:
+                    kept.append(last_whitespace)
+                last_whitespace = None
+                kept.append(slot)
+                continue
+            if last_whitespace is None:
+                kept.append(slot)
+            last_whitespace = slot
+        if last_whitespace is not None and last_whitespace != kept[-1]:
+            kept.append(last_whitespace)
+
+        self.kept_strings[element] = kept
+        return kept
+
+
+class LxmlContentParser(ContentParser):
+    splitter_class = LxmlBodySplitter
+
+    @staticmethod
+    def find_body(file):
+        return find(file, "body")
+
+    @staticmethod
+    def copy_body(body):
+        return Partial(body, contents(body))
+
+    @staticmethod
+    def find_ids(fragment):
+        ids = []
+        for child in fragment.children:
+            if type(child) is Partial:
+                if child.element.get("id") is not None:
+                    ids.append(child.element.get("id"))
+                ids.extend(LxmlContentParser.find_ids(child))
+            elif not isinstance(child, str):
+                ids.extend(element.get("id") for element in child.iter()
+                           if is_element(element) and element.get("id") is not None)
+        return ids
+
+    @staticmethod
+    def merge(content, to_merge):
+        # Only the tags are moved over, like ContentParser.merge
+        content.children.extend(child for child in to_merge.children
+                                if type(child) is Partial or (not isinstance(child, str) and is_element(child)))
+
+    def render(self, content):
+        markup = prettify(content, self.swap_locations)
+        if not self.prepare_text:
+            return markup, None
+        return markup, chapter_text(markup)
+
+
+class LxmlEpubParser(EpubParser):
+    """Parses the EPUB with lxml alone. Several times faster than the BeautifulSoup backend, see benchmark.py, which
+    stays the reference implementation: both produce the same chapters."""
+
+    content_parser_class = LxmlContentParser
+    backend = "lxml"
+    # lxml trees are around half the size of BeautifulSoup trees, and chapters aren't copies of the tree
+    memory_weight = 6
+    tree_weight = 4
+
+    @staticmethod
+    def parse_member(f):
+        return parse_html(f)
+
+    @staticmethod
+    def _try_get_text(content, selector):
+        elem = find(content, selector)
+        if elem is not None:
+            return get_text(elem)
+        return ""
+
+    @staticmethod
+    def find_content_path(container):
+        return find(container, "rootfile").attrib["full-path"]
+
+    @staticmethod
+    def find_navpoints(ncx):
+        return [(int(navpoint.attrib["playorder"]), get_text(next(navpoint.iter("text"))),
+                 next(navpoint.iter("content")).attrib["src"])
+                for navpoint in ncx.iter("navpoint")]
+
+    @staticmethod
+    def find_manifest_items(content):
+        return [ManifestItem(id=item.get("id"), href=item.get("href"), media_type=item.attrib["media-type"])
+                for item in find(content, "manifest") if is_element(item)]
+
+    @staticmethod
+    def find_spine_idrefs(content):
+        for spine_item in find(content, "spine"):
+            yield spine_item.attrib["idref"]
@@ -0,0 +1,151 @@
+import os
+import resource
+import sys
+import threading
+
+# How often the resident set size is sampled while a book is processed
+SAMPLE_INTERVAL = 0.005
+
+PAGE_SIZE = resource.getpagesize()
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+MB = 1024 * 1024
+
+
+def current_rss():
+    """Returns:
+        int -- The resident set size of this process in bytes, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    """Returns:
+        int -- The highest resident set size this process ever had, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT
+
+
+# The measurements in progress in this process, see PeakMemory.shared
+_active = set()
+_active_lock = threading.Lock()
+
+
+class PeakMemory(object):
+    """Measures the peak resident set size of this process while the block runs, by sampling it from a thread.
+
+    The resident set size is used rather than tracemalloc, which slows parsing down several times and doesn't see
+    the memory lxml allocates. If the process reaches a new high-water mark inside the block, that mark is used
+    as well, so a peak between two samples isn't missed. Memory which Python keeps after a previous book counts
+    towards the peak, but not towards the growth.
+
+    The resident set size belongs to the whole process, so while several books are measured at once, for instance
+    by the DB writer threads of process.py --workers, each of them is charged the memory of the others as well.
+    Such a measurement is marked as `shared`, as it is only an upper bound for the book.
+
+    Usage:
+        with PeakMemory() as memory:
+            parse()
+        memory.peak, memory.growth, memory.shared
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self.shared = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def __enter__(self):
+        with _active_lock:
+            if _active:
+                self.shared = True
+                for other in _active:
+                    other.shared = True
+            _active.add(self)
+        self.start_max = max_rss()
+        rss = current_rss()
+        self.start = rss if rss is not None else self.start_max
+        self.peak = self.start
+        if rss is not None:
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with _active_lock:
+            _active.discard(self)
+        end_max = max_rss()
+        if end_max > self.start_max:
+            self.peak = max(self.peak, end_max)
+        self.peak = max(self.peak, current_rss() or 0)
+
+    @property
+    def growth(self):
+        return max(self.peak - self.start, 0)
+
+
+def record_peak(memory, peak):
+    """Adds a measurement to the memory record of a book, keeping the highest one.
+
+    Arguments:
+        memory {dict} -- The memory record of the book, see ParsedBook.memory.
+        peak {PeakMemory} -- The measurement."""
+    memory["peak_rss_bytes"] = max(memory.get("peak_rss_bytes", 0), peak.peak)
+    memory["peak_growth_bytes"] = max(memory.get("peak_growth_bytes", 0), peak.growth)
+    if peak.shared:
+        memory["peak_shared"] = True
+
+
+def account_memory(epub, memory, memory_budget, stream=False, can_stream=True):
+    """Records the sizes of a book and the memory it is estimated to need, and decides how to parse it within the
+    memory budget. A book over the budget is streamed, which keeps only the member cache and one chapter in memory.
+    A book which is over the budget even then isn't parsed at all, as it could get the process killed.
+
+    Arguments:
+        epub {EpubParser} -- The book.
+        memory {dict} -- The memory record of the book, which is updated in place.
+        memory_budget {int} -- The memory a book may take in bytes, or None.
+
+    Keyword Arguments:
+        stream {bool} -- The book is going to be streamed anyway [default: {False}]
+        can_stream {bool} -- The book can be streamed by this process [default: {True}]
+
+    Returns:
+        str -- "full", "stream", "deferred" (to be streamed by another process) or "quarantined"."""
+    html, images = epub.member_sizes()
+    memory.update(file_bytes=epub.file_size(), html_bytes=sum(html), image_bytes=sum(images),
+                  estimate_bytes=epub.memory_estimate(stream))
+    if memory_budget is None or memory["estimate_bytes"] <= memory_budget:
+        return "stream" if stream else "full"
+    if not stream:
+        memory["stream_estimate_bytes"] = epub.memory_estimate(stream=True)
+        if memory["stream_estimate_bytes"] <= memory_budget:
+            return "stream" if can_stream else "deferred"
+    return "quarantined"
+
+
+def over_budget(memory, memory_budget):
+    """The reason a book which account_memory quarantined isn't parsed.
+
+    Arguments:
+        memory {dict} -- The memory record of the book.
+        memory_budget {int} -- The memory a book may take in bytes.
+
+    Returns:
+        str -- The reason."""
+    estimate = memory.get("stream_estimate_bytes", memory["estimate_bytes"])
+    return f"needs about {estimate // MB} MB, over the memory budget of {memory_budget // MB} MB"
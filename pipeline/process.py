@@ -1,10 +1,24 @@
 import sys
-from epub_parser import EpubParser
-from itertools import chain
+import time
+import cProfile
+import contextlib
+from checkpoint import CheckpointJournal
+from epub_parser import EpubParser, MemberCache, DEFAULT_MEMBER_CACHE_BYTES, calc_sha256
+from lxml_parser import LxmlEpubParser
+from content_parser import Chapter, Image
+from profiling import ProfileReport, add, recording, span
+from memory import MB, PeakMemory, account_memory, over_budget, record_peak
+from itertools import chain, islice
 from glob import glob
 from db import db
 import os
+import queue
 import argparse
+import threading
+from dataclasses import dataclass, field
+from typing import List
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import dotenv_values
 
 config = {
@@ -12,82 +26,719 @@ config = {
     **os.environ,  # override loaded values with environment variables
 }
 
-parser = argparse.ArgumentParser(description='Process ebook or ebooks')
-
-parser.add_argument('--drop', action='store_true',
-                    help="Delete the database and output before starting")
-parser.add_argument('--input-dir', default=None,
-                    help="Gutenberg archive directory to convert")
-parser.add_argument('--input-path', default=None,
-                    help="Individual epub to convert")
-parser.add_argument('--max', type=int, default=None,
-                    help="Maximum books to convert in this run")
-parser.add_argument('--dry-run', action='store_true',
-                    help="Do not make any changes, simply list stats about what you will change")
-
-args = parser.parse_args()
-db_connection = config['DB_CONNECTION']
-bucket_name = config["BUCKET_NAME"]
-
-if args.drop:
-    with db(db_connection, False) as con:
-        con.drop_tables()
-
-if args.input_path:
-    files = [args.input_path]
-elif args.input_dir:
-    files = (chain.from_iterable(
-        glob(os.path.join(x[0], '*.epub')) for x in os.walk(args.input_dir)))
-else:
-    parser.error(
-        "no input specified, you must specify one of the following arguments --input-dir or --input-path")
-
-
-if args.dry_run:
-    for file in files:
-        print(file)
+# The parser class behind each --backend. Both produce the same chapters, bs4 is the reference implementation.
+BACKENDS = {
+    "bs4": EpubParser,
+    "lxml": LxmlEpubParser,
+}
+
+db_connection = config.get('DB_CONNECTION')
+bucket_name = config.get("BUCKET_NAME")
+
+# With --incremental, the hashes of the sources which are already stored by the current parser. Each worker process
+# receives its own copy once, see set_current_hashes.
+current_hashes = None
+
+
+@dataclass
+class ParsedBook:
+    """Everything needed to store a book, detached from the EPUB file so it can be sent between processes."""
+    filename: str
+    file_hash: str = None
+    title: str = None
+    author: str = None
+    slug: str = None
+    description: str = None
+    publication: str = None
+    chapters: List[Chapter] = field(default_factory=list)
+    images: List[Image] = field(default_factory=list)
+    error: str = None
+    # The source is already stored by the current parser, so the book wasn't parsed
+    skipped: bool = False
+    # The seconds spent in each stage of parsing and storing the book, see profiling.span
+    stages: dict = field(default_factory=dict)
+    # The sizes of the book, the memory it was estimated to need and the memory it took, see memory.account_memory
+    memory: dict = field(default_factory=dict)
+    # The chapters are a generator which parses the book while it is stored
+    streamed: bool = False
+    # The open EPUB a streamed book is still being parsed from, which is closed once the book is stored
+    source: EpubParser = None
+    # Over the memory budget, but it can be parsed in streaming mode by the process which stores it
+    deferred: bool = False
+    # Over the memory budget even in streaming mode, or it ran out of memory, so it isn't parsed
+    quarantined: bool = False
+
+
+def prepare_args(argv=None):
+    """Parses the command line arguments.
+
+    Keyword Arguments:
+        argv {list} -- The arguments to parse instead of the ones of this process [default: {None}]
+
+    Returns:
+        argparse.Namespace -- The arguments."""
+    parser = argparse.ArgumentParser(description='Process ebook or ebooks')
+
+    parser.add_argument('--drop', action='store_true',
+                        help="Delete the database and output before starting")
+    parser.add_argument('--input-dir', default=None,
+                        help="Gutenberg archive directory to convert")
+    parser.add_argument('--input-path', default=None,
+                        help="Individual epub to convert")
+    parser.add_argument('--max', type=int, default=None,
+                        help="Maximum books to convert in this run")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Do not make any changes, simply list stats about what you will change")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Parse books in a pool of N processes [default: parse in this process]")
+    parser.add_argument('--writers', type=int, default=None,
+                        help="Number of DB writer connections used with --workers [default: min(N, 4)]")
+    parser.add_argument('--bulk', action='store_true',
+                        help="Load books with COPY through staging tables instead of one INSERT per row")
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="Books written per transaction with --bulk [default: 1]")
+    parser.add_argument('--stream', action='store_true',
+                        help="Build and store one chapter at a time to bound memory on very large books (not "
+                        "available with --workers)")
+    parser.add_argument('--precompute-text', action='store_true',
+                        help="Compute stripped text, search text and paragraphs while parsing instead of in the "
+                        "database triggers (requires --bulk)")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default="bs4",
+                        help="Parse the EPUB files with BeautifulSoup or directly with lxml, which is faster "
+                        "[default: bs4]")
+    parser.add_argument('--full-check', action='store_true',
+                        help="Decompress and CRC-check every member of an EPUB before parsing it [default: check the "
+                        "zip structure up front and each member's CRC as it is read]")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Skip the books whose rows were produced by the current parser version, without opening "
+                        "them, and only process new or stale ones")
+    parser.add_argument('--journal', default="ingest-journal.sqlite",
+                        help="SQLite file which records the progress of the run [default: %(default)s]")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the run recorded in --journal where it stopped, instead of listing the input "
+                        "files again")
+    parser.add_argument('--restart', action='store_true',
+                        help="Start a new run even though the run recorded in --journal didn't finish, forgetting "
+                        "the files it didn't get to [default: refuse to start]")
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help="Write the time each book spent in each stage to this JSON file, slowest books first")
+    parser.add_argument('--profile-top', type=int, default=10,
+                        help="Number of slowest books listed by --profile [default: %(default)s]")
+    parser.add_argument('--cprofile', action='store_true',
+                        help="Parse the --profile-top slowest books again under cProfile and write a .prof file "
+                        "for each next to the --profile report (requires --profile)")
+    parser.add_argument('--memory-budget-mb', type=int, default=None,
+                        help="Estimate the memory each book needs before parsing it. Books over this budget are "
+                        "parsed in streaming mode (with --workers, by this process once the pool is done), and books "
+                        "which are over it even then are quarantined in the journal instead [default: no budget]")
+    parser.add_argument('--member-cache-mb', type=int, default=DEFAULT_MEMBER_CACHE_BYTES // (1024 * 1024),
+                        help="Size of the cache of decompressed and parsed members of each book, in MB [default: "
+                        "%(default)s]")
+
+    args = parser.parse_args(argv)
+
+    if args.resume and (args.input_path or args.input_dir or args.max or args.drop):
+        parser.error("--resume continues the files of the previous run, it can't be used together with "
+                     "--input-path, --input-dir, --max or --drop")
+
+    if args.resume and args.restart:
+        parser.error("--resume can't be used together with --restart")
+
+    if not (args.input_path or args.input_dir or args.resume):
+        parser.error(
+            "no input specified, you must specify one of the following arguments --input-dir or --input-path")
+
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    if args.writers is not None and args.workers is None:
+        parser.error("--writers can only be used together with --workers")
+
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    if args.memory_budget_mb is not None and args.memory_budget_mb < 1:
+        parser.error("--memory-budget-mb must be at least 1")
+
+    if args.member_cache_mb < 0:
+        parser.error("--member-cache-mb can't be negative")
+
+    if args.batch_size > 1 and not args.bulk:
+        parser.error("--batch-size can only be used together with --bulk")
+
+    if args.stream and args.workers:
+        parser.error("--stream can't be used together with --workers")
+
+    if args.cprofile and not args.profile:
+        parser.error("--cprofile can only be used together with --profile")
+
+    if args.profile_top < 1:
+        parser.error("--profile-top must be at least 1")
+
+    if args.precompute_text and not args.bulk:
+        parser.error("--precompute-text can only be used together with --bulk")
+
+    # Checked before --drop drops the tables
+    if not (args.resume or args.restart or args.dry_run) and os.path.exists(args.journal):
+        with CheckpointJournal(args.journal) as journal:
+            unfinished = journal.unfinished()
+        if unfinished:
+            parser.error(f"the run recorded in {args.journal} has {unfinished} unfinished files, continue it with "
+                         "--resume or start a new run with --restart")
+
+    return args
+
+
+def list_files(args):
+    if args.input_path:
+        return [args.input_path]
+    return chain.from_iterable(
+        glob(os.path.join(x[0], '*.epub')) for x in os.walk(args.input_dir))
+
+
+def limit_files(files, max_books):
+    """Applies --max to the list of files. The counter has always been incremented before it is checked, so a run
+    with `--max N` attempts at most N - 1 books.
+
+    Arguments:
+        files {iterable} -- The files to process.
+        max_books {int} -- The value of --max, or None for no limit.
+
+    Returns:
+        iterable -- The files which should be processed."""
+    if not max_books:
+        return files
+    return islice(files, max(max_books - 1, 0))
+
+
+def set_current_hashes(hashes):
+    """Sets the hashes which `parse_book(incremental=True)` skips, in this process.
+
+    Arguments:
+        hashes {set} -- The SHA-256 of each source which is already current, see db.get_current_source_hashes."""
+    global current_hashes
+    current_hashes = hashes
+
+
+def parse_book(file, prepare_text=False, stream=False, backend="bs4", full_check=False,
+               member_cache_bytes=DEFAULT_MEMBER_CACHE_BYTES, incremental=False, memory_budget=None, can_stream=True):
+    """Parses a single EPUB into a ParsedBook. Any failure is reported through `ParsedBook.error` rather than raised,
+    so one bad book never takes down the run. This is the unit of work sent to the process pool.
+
+    Arguments:
+        file {str} -- The path of the EPUB file.
+
+    Keyword Arguments:
+        prepare_text {bool} -- Also compute the text which the chapter triggers would compute [default: {False}]
+        stream {bool} -- Leave the chapters as a generator and the images unread, so they are only produced while
+                         the book is being stored. Such a book can't be sent to another process, and parsing errors
+                         surface while storing it [default: {False}]
+        backend {str} -- The key of the parser in BACKENDS [default: {"bs4"}]
+        full_check {bool} -- Decompress and CRC-check the whole EPUB before parsing it [default: {False}]
+        member_cache_bytes {int} -- The size of the member cache of the book, see MemberCache
+                                    [default: {DEFAULT_MEMBER_CACHE_BYTES}]
+        incremental {bool} -- Hash the file first, and skip it if its hash is in `current_hashes` [default: {False}]
+        memory_budget {int} -- The memory a book may take in bytes, see account_memory [default: {None}]
+        can_stream {bool} -- A book over the budget can be streamed, because this process stores it. Otherwise it is
+                             returned as deferred [default: {True}]
+
+    Returns:
+        ParsedBook -- The parsed book."""
+    stages = {}
+    memory = {}
+    with recording(stages), span("parse"):
+        with PeakMemory() as peak:
+            book = _parse_book(file, prepare_text, stream, backend, full_check, member_cache_bytes, incremental,
+                               memory_budget, can_stream, memory)
+        record_peak(memory, peak)
+    book.stages = stages
+    book.memory = memory
+    return book
+
+
+def _parse_book(file, prepare_text, stream, backend, full_check, member_cache_bytes, incremental, memory_budget,
+                can_stream, memory):
+    try:
+        file_hash = None
+        if incremental:
+            with open(file, "rb") as f, span("hash"):
+                file_hash = calc_sha256(f)
+            if file_hash in current_hashes:
+                return ParsedBook(filename=file, file_hash=file_hash, skipped=True)
+        epub = BACKENDS[backend](file, file_hash=file_hash, member_cache=MemberCache(member_cache_bytes))
+    except Exception as e:
+        return ParsedBook(filename=file, error=str(e))
+
+    with contextlib.ExitStack() as open_epub:
+        # Closed on the way out, unless the book is streamed and still has to be parsed while it is stored
+        open_epub.callback(epub.close)
+        book = _parse_epub(epub, file, prepare_text, stream, full_check, memory_budget, can_stream, memory)
+        if book.streamed:
+            book.source = epub
+            open_epub.pop_all()
+    return book
+
+
+def _parse_epub(epub, file, prepare_text, stream, full_check, memory_budget, can_stream, memory):
+    try:
+        path = account_memory(epub, memory, memory_budget, stream, can_stream)
+        memory["path"] = path
+        if path == "quarantined":
+            return ParsedBook(filename=file, file_hash=epub.file_hash, quarantined=True,
+                              error=over_budget(memory, memory_budget))
+        if path == "deferred":
+            return ParsedBook(filename=file, file_hash=epub.file_hash, deferred=True)
+        stream = path == "stream"
+
+        if not epub.parse(prepare_text=prepare_text, stream=stream, full_check=full_check):
+            return ParsedBook(filename=file, file_hash=epub.file_hash, error="not a valid epub")
+
+        if stream:
+            images = epub.content.images
+        else:
+            with span("images"):
+                # The images were hashed to name them, so the process storing them doesn't hash them again, see
+                # db.add_images
+                images = [Image(location=image.location, content=image.read(), format=image.format,
+                                hash_sha256=image.sha256())
+                          for image in epub.content.images]
+            memory["chapters"] = len(epub.content.chapters)
+    except MemoryError:
+        return ParsedBook(filename=file, file_hash=epub.file_hash, quarantined=True,
+                          error="ran out of memory while parsing")
+    except Exception as e:
+        return ParsedBook(filename=file, file_hash=epub.file_hash, error=str(e))
+
+    return ParsedBook(filename=epub.filename, file_hash=epub.file_hash, title=epub.title, author=epub.author,
+                      slug=epub.slug, description=epub.description, publication=epub.publication,
+                      chapters=epub.content.chapters, images=images, streamed=stream)
+
+
+def store_book(con, book: ParsedBook):
+    """Writes a parsed book, its chapters and its images to the database.
+
+    Arguments:
+        con {db} -- The database connection to write with.
+        book {ParsedBook} -- The book to store.
+
+    Returns:
+        int -- The id of the book."""
+    ebook_source = con.get_book_source_by_hash(book.file_hash)
+    if(not ebook_source):
+        # ebook_source should be updated as epub is uploaded to s3
+        # this code remains to make sure we can run this locally
+        # since local runs/test we probably dont want to actually upload anything to s3
+        filename = os.path.basename(book.filename)
+        ebook_source_id = con.add_book_source(
+            "gutenberg", filename, f"s3://{bucket_name}/{filename}", book.file_hash)
+    else:
+        ebook_source_id = ebook_source[0]
+
+    book_id = None
+    if(ebook_source):
+        existing_book = con.get_book_by_ebook_source_id(ebook_source_id)
+        if(existing_book):
+            book_id = existing_book[0]
+
+    if(not book_id):
+        book_id = con.add_book(ebook_source_id, book.title, book.author,
+                               book.slug, book.description, book.publication)
+
+    # In one transaction, so readers never see the new chapters next to the old images, or the rows of two parser
+    # versions at once, see db._stamp_parser_version
+    con.add_chapters(book_id, book.chapters, commit=False)
+    con.add_images(book_id, book.images, commit=False)
+    con.set_source_parser_version(ebook_source_id, commit=False)
+    con.con.commit()
+    return book_id
+
+
+@contextlib.contextmanager
+def storing(book: ParsedBook):
+    """Records the stages of storing a book and the peak memory it took, which is when a streamed book is parsed.
+    The EPUB of a streamed book is closed afterwards, as its chapters can't be stored again."""
+    try:
+        with recording(book.stages), span("store"):
+            with PeakMemory() as peak:
+                yield
+            record_peak(book.memory, peak)
+    finally:
+        if book.source is not None:
+            book.source.close()
+
+
+def store_books(con, books: List[ParsedBook], precomputed_text=False, retry=True):
+    """Writes a batch of books in a single transaction using the bulk loader. If the batch fails it is rolled back
+    and, with `retry`, every book is retried on its own with the row-by-row path, so one bad book does not lose the
+    whole batch. Streamed books can't be retried, as their chapters have already been consumed.
+
+    Arguments:
+        con {db} -- The database connection to write with.
+        books {list} -- The books to store.
+
+    Keyword Arguments:
+        precomputed_text {bool} -- The books carry the text computed by the pipeline [default: {False}]
+        retry {bool} -- Retry the books of a failed batch one by one [default: {True}]
 
-if not args.dry_run:
+    Returns:
+        dict -- The error of each book which couldn't be stored, by filename."""
+    failed = {}
+    try:
+        with con.bulk_loader(precomputed_text) as loader:
+            for book in books:
+                filename = os.path.basename(book.filename)
+                with storing(book):
+                    loader.add_full_book("gutenberg", filename, f"s3://{bucket_name}/{filename}", book.file_hash,
+                                         book.title, book.author, book.slug, book.description, book.publication,
+                                         book.chapters, book.images)
+            commit_start = time.perf_counter()
+        # The whole batch is merged and committed at once, each book is charged its share
+        commit = (time.perf_counter() - commit_start) / len(books)
+        for book in books:
+            add(book.stages, "db.commit", commit)
+            add(book.stages, "store", commit)
+    except Exception as e:
+        if not retry:
+            for book in books:
+                print(f"error: ({book.filename}) {e}")
+                failed[book.filename] = e
+            return failed
+        print(f"warning: batch of {len(books)} books failed ({e}), retrying them one at a time")
+        for book in books:
+            try:
+                with storing(book):
+                    store_book(con, book)
+            except Exception as e:
+                con.con.rollback()
+                print(f"error: ({book.filename}) {e}")
+                failed[book.filename] = e
+    return failed
+
+
+class BookWriter(object):
+    """Buffers parsed books for one DB connection and writes them either one at a time or, with `bulk`, in
+    batches of `batch_size` books per transaction. Books are recorded in the `journal`, and their stages and memory
+    in the profile `report`, once they are committed."""
+
+    def __init__(self, con, bulk=False, batch_size=1, precomputed_text=False, stream=False, journal=None,
+                 report=None):
+        self.con = con
+        self.bulk = bulk
+        self.batch_size = batch_size
+        self.precomputed_text = precomputed_text
+        self.stream = stream
+        self.journal = journal
+        self.report = report
+        self.pending = []
+
+    def write(self, book: ParsedBook):
+        if not self.bulk:
+            if not (self.stream or book.streamed):
+                with storing(book):
+                    store_book(self.con, book)
+                self.record(book)
+                return
+            # Parsing happens while the book is stored, so errors have to be isolated here
+            try:
+                with storing(book):
+                    store_book(self.con, book)
+            except Exception as e:
+                self.con.con.rollback()
+                print(f"error: ({book.filename}) {e}")
+                self.record(book, e)
+                return
+            self.record(book)
+            return
+        self.pending.append(book)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            streamed = self.stream or any(book.streamed for book in self.pending)
+            failed = store_books(self.con, self.pending, self.precomputed_text, retry=not streamed)
+            for book in self.pending:
+                self.record(book, failed.get(book.filename))
+            self.pending = []
+
+    def record(self, book: ParsedBook, error=None):
+        if self.report is not None:
+            self.report.add(book.filename, book.stages, error, book.memory)
+        if self.journal is None:
+            return
+        if error is None:
+            self.journal.finish(book.filename, book.memory)
+        else:
+            self.journal.fail(book.filename, error, book.memory)
+
+
+def report_parsed(book: ParsedBook, journal=None, report=None):
+    """Reports a book which won't be stored, because it was skipped, quarantined or couldn't be parsed."""
+    if report is not None:
+        report.add(book.filename, book.stages, book.error, book.memory)
+    if journal is not None:
+        if book.skipped:
+            journal.finish(book.filename)
+        elif book.quarantined:
+            journal.quarantine(book.filename, book.error, book.memory)
+        else:
+            journal.fail(book.filename, book.error, book.memory)
+    if book.quarantined:
+        print(f"warning: ({book.filename}) quarantined, {book.error}")
+    elif book.error:
+        report_error(book)
+
+
+def report_error(book: ParsedBook):
+    if book.error == "not a valid epub":
+        print(f"warning: ({book.filename}) not a valid epub")
+    else:
+        # You can delete these lines if debugging is annoying.
+        print(f"error: ({book.filename}) {book.error}")
+
+
+def load_current_hashes(con, args):
+    """With --incremental, loads the hashes of the sources which are already current. Returns None otherwise."""
+    if not args.incremental:
+        return None
+    hashes = con.get_current_source_hashes()
+    print(f"{len(hashes)} books are already current")
+    return hashes
+
+
+def make_writer(con, args, journal=None, report=None):
+    return BookWriter(con, args.bulk, args.batch_size, args.precompute_text, args.stream, journal, report)
+
+
+def memory_budget(args):
+    return args.memory_budget_mb * MB if args.memory_budget_mb else None
+
+
+def ingest(files, args, journal=None, report=None):
+    """Parses and stores books one at a time in this process."""
     with db(db_connection) as con:
-        processed = 0
+        set_current_hashes(load_current_hashes(con, args))
+        writer = make_writer(con, args, journal, report)
         for file in files:
-            processed += 1
-            if args.max and processed >= args.max:
-                break
-
+            if journal is not None:
+                journal.begin(file)
             try:
-                epub = EpubParser(file)
+                book = parse_book(file, args.precompute_text, args.stream, args.backend, args.full_check,
+                                  args.member_cache_mb * 1024 * 1024, args.incremental, memory_budget(args),
+                                  can_stream=True)
             except KeyboardInterrupt:
                 sys.exit()
-            except Exception as e:
-                # You can delete these lines if debugging is annoying.
-                print(e)
-                continue
 
-            if not epub.parse():
-                print(f"warning: ({file}) not a valid epub")
+            if book.skipped or book.error:
+                report_parsed(book, journal, report)
                 continue
 
-            ebook_source = con.get_book_source_by_hash(epub.file_hash)
-            if(not ebook_source):
-                # ebook_source should be updated as epub is uploaded to s3
-                # this code remains to make sure we can run this locally
-                # since local runs/test we probably dont want to actually upload anything to s3
-                filename = os.path.basename(epub.filename)
-                ebook_source_id = con.add_book_source(
-                    "gutenberg", filename, f"s3://{bucket_name}/{filename}", epub.file_hash)
-            else:
-                ebook_source_id = ebook_source[0]
-
-            book_id = None
-            if(ebook_source):
-                book = con.get_book_by_ebook_source_id(ebook_source_id)
-                book_id = book[0]
-
-
-            if(not book_id):
-                book_id = con.add_book(ebook_source_id, epub.title, epub.author,
-                                       epub.slug, epub.description, epub.publication)
-
-            con.add_chapters(book_id, epub.content.chapters)
-            con.add_images(book_id, epub.content.images)
+            writer.write(book)
+        writer.flush()
+
+
+def _writer(writer: BookWriter, write_queue: queue.Queue):
+    """Body of a DB writer thread. Each writer owns one connection and stores books until it receives `None`."""
+    while True:
+        book = write_queue.get()
+        if book is None:
+            writer.flush()
+            return
+        try:
+            writer.write(book)
+        except Exception as e:
+            writer.con.con.rollback()
+            print(f"error: ({book.filename}) {e}")
+            writer.record(book, e)
+
+
+def ingest_parallel(files, args, journal=None, report=None):
+    """Parses books in a pool of `--workers` processes and stores them through `--writers` DB connections.
+
+    At most `2 * workers` books are being parsed and `2 * writers` parsed books are waiting to be written at any
+    time, so a slow database applies back-pressure to the parsers instead of filling up memory.
+
+    A worker which dies, e.g. killed by the OOM killer, breaks the pool. The pool is then recreated, and the books
+    which were in flight are parsed again one at a time until the one which kills its worker is quarantined.
+
+    Arguments:
+        files {iterable} -- The EPUB files to ingest.
+        args {argparse.Namespace} -- The command line arguments.
+
+    Keyword Arguments:
+        journal {CheckpointJournal} -- Records the progress of the run [default: {None}]
+        report {ProfileReport} -- Collects the stages of each book [default: {None}]
+
+    Returns:
+        list -- The books which were over the memory budget, to be streamed by ingest."""
+    workers = args.workers
+    writers = args.writers or min(workers, 4)
+
+    # The first connection creates the schema, so the writers never race for it. Connecting up front also means a
+    # bad DSN fails the run before any parsing starts.
+    connections = [db(db_connection, create_tables=(i == 0)) for i in range(writers)]
+    for con in connections:
+        con.con
+    hashes = load_current_hashes(connections[0], args)
+
+    write_queue = queue.Queue(maxsize=writers * 2)
+    writer_threads = [threading.Thread(target=_writer, args=(make_writer(con, args, journal, report), write_queue), daemon=True)
+                      for con in connections]
+    for thread in writer_threads:
+        thread.start()
+
+    files = iter(files)
+    # The books which were in flight when a worker died. They are parsed again one at a time, so the book which
+    # kills its worker is found and quarantined and the others are stored.
+    suspects = []
+    deferred = []
+    pool = None
+    try:
+        in_flight = {}
+        exhausted = False
+        while in_flight or suspects or not exhausted:
+            if pool is None:
+                pool = ProcessPoolExecutor(max_workers=workers, initializer=set_current_hashes, initargs=(hashes,))
+            while len(in_flight) < (1 if suspects else workers * 2):
+                if suspects:
+                    # Left in suspects until it is parsed, so nothing else is parsed next to it
+                    file = suspects[0]
+                else:
+                    file = None if exhausted else next(files, None)
+                    if file is None:
+                        exhausted = True
+                        break
+                if journal is not None:
+                    journal.begin(file)
+                in_flight[pool.submit(
+                    parse_book, file, args.precompute_text, False, args.backend, args.full_check,
+                    args.member_cache_mb * 1024 * 1024, args.incremental, memory_budget(args),
+                    can_stream=False)] = file
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            crashed = []
+            while done:
+                for future in done:
+                    file = in_flight.pop(future)
+                    if suspects and suspects[0] == file:
+                        suspects.pop(0)
+                    try:
+                        book = future.result()
+                    except BrokenProcessPool:
+                        crashed.append(file)
+                        continue
+                    except Exception as e:
+                        book = ParsedBook(filename=file, error=str(e))
+                    if book.deferred:
+                        deferred.append(book.filename)
+                        continue
+                    if book.skipped or book.error:
+                        report_parsed(book, journal, report)
+                        continue
+                    write_queue.put(book)
+                # Every book still in flight in a broken pool fails, so wait for all of them
+                done = wait(in_flight)[0] if crashed else set()
+
+            if crashed:
+                pool.shutdown()
+                pool = None
+                if len(crashed) == 1:
+                    report_parsed(ParsedBook(filename=crashed[0], quarantined=True,
+                                             error="the worker parsing it died"), journal, report)
+                else:
+                    suspects = crashed
+    except KeyboardInterrupt:
+        sys.exit()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for _ in writer_threads:
+            write_queue.put(None)
+        for thread in writer_threads:
+            thread.join()
+        for con in connections:
+            con.close()
+    return deferred
+
+
+def ingest_files(files, args, journal=None, report=None):
+    """Ingests books in this process, or with `--workers` in a pool of processes followed by the books which were
+    deferred because they have to be streamed.
+
+    Arguments:
+        files {iterable} -- The EPUB files to ingest.
+        args {argparse.Namespace} -- The command line arguments.
+
+    Keyword Arguments:
+        journal {CheckpointJournal} -- Records the progress of the run [default: {None}]
+        report {ProfileReport} -- Collects the stages of each book [default: {None}]"""
+    if not args.workers:
+        ingest(files, args, journal, report)
+        return
+    deferred = ingest_parallel(files, args, journal, report)
+    if deferred:
+        # Streamed books are parsed while they are stored, so they can't be parsed by the workers
+        print(f"Streaming {len(deferred)} books over the memory budget")
+        ingest(deferred, argparse.Namespace(**{**vars(args), "workers": None, "stream": True}), journal, report)
+
+
+def profile_books(files, args):
+    """Parses books again under cProfile, without storing them, and writes the statistics of each book next to the
+    --profile report. They can be read with `python -m pstats`.
+
+    Arguments:
+        files {list} -- The EPUB files to profile.
+        args {argparse.Namespace} -- The command line arguments."""
+    prefix = os.path.splitext(args.profile)[0]
+    for file in files:
+        profiler = cProfile.Profile()
+        profiler.runcall(parse_book, file, args.precompute_text, False, args.backend, args.full_check,
+                         args.member_cache_mb * 1024 * 1024)
+        path = f"{prefix}-{os.path.splitext(os.path.basename(file))[0]}.prof"
+        profiler.dump_stats(path)
+        print(f"cProfile of {file}: {path}")
+
+
+def main():
+    args = prepare_args()
+
+    if args.drop:
+        with db(db_connection, False) as con:
+            con.drop_tables()
+
+    if args.dry_run:
+        if args.resume:
+            with CheckpointJournal(args.journal) as journal:
+                files = journal.remaining()
+        else:
+            files = list_files(args)
+        for file in files:
+            print(file)
+        return
+
+    with CheckpointJournal(args.journal) as journal:
+        if args.resume:
+            files = journal.remaining()
+            print(f"Resuming {len(files)} files from {args.journal}")
+        else:
+            files = journal.start(limit_files(list_files(args), args.max), args.restart)
+
+        report = ProfileReport(args.profile, args.profile_top) if args.profile else None
+        ingest_files(files, args, journal, report)
+
+        print(f"Journal: {journal.counts()}")
+        for file, error in journal.quarantined():
+            print(f"quarantined: ({file}) {error}")
+
+    if report is not None:
+        slowest = report.write()
+        report.print_summary(slowest)
+        if args.cprofile:
+            profile_books([book["filename"] for book in slowest], args)
+
+
+if __name__ == "__main__":
+    main()
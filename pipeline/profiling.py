@@ -0,0 +1,146 @@
+import contextlib
+import functools
+import json
+import threading
+import time
+
+# The spans of each thread are added to the stages of the book it is working on, see recording
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def recording(stages):
+    """Adds the spans this thread runs inside the block to `stages`. Books are parsed and stored by different
+    threads or processes, so each of them records into the stages of the book it is working on.
+
+    Arguments:
+        stages {dict} -- The seconds spent in each stage, which is updated in place."""
+    previous = getattr(_local, "stages", None)
+    _local.stages = stages
+    try:
+        yield stages
+    finally:
+        _local.stages = previous
+
+
+def add(stages, stage, seconds):
+    stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Times the block as `stage` of the book being recorded. Spans can be nested, each stage includes the stages
+    inside of it. Does nothing outside of `recording`, so spans are cheap enough to leave around every stage of
+    a book, but not around the work done for each tag.
+
+    Arguments:
+        stage {str} -- The name of the stage."""
+    stages = getattr(_local, "stages", None)
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stages, stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """Decorator version of span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled(handler):
+    """Records the stages of a Lambda handler and prints them as a single JSON line, which can be queried in the
+    logs, whether the handler succeeds or not."""
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        stages = {}
+        try:
+            with recording(stages), span("total"):
+                return handler(event, context)
+        finally:
+            print(json.dumps({"profile": handler.__name__, "stages": stages}))
+    return wrapper
+
+
+class ProfileReport(object):
+    """Collects the stages of every book of a run and writes them as JSON, with the slowest books first and the
+    total time of each stage over the whole run. Books can be added from several threads.
+
+    A book which is added again, for instance when a failed batch is retried one book at a time, has its stages
+    summed. Memory records, see ParsedBook.memory, are merged, so the highest peak of parsing and storing is kept."""
+
+    def __init__(self, path, top=10):
+        self.path = path
+        self.top = top
+        self.lock = threading.Lock()
+        self.books = {}
+
+    def add(self, filename, stages, error=None, memory=None):
+        with self.lock:
+            book = self.books.setdefault(filename, {"filename": filename, "stages": {}, "error": None, "memory": {}})
+            for stage, seconds in stages.items():
+                add(book["stages"], stage, seconds)
+            if error is not None:
+                book["error"] = str(error)
+            for key, value in (memory or {}).items():
+                book["memory"][key] = max(book["memory"].get(key, value), value)
+
+    @staticmethod
+    def total(book):
+        return book["stages"].get("parse", 0.0) + book["stages"].get("store", 0.0)
+
+    def slowest(self):
+        """Returns:
+            list -- The books, slowest first, each with its total time."""
+        with self.lock:
+            books = [dict(book, total=self.total(book)) for book in self.books.values()]
+        return sorted(books, key=lambda book: book["total"], reverse=True)
+
+    def stages(self, books):
+        """The total and the slowest time of each stage over `books`, the stage which took the longest first."""
+        stages = {}
+        for book in books:
+            for stage, seconds in book["stages"].items():
+                summary = stages.setdefault(stage, {"total": 0.0, "max": 0.0, "slowest_book": None})
+                summary["total"] += seconds
+                if seconds > summary["max"]:
+                    summary["max"] = seconds
+                    summary["slowest_book"] = book["filename"]
+        return dict(sorted(stages.items(), key=lambda item: item[1]["total"], reverse=True))
+
+    @staticmethod
+    def largest(books):
+        """The books which were measured, the highest memory growth first."""
+        books = [book for book in books if "peak_growth_bytes" in book["memory"]]
+        return sorted(books, key=lambda book: book["memory"]["peak_growth_bytes"], reverse=True)
+
+    def write(self):
+        """Writes the report to `path`.
+
+        Returns:
+            list -- The `top` slowest books."""
+        books = self.slowest()
+        with open(self.path, "w") as f:
+            json.dump({"stages": self.stages(books), "slowest": [book["filename"] for book in books[:self.top]],
+                       "largest": [book["filename"] for book in self.largest(books)[:self.top]],
+                       "books": books}, f, indent=1)
+        return books[:self.top]
+
+    def print_summary(self, books):
+        print(f"Slowest books (see {self.path}):")
+        for book in books:
+            stages = sorted(((stage, seconds) for stage, seconds in book["stages"].items()
+                             if stage not in ("parse", "store")), key=lambda item: item[1], reverse=True)
+            details = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in stages[:4])
+            if "peak_growth_bytes" in book["memory"]:
+                details += f", peak +{book['memory']['peak_growth_bytes'] / (1024 * 1024):.1f}MB"
+            print(f"  {book['total']:8.2f}s {book['filename']} ({details})")
@@ -0,0 +1,268 @@
+import io
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+# S3 needs every part but the last to be at least 5 MB
+PART_SIZE = 8 * 1024 * 1024
+# Parts uploaded at once, which also bounds the parts held in memory
+MAX_PARTS_IN_FLIGHT = 4
+# A spooled copy is kept in memory up to this size, and moves to a temporary file above it
+SPOOL_SIZE = 64 * 1024 * 1024
+
+# S3RangeReader fetches and caches blocks of this size
+BLOCK_SIZE = 256 * 1024
+# Blocks fetched together with a block which follows the previous read, as zipfile reads members from start to end
+READ_AHEAD_BLOCKS = 4
+CACHE_BLOCKS = 64
+
+
+class MultipartUpload(object):
+    """A write-only file object which uploads to S3 while it is being written, with a multipart upload of
+    `part_size` parts, several of them in flight at once. Nothing appears in the bucket until `complete`, and the
+    upload is aborted if the block exits without completing it, so the parts uploaded so far are thrown away.
+
+    Usage:
+        with MultipartUpload(s3_client, bucket, key) as upload:
+            upload.write(data)
+            upload.complete()
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=PART_SIZE, max_in_flight=MAX_PARTS_IN_FLIGHT):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.buffer = bytearray()
+        self.parts = []
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.completed = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, data):
+        # Waits while max_in_flight parts are uploading, so a slow upload slows the writer down instead of piling up
+        self.slots.acquire()
+        future = self.pool.submit(self._put_part, len(self.parts) + 1, data)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.parts.append(future)
+
+    def _put_part(self, number, data):
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              PartNumber=number, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    def complete(self):
+        """Uploads what is left and waits for every part, and makes the object appear in the bucket."""
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = [future.result() for future in self.parts]
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                 MultipartUpload={'Parts': parts})
+        self.completed = True
+        self.pool.shutdown()
+
+    def abort(self):
+        self.pool.shutdown()
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if not self.completed:
+            self.abort()
+
+
+class Tee(object):
+    """A write-only file object which writes everything to each of `files`."""
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+
+class Spool(object):
+    """A write-only file object which keeps what is written in memory up to `max_size`, and in a temporary file
+    above it. Unlike tempfile.SpooledTemporaryFile, the file it hands out can be read by zipfile on any Python 3.
+
+    Usage:
+        with Spool() as spool:
+            spool.write(data)
+            zipfile.ZipFile(spool.file())
+    """
+
+    def __init__(self, max_size=SPOOL_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.f = io.BytesIO()
+
+    def write(self, data):
+        if isinstance(self.f, io.BytesIO) and self.size + len(data) > self.max_size:
+            f = tempfile.TemporaryFile()
+            f.write(self.f.getbuffer())
+            self.f = f
+        # Always appends, even after file() went back to the start
+        self.f.seek(self.size)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def file(self):
+        """Returns:
+            file -- What was written, as a binary file object at its start."""
+        self.f.seek(0)
+        return self.f
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class S3RangeReader(io.RawIOBase):
+    """A seekable, read-only file object over an S3 object, which only fetches the parts that are read, with ranged
+    GETs of whole blocks. Blocks are cached, and a read which continues the previous one also fetches the next
+    `read_ahead` blocks, so reading a member sequentially costs a few requests.
+
+    ZipFile can read from it directly: opening it fetches the end of the object with the central directory, and
+    reading a member fetches that member only.
+
+    Arguments:
+        s3_client {S3.Client} -- The S3 client.
+        bucket {str} -- The bucket of the object.
+        key {str} -- The key of the object.
+
+    Keyword Arguments:
+        block_size {int} -- The size of the blocks fetched and cached [default: {BLOCK_SIZE}]
+        read_ahead {int} -- The blocks fetched ahead of a sequential read [default: {READ_AHEAD_BLOCKS}]
+        cache_blocks {int} -- The blocks kept, the least recently used are dropped first [default: {CACHE_BLOCKS}]
+    """
+
+    def __init__(self, s3_client, bucket, key, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD_BLOCKS,
+                 cache_blocks=CACHE_BLOCKS):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.name = key
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.cache_blocks = cache_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.last_block = None
+        self.requests = 0
+        self.bytes_fetched = 0
+        # The first request fetches the end of the object, where a zip file starts to be read, and tells its size
+        self.size = None
+        self._fetch_tail(2 * block_size)
+
+    def _get(self, range):
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=range)
+        data = response['Body'].read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        return response, data
+
+    def _store(self, index, data):
+        self.blocks[index] = data
+        self.blocks.move_to_end(index)
+        while len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+
+    def _fetch_tail(self, length):
+        try:
+            response, data = self._get(f"bytes=-{length}")
+        except ClientError as e:
+            # S3 can't satisfy any range of an empty object
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            if self.s3_client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength'] != 0:
+                raise
+            self.size = 0
+            return
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)", response.get('ContentRange', ''))
+        self.size = int(match.group(3)) if match else len(data)
+        start = self.size - len(data)
+        # Only the blocks which were fetched whole are kept, the last block of the object always is
+        first = -(-start // self.block_size)
+        for index in range(first, -(-self.size // self.block_size)):
+            offset = index * self.block_size - start
+            self._store(index, data[offset:offset + self.block_size])
+
+    def _fetch(self, first, last):
+        """Fetches the blocks from `first` to `last` with one request."""
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size)
+        _, data = self._get(f"bytes={start}-{end - 1}")
+        for index in range(first, last + 1):
+            offset = (index - first) * self.block_size
+            self._store(index, data[offset:offset + self.block_size])
+
+    def _block(self, index):
+        if index not in self.blocks:
+            last = index
+            if self.last_block is not None and index == self.last_block + 1:
+                last = min(index + self.read_ahead, (self.size - 1) // self.block_size)
+            # Blocks which are cached already aren't fetched again
+            while last > index and last in self.blocks:
+                last -= 1
+            self._fetch(index, last)
+        self.blocks.move_to_end(index)
+        self.last_block = index
+        return self.blocks[index]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+        self.position = position
+        return position
+
+    def readinto(self, b):
+        end = min(self.position + len(b), self.size)
+        written = 0
+        while self.position < end:
+            index, offset = divmod(self.position, self.block_size)
+            chunk = self._block(index)[offset:offset + end - self.position]
+            if not chunk:
+                # The object is shorter than when it was opened
+                raise IOError(f"{self.key} ended at {self.position} of {self.size} bytes")
+            b[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self.position += len(chunk)
+        return written
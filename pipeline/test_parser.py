@@ -1,7 +1,28 @@
+import contextlib
+import glob
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from benchmark import PHASES, run_benchmark, synthetic_epub
+import bs4
 from bs4 import BeautifulSoup
-from content_parser import ContentParser, Navpoint
-from unittest import TestCase
+from catalog import CatalogIndex
+from checkpoint import CheckpointJournal, UnfinishedRunError
+from content_parser import ContentParser, Image, Navpoint
+from epub_parser import EpubParser, Manifest, MemberCache, calc_sha256
+from lxml_parser import LxmlContentParser, LxmlEpubParser, parse_html
+from memory import MB, PeakMemory
+from profiling import ProfileReport, recording, span
+from s3_io import MultipartUpload, S3RangeReader, Spool, Tee
+from unittest import TestCase, mock
 
 
 def print_result(result):
@@ -187,6 +208,67 @@ class TestContentParser(TestCase):
         ]
         self.assertListEqual(result, expectation)
 
+    def test_leaves_the_page_untouched(self):
+        file_order = ["one.html"]
+        page = scaffold("""
+    <div>
+        <span>Copyright Notice</span>
+        <h1 id="t1">Title 1</h1>
+        <span>1.1</span>
+    </div>
+    <div>
+        text outside of a tag
+        <h1 id="t2"><span>Title</span> <i>2</i></h1>
+        <p>2.1</p>
+    </div>""")()
+        original = str(page)
+        files = {
+            "one.html": lambda: page
+        }
+        navpoints = {
+            "one.html": [
+                Navpoint(title="My First Title", selector="t1"),
+                Navpoint(title="My Second Title", selector="t2"),
+            ],
+        }
+        parser = ContentParser(file_order, files, {}, navpoints)
+
+        chapters = parser.chapters
+        result = []
+        for chapter in chapters:
+            result.append((chapter.title, chapter.content))
+        expectation = [
+            ('My First Title', '<body>\n <div>\n  <span>\n   1.1\n  </span>\n </div>\n <div>\n  text outside of a tag\n </div>\n</body>'),
+            ('My Second Title', '<body>\n <div>\n  text outside of a tag\n  <h1 id="t2">\n   <span>\n    Title\n   </span>\n   <i>\n    2\n   </i>\n  </h1>\n  <p>\n   2.1\n  </p>\n </div>\n</body>')
+        ]
+        self.assertListEqual(result, expectation)
+        self.assertEqual(str(page), original)
+
+    def test_carry_over_cost_does_not_grow_with_the_chapter(self):
+        parser = ContentParser([], {}, {}, {})
+        parser.location_mapping = {}
+        fragments = [scaffold("".join(
+            f'<div id="f{page}-{i}"><p id="p{page}-{i}">{page}.{i}</p></div>' for i in range(20)))().find("body")
+            for page in range(400)]
+
+        # The number of tags under the fragment find_ids searches on each merge
+        visited = []
+        find_ids = ContentParser.find_ids
+
+        def counting_find_ids(fragment):
+            visited.append(len(fragment.find_all(True)))
+            return find_ids(fragment)
+
+        with mock.patch.object(ContentParser, "find_ids", staticmethod(counting_find_ids)):
+            for start in range(0, len(fragments), 100):
+                for fragment in fragments[start:start + 100]:
+                    parser.carry_over("Title", fragment, f"page-{start}.html")
+
+        self.assertEqual(len(parser.location_mapping), 400 * 40 + 4)
+        self.assertEqual(parser.location_mapping["page-300.html#p399-19"], "title#p399-19")
+        # Only the merged fragment is searched, rescanning the whole chapter would grow with every merge
+        self.assertEqual(visited, [40] * 400)
+
     def test_changes_image(self):
         file_order = ["one.html"]
         files = {
@@ -202,7 +284,7 @@ class TestContentParser(TestCase):
     </div>""")
         }
         image_files = {
-            "foo.jpg": "foobar"
+            "foo.jpg": b"foobar"
         }
         navpoints = {
             "one.html": [
@@ -216,10 +298,1091 @@ class TestContentParser(TestCase):
         for chapter in chapters:
             result.append((chapter.title, chapter.content))
         expectation = [
-            ('My First Title', '<body>\n <div>\n </div>\n <div>\n  <span>\n   1.1\n  </span>\n  <img src="image-0.jpg"/>\n </div>\n</body>'),
+            ('My First Title', '<body>\n <div>\n </div>\n <div>\n  <span>\n   1.1\n  </span>\n  <img src="/api/books/image/image-'
+                               f'{hashlib.sha256(b"foobar").hexdigest()[:16]}.jpg"/>\n </div>\n</body>'),
         ]
         self.assertListEqual(result, expectation)
+        self.assertEqual([image.location for image in parser.images],
+                         [f'image-{hashlib.sha256(b"foobar").hexdigest()[:16]}.jpg'])
+
+    def test_prepares_text(self):
+        file_order = ["one.html"]
+        files = {
+            "one.html":
+            scaffold("""
+    <h1 id="t1">Title 1</h1>
+    <p>First <i>paragraph</i>.</p>
+    <p>   </p>
+    <p>A pneumonoultramicroscopicsilicovolcanoconiosis case</p>""")
+        }
+        navpoints = {
+            "one.html": [
+                Navpoint(title="My First Title", selector="t1"),
+            ],
+        }
+        parser = ContentParser(file_order, files, {}, navpoints, prepare_text=True)
+
+        text = parser.chapters[0].text
+        self.assertEqual(
+            text.stripped, ' First paragraph . A pneumonoultramicroscopicsilicovolcanoconiosis case ')
+        self.assertEqual(text.searchable, ' First paragraph . A case ')
+        self.assertListEqual(text.paragraphs, [
+            '<p> First <i> paragraph </i> . </p>',
+            '<p> A pneumonoultramicroscopicsilicovolcanoconiosis case </p>'
+        ])
+
+    def test_prepares_the_text_the_sql_functions_would(self):
+        # xmlparse drops the whitespace-only text nodes prettify adds, so the <p> holding only a <b> has no text() of
+        # its own, and the strings either side of the comment in the <pre> are separate text nodes
+        markup = scaffold("""
+    <h1 id="t1">Title 1</h1>
+    <pre>x <!-- a comment -->ya<b>b</b></pre>
+    <p><b>only bold</b></p>
+    <p>some &amp; <i>more</i></p>""")().encode()
+        navpoints = {"one.html": [Navpoint(title="My First Title", selector="t1")]}
+        for parser_class, load in [
+                (ContentParser, lambda: BeautifulSoup(io.BytesIO(markup), features="lxml")),
+                (LxmlContentParser, lambda: parse_html(io.BytesIO(markup)))]:
+            with self.subTest(parser=parser_class.__name__):
+                text = parser_class(["one.html"], {"one.html": load}, {}, navpoints, prepare_text=True).chapters[0].text
+                self.assertEqual(text.stripped, 'x ya b only bold some & more ')
+                self.assertListEqual(text.paragraphs, ['<p> some &amp; <i> more </i> </p>'])
+
+
+def synthetic_opf(items):
+    manifest = "".join(f'<item id="c{i}.xhtml" href="text/c{i}.xhtml" media-type="application/xhtml+xml"/>'
+                       f'<item id="i{i}" href="images/{i}.png" media-type="image/png"/>' for i in range(items))
+    spine = "".join(f'<itemref idref="c{i}.xhtml"/><itemref idref="c{i // 2}.xhtml"/>' for i in range(items))
+    package = f"""<?xml version="1.0"?>
+<package>
+    <metadata><dc:title>Synthetic</dc:title></metadata>
+    <manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{manifest}</manifest>
+    <spine toc="ncx">{spine}</spine>
+</package>"""
+    book = io.BytesIO()
+    with zipfile.ZipFile(book, "w") as z:
+        z.writestr("OEBPS/content.opf", package)
+    return book
+
+
+def small_epub(with_ncx=True, corrupt_image=False):
+    members = {
+        "META-INF/container.xml": '<container><rootfiles><rootfile full-path="OEBPS/content.opf"/></rootfiles>'
+                                  '</container>',
+        "OEBPS/content.opf": '<package><metadata><dc:title>Small</dc:title></metadata><manifest>'
+                             '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+                             '<item id="one" href="one.html" media-type="application/xhtml+xml"/>'
+                             '<item id="pic" href="pic.png" media-type="image/png"/>'
+                             '</manifest><spine toc="ncx"><itemref idref="one"/></spine></package>',
+        "OEBPS/one.html": '<html><body><h1 id="t1">Title 1</h1><p>1.1 <img src="pic.png"/></p></body></html>',
+        "OEBPS/pic.png": "IMAGE BYTES",
+    }
+    if with_ncx:
+        members["OEBPS/toc.ncx"] = '<ncx><navMap><navPoint playOrder="1"><navLabel><text>One</text></navLabel>' \
+                                   '<content src="one.html#t1"/></navPoint></navMap></ncx>'
+    book = io.BytesIO()
+    with zipfile.ZipFile(book, "w") as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+    if corrupt_image:
+        book = io.BytesIO(book.getvalue().replace(b"IMAGE BYTES", b"IMAGE BYTEZ"))
+    return book
+
+
+class TestEpubParser(TestCase):
+    def test_parses_a_book_the_same_way_twice(self):
+        for parser_class in (EpubParser, LxmlEpubParser):
+            with self.subTest(parser_class=parser_class.__name__), contextlib.redirect_stdout(io.StringIO()):
+                first, second = (parser_class("small.epub", small_epub(), member_cache=MemberCache())
+                                 for _ in range(2))
+                first.parse()
+                second.parse()
+                first, second = first.content, second.content
+                self.assertEqual([chapter.content for chapter in first.chapters],
+                                 [chapter.content for chapter in second.chapters])
+                self.assertEqual([image.location for image in first.images],
+                                 [image.location for image in second.images])
+                self.assertIn(first.images[0].location, first.chapters[0].content)
+
+    def test_checks_the_structure_without_decompressing_every_member(self):
+        for parser_class in (EpubParser, LxmlEpubParser):
+            with self.subTest(parser_class=parser_class.__name__), contextlib.redirect_stdout(io.StringIO()):
+                self.assertTrue(parser_class("small.epub", small_epub()).can_be_unzipped())
+                self.assertFalse(parser_class("small.epub", small_epub(with_ncx=False)).can_be_unzipped())
+
+                epub = parser_class("small.epub", small_epub(corrupt_image=True))
+                self.assertTrue(epub.can_be_unzipped())
+                self.assertFalse(epub.can_be_unzipped(full=True))
+                self.assertFalse(epub.parse(full_check=True))
+
+                # The CRC is still checked, once the member is read to name the image after its content
+                with self.assertRaises(zipfile.BadZipFile):
+                    epub.parse()
+
+    def test_closes_only_the_files_it_opened(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "small.epub")
+            with open(filename, "wb") as f:
+                f.write(small_epub().getvalue())
+            with EpubParser(filename) as epub:
+                self.assertFalse(epub.file.closed)
+            self.assertTrue(epub.file.closed)
+
+            import process
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    mock.patch.object(EpubParser, "close", autospec=True, side_effect=EpubParser.close) as close:
+                book = process.parse_book(filename)
+            self.assertIsNone(book.error)
+            self.assertEqual(close.call_count, 1)
+
+        book = small_epub()
+        with EpubParser("small.epub", book):
+            pass
+        self.assertFalse(book.closed)
+
+    def test_caches_members(self):
+        book = small_epub()
+        cache = MemberCache()
+        with contextlib.redirect_stdout(io.StringIO()):
+            epub = EpubParser("small.epub", book, member_cache=cache).parse(stream=True)
+            chapters = list(epub.content.chapters)
+        self.assertEqual([chapter.title for chapter in chapters], ["One"])
+        # Streaming splits the page twice, the second time comes out of the cache. The image was read to name it.
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+        self.assertIs(epub.get_file_content("OEBPS/pic.png"), epub.get_file_content("/OEBPS/pic.png"))
+        self.assertEqual((cache.hits, cache.misses), (3, 5))
+
+        # The same book parsed by the other backend doesn't share the parsed members, only the image
+        with contextlib.redirect_stdout(io.StringIO()):
+            LxmlEpubParser("small.epub", book, epub.file_hash, member_cache=cache).parse()
+        self.assertEqual((cache.hits, cache.misses), (4, 9))
+
+    def test_evicts_the_least_recently_used_members(self):
+        cache = MemberCache(max_bytes=10)
+        cache.get("a", lambda: "A", 4)
+        cache.get("b", lambda: "B", 4)
+        cache.get("a", lambda: "not cached", 4)
+        cache.get("c", lambda: "C", 4)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, cache.size), (1, 3, 1, 8))
+
+        self.assertEqual(cache.get("d", lambda: "D", 11), "D")
+        self.assertEqual(list(cache.entries), ["a", "c"])
+
+    @staticmethod
+    def resolve_spine(parser_class, items):
+        """Resolves the pages and images of a synthetic OPF, counting the searches of the OPF tree and the lookups
+        of spine items in the manifest."""
+        import lxml_parser
+        epub = parser_class("synthetic.epub", synthetic_opf(items))
+        content = epub.get_file_content_xml("OEBPS/content.opf")
+
+        searches = [mock.patch.object(bs4.Tag, name, autospec=True, side_effect=getattr(bs4.Tag, name))
+                    for name in ("find", "find_all", "select", "select_one")]
+        searches.append(mock.patch.object(lxml_parser, "find", wraps=lxml_parser.find))
+        lookups = mock.MagicMock()
+        with contextlib.ExitStack() as stack:
+            searched = [stack.enter_context(search) for search in searches]
+            epub.manifest = Manifest(epub.find_manifest_items(content))
+            lookups.__getitem__.side_effect = epub.manifest.by_id.__getitem__
+            by_id, epub.manifest.by_id = epub.manifest.by_id, lookups
+            epub.populate_html_page_list(content, "OEBPS")
+            epub.populate_image_list(content, "OEBPS")
+        epub.manifest.by_id = by_id
+        return epub, sum(search.call_count for search in searched), lookups.__getitem__.call_count
+
+    def test_resolves_a_large_spine_in_linear_time(self):
+        for parser_class in (EpubParser, LxmlEpubParser):
+            with self.subTest(parser_class=parser_class.__name__):
+                _, small_searches, _ = self.resolve_spine(parser_class, 500)
+                epub, searches, lookups = self.resolve_spine(parser_class, 5000)
+
+                self.assertEqual(epub.manifest.by_id["ncx"].href, "toc.ncx")
+                self.assertListEqual(epub.html_file_order, [f"text/c{i}.xhtml" for i in range(5000)])
+                self.assertListEqual(list(epub.image_files), [f"images/{i}.png" for i in range(5000)])
+                # Searching the whole OPF for every spine item took around two minutes for this book
+                self.assertEqual(searches, small_searches)
+                # One for each of the 10000 spine items, half of which repeat a page
+                self.assertEqual(lookups, 10000)
+
+
+class TestIncrementalIngest(TestCase):
+    def test_skips_current_books_without_opening_them(self):
+        import process
+        filename = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "epubs", "*.epub")))[0]
+        with open(filename, "rb") as f:
+            file_hash = calc_sha256(f)
+
+        process.set_current_hashes({file_hash})
+        with mock.patch.object(process, "BACKENDS", {}):
+            book = process.parse_book(filename, incremental=True)
+        self.assertTrue(book.skipped)
+        self.assertEqual(book.file_hash, file_hash)
+
+        process.set_current_hashes(set())
+        with contextlib.redirect_stdout(io.StringIO()):
+            book = process.parse_book(filename, incremental=True)
+        self.assertFalse(book.skipped)
+        self.assertIsNone(book.error)
+        self.assertEqual(book.file_hash, file_hash)
+        self.assertTrue(book.chapters)
+
+
+class TestCheckpointJournal(TestCase):
+    def test_resumes_where_the_run_stopped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal.sqlite")
+            with CheckpointJournal(path) as journal:
+                journal.start(["a.epub", "b.epub", "c.epub", "d.epub", "e.epub"])
+                journal.begin("a.epub")
+                journal.finish("a.epub")
+                journal.begin("b.epub")
+                journal.fail("b.epub", "not a valid epub")
+                journal.begin("c.epub")
+                # The run dies while c.epub is in flight
+
+            with CheckpointJournal(path) as journal:
+                self.assertListEqual(journal.remaining(), ["c.epub", "d.epub", "e.epub"])
+                journal.begin("c.epub")
+                # And dies on c.epub again
+
+            with CheckpointJournal(path) as journal:
+                self.assertListEqual(journal.remaining(), ["d.epub", "e.epub"])
+                self.assertDictEqual(journal.counts(), {"done": 1, "failed": 2, "pending": 2})
+
+                # Starting over would lose d.epub and e.epub
+                with self.assertRaises(UnfinishedRunError):
+                    journal.start(["f.epub"])
+                self.assertListEqual(journal.remaining(), ["d.epub", "e.epub"])
+                journal.start(["f.epub"], restart=True)
+                self.assertListEqual(journal.remaining(), ["f.epub"])
+
+    def test_refuses_to_start_over_an_unfinished_run(self):
+        import process
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal.sqlite")
+            argv = ["--input-dir", directory, "--journal", path]
+            process.prepare_args(argv)
+            with CheckpointJournal(path) as journal:
+                journal.start(["a.epub", "b.epub"])
+                journal.begin("a.epub")
+                journal.finish("a.epub")
+
+            with contextlib.redirect_stderr(io.StringIO()) as stderr, self.assertRaises(SystemExit):
+                process.prepare_args(argv)
+            self.assertIn("1 unfinished files", stderr.getvalue())
+            self.assertTrue(process.prepare_args(argv + ["--restart"]).restart)
+            self.assertTrue(process.prepare_args(["--resume", "--journal", path]).resume)
+
+            with CheckpointJournal(path) as journal:
+                journal.begin("b.epub")
+                journal.finish("b.epub")
+            process.prepare_args(argv)
+
+    def test_quarantined_files_are_not_resumed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with CheckpointJournal(os.path.join(directory, "journal.sqlite")) as journal:
+                journal.start(["a.epub", "b.epub"])
+                journal.begin("a.epub")
+                journal.quarantine("a.epub", "over the memory budget", {"estimate_bytes": 2048})
+                self.assertListEqual(journal.remaining(), ["b.epub"])
+                self.assertEqual(journal.memory("a.epub"), {"estimate_bytes": 2048})
+                self.assertIsNone(journal.memory("b.epub"))
+                self.assertListEqual(journal.quarantined(), [("a.epub", "over the memory budget")])
+                self.assertDictEqual(journal.counts(), {"quarantined": 1, "pending": 1})
+
+
+def parse_or_die(file, *args, **kwargs):
+    """Stands in for process.parse_book in the workers of TestParallelIngest. The worker parsing crash.epub dies as
+    if it was killed, and nothing else is opened."""
+    import process
+    if file == "crash.epub":
+        os._exit(1)
+    if file == "bad.epub":
+        raise ValueError("the worker raised")
+    return process.ParsedBook(filename=file, title=file)
+
+
+class TestParallelIngest(TestCase):
+    def test_a_dead_worker_doesnt_stop_the_run(self):
+        import process
+        files = ["a.epub", "crash.epub", "b.epub", "bad.epub", "c.epub", "d.epub", "e.epub"]
+        args = process.prepare_args(["--input-dir", ".", "--workers", "2"])
+        stored = []
+        with tempfile.TemporaryDirectory() as directory, \
+                CheckpointJournal(os.path.join(directory, "journal.sqlite")) as journal, \
+                mock.patch.object(process, "db"), mock.patch.object(process, "parse_book", parse_or_die), \
+                mock.patch.object(process, "store_book", lambda con, book: stored.append(book.filename)), \
+                contextlib.redirect_stdout(io.StringIO()):
+            journal.start(files)
+            self.assertListEqual(process.ingest_parallel(files, args, journal), [])
+            self.assertDictEqual(journal.counts(), {"done": 5, "failed": 1, "quarantined": 1})
+            self.assertListEqual(journal.quarantined(), [("crash.epub", "the worker parsing it died")])
+        # The other books in flight when the worker died are parsed again
+        self.assertCountEqual(stored, ["a.epub", "b.epub", "c.epub", "d.epub", "e.epub"])
+
+
+class TestCatalogIndex(TestCase):
+    HEADER = "Text#,Type,Issued,Title,Language,Authors,Subjects,LoCC,Bookshelves\n"
+
+    def write_csv(self, path, rows):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.HEADER)
+            for id, type, title in rows:
+                f.write(f'{id},{type},2004-01-01,"{title}",en,"Author, A.",,,\n')
+
+    def test_looks_up_books_and_applies_changed_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "pg_catalog.csv")
+            self.write_csv(csv_path, [(1, "Text", "One"), (2, "Sound", "Two"), (3, "Text", "Three, Again"),
+                                      (10, "Text", "Ten")])
+            with CatalogIndex(os.path.join(directory, "pg_catalog.sqlite")) as catalog:
+                self.assertEqual(catalog.refresh(csv_path), {"written": 4, "deleted": 0})
+                self.assertIsNone(catalog.refresh(csv_path))
+
+                self.assertEqual([book["Title"] for book in catalog.range(1, 9)], ["One", "Three, Again"])
+                self.assertEqual(catalog.range(3, 3)[0]["Authors"], "Author, A.")
+                self.assertEqual([book["Text#"] for book in catalog.books()], ["1", "3", "10"])
+                self.assertEqual([book["Text#"] for book in catalog.range(1, 10, type="Sound")], ["2"])
+                self.assertEqual(sorted(book["Text#"] for book in catalog.sample(5)), ["1", "10", "3"])
+                self.assertEqual(len(catalog.sample(2)), 2)
+
+                self.write_csv(csv_path, [(1, "Text", "One"), (3, "Text", "Three, Revised"), (10, "Text", "Ten"),
+                                          (11, "Text", "Eleven")])
+                self.assertEqual(catalog.refresh(csv_path), {"written": 2, "deleted": 1})
+                self.assertEqual([book["Title"] for book in catalog.range(0, 100)],
+                                 ["One", "Three, Revised", "Ten", "Eleven"])
+                self.assertEqual(catalog.count(), 4)
+
+
+class TestLxmlBackend(TestCase):
+    snippets = [
+        """
+    <div>
+        <span>Copyright Notice</span>
+        <h1 id="t1">Title 1</h1>
+        <span>1.1</span>
+    </div>
+    <div>
+        text outside of a tag <!-- a comment -->
+        <h1 id="t2"><span>Title</span> <i>2</i></h1>
+        <p class=" a  b ">2.1 &amp; <a href="one.html#t1">back</a> <a href="elsewhere.html">away</a></p>
+    </div>
+    <pre>  kept
+    <b id="t3">as is</b>  </pre>
+    <p><img src="images/foo.jpg"/><br/>   </p>
+    <script>if (a < b) {}</script>
+    <p>last</p>""",
+        """
+    <h1 id="t1">Title 1</h1>
+    <p>First <i>paragraph</i>.</p>
+    <p>   </p>
+    <h2 id="t2">Title 2</h2>
+    <p>A pneumonoultramicroscopicsilicovolcanoconiosis case</p>""",
+    ]
+
+    @staticmethod
+    def run_parser(parse):
+        with contextlib.redirect_stdout(io.StringIO()):
+            content = parse()
+            return [(image.location, image.read()) for image in content.images], \
+                [(chapter.title, chapter.slug, chapter.content, chapter.order, chapter.text)
+                 for chapter in content.chapters]
+
+    def test_produces_the_same_chapters_from_html(self):
+        for snippet, selectors, prepare_text in itertools.product(
+                self.snippets, [["t1", "t2"], ["t2", "t3"], [None]], [False, True]):
+            markup = scaffold(snippet)().encode()
+            navpoints = {"one.html": [Navpoint(title=f"Title {selector}", selector=selector)
+                                      for selector in selectors]}
+
+            def parse(parser_class, load):
+                return lambda: parser_class(["one.html"], {"one.html": load}, {"images/foo.jpg": b""},
+                                            navpoints, prepare_text=prepare_text)
+
+            with self.subTest(selectors=selectors, prepare_text=prepare_text):
+                self.assertEqual(
+                    self.run_parser(parse(
+                        LxmlContentParser, lambda: parse_html(io.BytesIO(markup)))),
+                    self.run_parser(parse(
+                        ContentParser, lambda: BeautifulSoup(io.BytesIO(markup), features="lxml"))))
+
+    def test_produces_the_same_books(self):
+        files = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "epubs", "*.epub")))
+        self.assertTrue(files)
+        for filename, options in itertools.product(files, [{}, {"prepare_text": True}, {"stream": True}]):
+            with self.subTest(filename=os.path.basename(filename), **options), \
+                    EpubParser(filename) as epub, LxmlEpubParser(filename) as lxml_epub:
+                expected = self.run_parser(lambda: epub.parse(**options).content)
+                self.assertEqual(self.run_parser(lambda: lxml_epub.parse(**options).content), expected)
+
+
+class TestBenchmark(TestCase):
+    def test_synthetic_books_parse_into_their_chapters(self):
+        book = synthetic_epub(spine_files=3, navpoints_per_file=2, anchor_density=0.5, chapter_paragraphs=4,
+                              paragraph_words=5, images=2, image_bytes=16)
+        for parser_class in (EpubParser, LxmlEpubParser):
+            with self.subTest(parser_class=parser_class.__name__), contextlib.redirect_stdout(io.StringIO()):
+                epub = parser_class("synthetic.epub", io.BytesIO(book)).parse()
+                self.assertEqual([chapter.title for chapter in epub.content.chapters],
+                                 [f"Chapter {i}" for i in range(1, 7)])
+                self.assertEqual(len(epub.content.images), 2)
+                # Every link points to a paragraph of the book, so none of them is dropped
+                content = "".join(chapter.content for chapter in epub.content.chapters)
+                self.assertIn("#f", content)
+                self.assertNotIn('href="#"', content)
+                self.assertEqual(content.count("/api/books/image/"), 2)
+
+    def test_times_each_phase(self):
+        book = synthetic_epub(spine_files=2, navpoints_per_file=2, chapter_paragraphs=3, images=1, image_bytes=16)
+        for backend in ("bs4", "lxml"):
+            with self.subTest(backend=backend), contextlib.redirect_stdout(io.StringIO()):
+                result = run_benchmark(book, backend, repeat=1)
+            self.assertEqual(result["chapters"], 4)
+            self.assertEqual(list(result["median"]), PHASES + ["total"])
+            self.assertTrue(all(seconds >= 0 for seconds in result["median"].values()))
+
+
+class TestProfiling(TestCase):
+    def test_records_the_stages_of_each_book(self):
+        import process
+        filename = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "epubs", "*.epub")))[0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            book = process.parse_book(filename)
+        self.assertIsNone(book.error)
+        for stage in ("parse", "hash", "unzip_check", "package", "parse_member", "navpoints", "content", "split",
+                      "render", "images"):
+            self.assertIn(stage, book.stages)
+        self.assertGreaterEqual(book.stages["parse"], book.stages["content"])
+        self.assertGreaterEqual(book.stages["content"], book.stages["split"])
+
+    def test_spans_only_record_inside_recording(self):
+        with span("outside"):
+            pass
+        stages = {}
+        with recording(stages):
+            for _ in range(2):
+                with span("stage"):
+                    pass
+        with span("outside"):
+            pass
+        self.assertEqual(list(stages), ["stage"])
+
+    def test_reports_the_slowest_books(self):
+        with tempfile.TemporaryDirectory() as directory:
+            report = ProfileReport(os.path.join(directory, "profile.json"), top=1)
+            report.add("fast.epub", {"parse": 1.0, "split": 0.5})
+            report.add("slow.epub", {"parse": 2.0, "store": 1.0, "db.add_chapters": 0.8})
+            report.add("slow.epub", {"store": 0.5})
+            self.assertEqual([book["filename"] for book in report.write()], ["slow.epub"])
+            with open(report.path) as f:
+                written = json.load(f)
+        self.assertEqual(written["slowest"], ["slow.epub"])
+        self.assertEqual([book["total"] for book in written["books"]], [3.5, 1.0])
+        self.assertEqual(written["stages"]["parse"]["total"], 3.0)
+        self.assertEqual(written["stages"]["split"]["slowest_book"], "fast.epub")
+
+
+class TestMemoryBudget(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "synthetic.epub")
+        with open(self.filename, "wb") as f:
+            f.write(synthetic_epub(spine_files=4, chapter_paragraphs=20, images=4, image_bytes=64 * 1024))
+
+    def parse(self, **kwargs):
+        import process
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process.parse_book(self.filename, **kwargs)
+
+    def test_streaming_needs_less_memory(self):
+        for parser_class in (EpubParser, LxmlEpubParser):
+            with self.subTest(parser_class=parser_class.__name__), contextlib.redirect_stdout(io.StringIO()), \
+                    parser_class(self.filename) as epub:
+                full, stream = epub.memory_estimate(), epub.memory_estimate(stream=True)
+                html, images = epub.member_sizes()
+            self.assertEqual(len(images), 4)
+            self.assertGreater(full, sum(html) + sum(images))
+            self.assertLessEqual(stream, full)
+
+    def test_books_over_the_budget_are_streamed_or_quarantined(self):
+        book = self.parse(memory_budget=1024 * MB)
+        self.assertIsNone(book.error)
+        self.assertFalse(book.streamed)
+        self.assertLessEqual(book.memory["html_bytes"], book.memory["estimate_bytes"])
+
+        with EpubParser(self.filename) as epub:
+            budget = (epub.memory_estimate(stream=True) + epub.memory_estimate()) // 2
+        book = self.parse(memory_budget=budget)
+        self.assertTrue(book.streamed)
+        self.assertEqual(next(iter(book.chapters)).title, "Chapter 1")
+        # Left open to be parsed while it is stored
+        self.assertFalse(book.source.file.closed)
+        book.source.close()
+
+        book = self.parse(memory_budget=budget, can_stream=False)
+        self.assertTrue(book.deferred)
+        self.assertIsNone(book.error)
+
+        book = self.parse(memory_budget=1)
+        self.assertTrue(book.quarantined)
+        self.assertIn("memory budget", book.error)
+
+    def test_deferred_books_are_streamed_after_the_pool(self):
+        import process
+        args = process.prepare_args(["--input-dir", ".", "--workers", "2", "--memory-budget-mb", "64"])
+        with mock.patch.object(process, "ingest_parallel", return_value=["big.epub"]) as ingest_parallel, \
+                mock.patch.object(process, "ingest") as ingest, contextlib.redirect_stdout(io.StringIO()):
+            process.ingest_files(["big.epub", "small.epub"], args)
+        ingest_parallel.assert_called_once_with(["big.epub", "small.epub"], args, None, None)
+        (files, streaming_args, journal, report), _ = ingest.call_args
+        self.assertEqual(files, ["big.epub"])
+        self.assertTrue(streaming_args.stream)
+        self.assertIsNone(streaming_args.workers)
+
+    def test_measures_the_peak_memory(self):
+        with PeakMemory() as peak:
+            data = bytearray(32 * MB)
+            data[::4096] = b"x" * len(data[::4096])
+        del data
+        self.assertGreaterEqual(peak.growth, 16 * MB)
+
+        book = self.parse()
+        self.assertGreaterEqual(book.memory["peak_rss_bytes"], book.memory["peak_growth_bytes"])
+        self.assertNotIn("peak_shared", book.memory)
+
+    def test_marks_measurements_which_overlap(self):
+        with PeakMemory() as first:
+            with PeakMemory() as second:
+                pass
+        with PeakMemory() as third:
+            pass
+        self.assertTrue(first.shared)
+        self.assertTrue(second.shared)
+        self.assertFalse(third.shared)
+
+    def test_lambda_handlers_stream_or_reject_books_over_the_budget(self):
+        import lambda_functions
+        with contextlib.redirect_stdout(io.StringIO()):
+            with EpubParser(self.filename) as epub:
+                lambda_functions.parse_within_budget(epub, None)
+                self.assertIsInstance(epub.content.chapters, list)
+
+            with EpubParser(self.filename) as epub:
+                budget = (epub.memory_estimate(stream=True) + epub.memory_estimate()) // 2
+                lambda_functions.parse_within_budget(epub, budget)
+                self.assertEqual(next(iter(epub.content.chapters)).title, "Chapter 1")
+                self.assertNotIsInstance(epub.content.chapters, list)
+
+            with EpubParser(self.filename) as epub, self.assertRaisesRegex(MemoryError, "memory budget"):
+                lambda_functions.parse_within_budget(epub, 1)
+            self.assertFalse(hasattr(epub, "content"))
+
+        context = mock.Mock(memory_limit_in_mb="1024")
+        self.assertEqual(lambda_functions.memory_budget(context), 1024 * MB - lambda_functions.RUNTIME_MEMORY)
+        self.assertIsNone(lambda_functions.memory_budget(None))
+
+
+class TestAsyncDownloader(TestCase):
+    """Downloads from a local HTTP server, which fails the first request for some books, and supports conditional and
+    range requests."""
+
+    def setUp(self):
+        requests = self.requests = []
+        self.headers = headers = []
+        # The requests are handled in threads, a request and its headers are recorded together
+        lock = threading.Lock()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with lock:
+                    requests.append(self.path)
+                    headers.append(dict(self.headers))
+                book = self.path.split("/")[-1]
+                body = book.encode() * 100000
+                etag = f'"{book}"'
+                if book == "missing.epub":
+                    self.send_response(404)
+                    body = b""
+                elif book in ("flaky.epub", "down.epub") and (book == "down.epub" or requests.count(self.path) == 1):
+                    self.send_response(503)
+                    body = b""
+                elif self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    body = b""
+                elif self.headers.get("Range") and self.headers.get("If-Range") == etag:
+                    start = int(self.headers["Range"][len("bytes="):-1])
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+                    body = body[start:]
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output = directory.name
+
+    def link(self, id):
+        return f"http://127.0.0.1:{self.server.server_port}/{id}/{id}.epub"
+
+    def download(self, books):
+        import asyncio
+        import async_downloader
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(async_downloader.download_books(
+                books, self.output, concurrency=3, rate=0, retries=2, backoff=0.01, link=self.link))
+
+    def test_downloads_books_concurrently_with_retries(self):
+        books = [("a", "A"), ("b", "B"), ("flaky", "Flaky"), ("missing", "Missing"), ("down", "Down")]
+        paths, up_to_date, failed = self.download(books)
+
+        self.assertEqual(sorted(os.path.basename(path) for path in paths), ["a.epub", "b.epub", "flaky.epub"])
+        for path in paths:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), os.path.basename(path).encode() * 100000)
+        self.assertEqual(sorted(failed), ["down", "missing"])
+        self.assertIsInstance(failed["missing"], FileNotFoundError)
+        self.assertEqual(self.requests.count("/flaky/flaky.epub"), 2)
+        self.assertEqual(self.requests.count("/down/down.epub"), 3)
+        self.assertEqual(self.requests.count("/missing/missing.epub"), 1)
+        # Failed downloads leave no EPUB behind
+        self.assertEqual(sorted(name for name in os.listdir(self.output) if name.endswith(".epub")),
+                         ["a.epub", "b.epub", "flaky.epub"])
+
+    def test_skips_books_which_are_up_to_date_and_resumes_partial_ones(self):
+        paths, _, _ = self.download([("a", "A"), ("b", "B")])
+        self.assertEqual(len(paths), 2)
+        a, b = sorted(paths)
+        # b.epub was interrupted half way
+        os.replace(b, b + ".part")
+        with open(b + ".part", "r+b") as f:
+            f.truncate(1000)
+        del self.requests[:], self.headers[:]
+
+        paths, up_to_date, failed = self.download([("a", "A"), ("b", "B")])
+        self.assertEqual((paths, up_to_date, failed), ([b], [a], {}))
+        requests = dict(zip(self.requests, self.headers))
+        self.assertEqual(requests["/a/a.epub"]["If-None-Match"], '"a.epub"')
+        self.assertEqual(requests["/b/b.epub"]["Range"], "bytes=1000-")
+        with open(b, "rb") as f:
+            self.assertEqual(f.read(), b"b.epub" * 100000)
+        self.assertFalse(os.path.exists(b + ".part"))
+
+    def test_synchronous_downloads_are_conditional_too(self):
+        import epub_downloader
+        path = os.path.join(self.output, "a.epub")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(epub_downloader.download_to_path(self.link("a"), path))
+            self.assertFalse(epub_downloader.download_to_path(self.link("a"), path))
+            # A stale validator downloads the file again
+            with open(epub_downloader.metadata_path(path), "w") as f:
+                json.dump({"url": self.link("a"), "etag": '"old"', "last_modified": None, "size": 600000}, f)
+            self.assertTrue(epub_downloader.download_to_path(self.link("a"), path))
+        self.assertEqual(self.headers[1]["If-None-Match"], '"a.epub"')
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"a.epub" * 100000)
+
+    def test_rate_limit_spaces_out_requests(self):
+        import asyncio
+        import async_downloader
+
+        async def wait_all():
+            limiter = async_downloader.RateLimiter(50)
+            start = time.monotonic()
+            await asyncio.gather(*(limiter.wait("host") for _ in range(6)), limiter.wait("other"))
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(wait_all()), 0.09)
+
+
+class FakeDb(object):
+    """Stands in for db.db in the Lambda handlers, keeping what they store in memory."""
+    connections = 0
+    current_sources = []
+
+    def __init__(self, dsn, create_tables=True):
+        FakeDb.connections += 1
+        self.con = mock.Mock()
+        self.books = {}
+
+    def get_book_source_by_hash(self, file_hash):
+        return None
+
+    def add_book_source(self, source, source_id, s3_path, file_hash):
+        return len(self.books) + 100
+
+    def add_book(self, ebook_source_id, title, *args):
+        self.books[ebook_source_id] = {"title": title}
+        return ebook_source_id + 1000
+
+    def add_chapters(self, book_id, chapters, commit=True):
+        self.books[book_id - 1000]["chapters"] = len(list(chapters))
+
+    def add_images(self, book_id, images, commit=True):
+        self.books[book_id - 1000]["images"] = len(list(images))
+
+    def set_source_parser_version(self, ebook_source_id, commit=True):
+        FakeDb.current_sources.append(ebook_source_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeS3Client(object):
+    """Stands in for the multipart upload and ranged GET calls of an S3 client."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.aborted = []
+        self.lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+        del self.uploads[UploadId]
+
+    def get_object(self, Bucket, Key, Range):
+        from botocore.exceptions import ClientError
+        data = self.objects[Key]
+        first, last = Range[len("bytes="):].split("-")
+        if not first:
+            first, last = max(len(data) - int(last), 0), len(data) - 1
+        first, last = int(first), min(int(last), len(data) - 1)
+        if first > last:
+            raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        return {"ContentRange": f"bytes {first}-{last}/{len(data)}", "Body": io.BytesIO(data[first:last + 1])}
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.objects[Key])}
+
+
+class TestS3Streaming(TestCase):
+    def test_multipart_upload_while_writing(self):
+        s3 = FakeS3Client()
+        with MultipartUpload(s3, "bucket", "book.epub", part_size=10, max_in_flight=2) as upload:
+            for chunk in (b"a" * 7, b"b" * 7, b"c" * 7):
+                upload.write(chunk)
+            self.assertEqual(len(upload.parts), 2)
+            upload.complete()
+        self.assertEqual(s3.objects["book.epub"], b"a" * 7 + b"b" * 7 + b"c" * 7)
+
+        with self.assertRaises(ValueError), MultipartUpload(s3, "bucket", "bad.epub", part_size=10) as upload:
+            upload.write(b"x" * 25)
+            raise ValueError("not an epub")
+        self.assertEqual(s3.aborted, ["bad.epub"])
+        self.assertNotIn("bad.epub", s3.objects)
+
+    def test_spool_moves_to_a_file_when_it_grows(self):
+        with Spool(max_size=10) as spool:
+            Tee(spool).write(b"12345")
+            self.assertIsInstance(spool.file(), io.BytesIO)
+            spool.write(b"678901")
+            self.assertNotIsInstance(spool.file(), io.BytesIO)
+            self.assertEqual(spool.file().read(), b"12345678901")
+
+
+    def test_range_reader_reads_empty_and_shrunk_objects(self):
+        s3 = FakeS3Client()
+        s3.objects["empty.epub"] = b""
+        reader = S3RangeReader(s3, "bucket", "empty.epub")
+        self.assertEqual(reader.size, 0)
+        self.assertEqual(reader.read(), b"")
+
+        s3.objects["book.epub"] = bytes(range(256)) * 4
+        reader = S3RangeReader(s3, "bucket", "book.epub", block_size=64)
+        self.assertEqual(reader.read(8), bytes(range(8)))
+        # Replaced by a shorter object while it is read
+        s3.objects["book.epub"] = s3.objects["book.epub"][:520]
+        reader.seek(500)
+        with self.assertRaises(IOError):
+            reader.read(40)
+
+    def test_range_reader_only_fetches_what_is_read(self):
+        try:
+            from moto import mock_aws
+        except ImportError:
+            try:
+                from moto import mock_s3 as mock_aws
+            except ImportError:
+                self.skipTest("moto isn't installed")
+        import boto3
+        import helpers
+
+        book = synthetic_epub(spine_files=4, chapter_paragraphs=10, images=8, image_bytes=256 * 1024)
+        file_hash = hashlib.sha256(book).hexdigest()
+        local = EpubParser("book.epub", io.BytesIO(book))
+        local.parse()
+
+        environment = {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                       "AWS_DEFAULT_REGION": "us-east-1"}
+        with mock.patch.dict(os.environ, environment), mock_aws():
+            s3_resource = boto3.resource("s3")
+            s3_resource.create_bucket(Bucket="books")
+            s3_resource.Object("books", "book.epub").put(Body=book)
+
+            epub = helpers.EpubParserFromS3("books", "book.epub", s3_resource=s3_resource, file_hash=file_hash)
+            epub.parse()
+            self.assertEqual(epub.file_hash, file_hash)
+            # The images are named after their content, so the chapters are the same wherever the book is read from
+            self.assertEqual(epub.content.chapters, local.content.chapters)
+            self.assertEqual([image.location for image in epub.content.images],
+                             [image.location for image in local.content.images])
+            # Naming the images reads them once, the book isn't fetched again when they are stored
+            reader = epub.file
+            images = [image.read() for image in epub.content.images]
+            self.assertEqual(images, [image.read() for image in local.content.images])
+            self.assertLessEqual(reader.bytes_fetched, len(book) + reader.block_size * reader.read_ahead)
+
+            reader.seek(-10, io.SEEK_END)
+            self.assertEqual(reader.read(), book[-10:])
+            reader.seek(3)
+            self.assertEqual(reader.read(5), book[3:8])
+
+
+@unittest.skipUnless(os.environ.get("TEST_DB_CONNECTION"), "TEST_DB_CONNECTION isn't set")
+class TestDatabase(TestCase):
+    """Runs against the PostgreSQL database of TEST_DB_CONNECTION, whose tables are dropped first."""
+
+    def setUp(self):
+        from db import db
+        self.connections = []
+
+        def connect(version_marker):
+            con = db(os.environ["TEST_DB_CONNECTION"], version_marker=version_marker)
+            self.connections.append(con)
+            return con
+        self.connect = connect
+        with contextlib.redirect_stdout(io.StringIO()):
+            connect(1).drop_tables()
+        self.addCleanup(lambda: [con.close() for con in self.connections])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "synthetic.epub")
+        with open(self.filename, "wb") as f:
+            f.write(synthetic_epub(spine_files=2, navpoints_per_file=2, chapter_paragraphs=3, images=2,
+                                   image_bytes=1024))
+
+    def parse(self, **kwargs):
+        import process
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process.parse_book(self.filename, **kwargs)
+
+    def rows(self, con):
+        cur = con.con.cursor()
+        counts = {}
+        for table in ("books", "chapters", "paragraphs", "images"):
+            cur.execute(f"SELECT version, count(*) FROM {table} GROUP BY version ORDER BY version;")
+            counts[table] = cur.fetchall()
+        cur.execute("SELECT parser_version FROM ebook_source;")
+        counts["parser_version"] = cur.fetchall()
+        # Ends the transaction, which would hold up the next connection creating the schema
+        con.con.commit()
+        return counts
+
+    def test_bulk_loader_finds_a_source_another_writer_added_meanwhile(self):
+        first, second, observer = self.connect(1), self.connect(1), self.connect(1)
+        for con in (first, second, observer):
+            con.con
+        observer.con.autocommit = True
+        cur = first.con.cursor()
+        cur.execute('''INSERT INTO ebook_source (source, source_id, s3_path, hash_sha256)
+            VALUES ('gutenberg', 'a.epub', 's3://a.epub', 'a-hash') RETURNING id;''')
+        source_id = cur.fetchone()[0]
+
+        found = {}
+        thread = threading.Thread(target=lambda: found.update(source=second.bulk_loader().add_book_source(
+            "gutenberg", "a.epub", "s3://a.epub", "a-hash")))
+        thread.start()
+        # The INSERT of the loader waits for the first transaction, after its statement took its snapshot
+        pid = second.con.get_backend_pid()
+        for _ in range(1000):
+            cur = observer.con.cursor()
+            cur.execute("SELECT wait_event_type FROM pg_stat_activity WHERE pid = %s;", (pid,))
+            if cur.fetchone()[0] == "Lock":
+                break
+            thread.join(0.01)
+        first.con.commit()
+        thread.join(10)
+        second.con.rollback()
+        self.assertEqual(found["source"], (source_id, None))
+
+    def test_a_new_parser_version_replaces_the_rows_of_the_old_one(self):
+        import process
+        con = self.connect(1)
+        process.store_book(con, self.parse())
+        first = self.rows(con)
+        self.assertEqual(first["chapters"], [(1, 4)])
+        self.assertEqual(first["parser_version"], [(1,)])
+
+        con = self.connect(2)
+        process.store_book(con, self.parse())
+        second = self.rows(con)
+        self.assertEqual(second["books"], first["books"])
+        self.assertEqual(second["chapters"], [(2, 4)])
+        self.assertEqual(second["images"], [(2, 2)])
+        self.assertEqual(second["parser_version"], [(2,)])
+        self.assertEqual([version for version, _ in second["paragraphs"]], [2])
+
+        con = self.connect(3)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(process.store_books(con, [self.parse(prepare_text=True)], precomputed_text=True), {})
+        third = self.rows(con)
+        self.assertEqual(third["chapters"], [(3, 4)])
+        self.assertEqual([version for version, _ in third["paragraphs"]], [3])
+        self.assertEqual(third["images"], [(3, 2)])
+        self.assertEqual(third["parser_version"], [(3,)])
+
+    def test_a_book_is_stored_in_one_transaction(self):
+        import process
+        con = self.connect(1)
+        process.store_book(con, self.parse())
+        first = self.rows(con)
+
+        con = self.connect(2)
+        with mock.patch.object(con, "add_images", side_effect=RuntimeError("the images failed")), \
+                self.assertRaises(RuntimeError):
+            process.store_book(con, self.parse())
+        con.con.rollback()
+        # Neither the chapters of version 2 nor its stamp are left behind
+        self.assertEqual(self.rows(con), first)
+
+
+class FakeImageCursor(object):
+    """Stands in for the cursor of db.add_images, keeping the image_blobs and images rows in memory."""
+
+    def __init__(self, blobs, rows):
+        self.blobs = blobs
+        self.rows = rows
+        self.result = []
+
+    def execute(self, sql, args=()):
+        if sql.startswith("SELECT hash_sha256 FROM image_blobs"):
+            self.result = [(hash,) for hash in args[0] if hash in self.blobs]
+        elif sql.startswith("INSERT INTO image_blobs"):
+            self.blobs.setdefault(args[0], args[1])
+        elif sql.startswith("INSERT INTO images"):
+            self.rows.append(args)
+
+    def fetchall(self):
+        return self.result
+
+
+class TestImageBlobs(TestCase):
+    def test_images_are_stored_once(self):
+        from db import db
+        blobs, rows = {}, []
+        con = db("", create_tables=False)
+        con._con = mock.Mock()
+        con._con.cursor.side_effect = lambda: FakeImageCursor(blobs, rows)
+        reads = []
+
+        def image(location, content):
+            return Image(location=location, content=lambda: reads.append(location) or content, format="png")
+
+        con.add_images(1, [image("a.png", b"cover"), image("b.png", b"ornament"), image("c.png", b"cover")])
+        self.assertEqual(sorted(blobs.values()), [b"cover", b"ornament"])
+        self.assertEqual([row[1] for row in rows], ["a.png", "b.png", "c.png"])
+        self.assertEqual(rows[0][3], rows[2][3])
+
+        # The images of another book are hashed, and only the one which is new is read again to be stored
+        del reads[:]
+        con.add_images(2, [image("d.png", b"cover"), image("e.png", b"logo")])
+        self.assertEqual(reads, ["d.png", "e.png", "e.png"])
+        self.assertEqual(len(blobs), 3)
+        self.assertEqual(Image(location="f.png", content=b"cover", format="png").sha256(), rows[0][3])
+
+
+class TestLambdaBatches(TestCase):
+    def test_dispatchers_invoke_batches_concurrently(self):
+        import lambda_functions
+        invocations = []
+        # Only returns once three invocations are in flight together
+        barrier = threading.Barrier(3, timeout=10)
+
+        def invoke(FunctionName, InvocationType, Payload):
+            barrier.wait()
+            invocations.append((FunctionName, json.loads(Payload)))
+            return {"StatusCode": 202, "Payload": io.BytesIO()}
+
+        books = [{"gutenberg_id": id} for id in range(1, 6)]
+        with mock.patch.object(lambda_functions.boto3, "client") as client, \
+                contextlib.redirect_stdout(io.StringIO()):
+            client.return_value.invoke.side_effect = invoke
+            response = lambda_functions.DownloadBooks({"data": books, "batch_size": 2}, None)
+
+        self.assertEqual(json.loads(response["body"]), [{"StatusCode": 202}] * 3)
+        self.assertEqual(sorted(invocations, key=lambda invocation: invocation[1]["data"][0]["gutenberg_id"]),
+                         [("downloadBookBatch", {"data": books[0:2]}), ("downloadBookBatch", {"data": books[2:4]}),
+                          ("downloadBookBatch", {"data": books[4:]})])
+
+    def test_batch_handler_reports_each_book(self):
+        import epub_downloader
+        import lambda_functions
+        filename = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "epubs", "*.epub")))[0]
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        def download_file(link, f, hasher=None, chunk_size=4096):
+            if "/2/" in link:
+                raise FileNotFoundError(f"404: {link}")
+            for start in range(0, len(data), chunk_size):
+                f.write(data[start:start + chunk_size])
+                hasher.update(data[start:start + chunk_size])
+
+        s3 = FakeS3Client()
+        FakeDb.connections = 0
+        FakeDb.current_sources = []
+        with mock.patch("db.db", FakeDb), \
+                mock.patch.object(epub_downloader, "download_file", download_file), \
+                mock.patch.object(lambda_functions.boto3, "resource") as resource, \
+                mock.patch.object(EpubParser, "close", autospec=True, side_effect=EpubParser.close) as close, \
+                contextlib.redirect_stdout(io.StringIO()):
+            resource.return_value.meta.client = s3
+            response = lambda_functions.DownloadBookBatch({"data": [{"gutenberg_id": 1}, {"gutenberg_id": 2}]}, None)
 
+        body = json.loads(response["body"])
+        self.assertEqual(body["failed"], 1)
+        self.assertEqual(body["results"][0], {"gutenberg_id": 1, "book_id": 1100, "ebook_source_id": 100})
+        self.assertTrue(body["results"][1]["error"].startswith("404: "))
+        self.assertEqual(FakeDb.connections, 1)
+        self.assertEqual(FakeDb.current_sources, [100])
+        self.assertEqual(resource.call_count, 1)
+        # The book was streamed to S3 as it was downloaded, and the upload of the failed one was thrown away
+        self.assertEqual(s3.objects, {"pg1-images.epub": data})
+        self.assertEqual(len(s3.aborted), 1)
+        # The book which was parsed is closed
+        self.assertEqual(close.call_count, 1)
 
 if __name__ == "__main__":
     unittest.main()